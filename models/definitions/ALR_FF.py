@@ -1,7 +1,170 @@
+from functools import partial
+
 from torch import nn
 from utils.constants import *
 import torch
 
+def apply_token_mask(data, mask):
+    """Zeroes the features of the masked tokens.
+
+    Args:
+        data (Tensor): B x ... x S * F, the features of every token are contiguous
+        mask (Tensor): B x S, broadcast over the F features of every token (and over the middle dimensions of data,
+            e.g. the heads) as a view. A mask of the same shape as data is applied as is.
+    """
+    if mask.shape == data.shape:
+        return data * mask
+    B, S = mask.shape
+    mask = mask.view(B, *([1] * (data.dim() - 2)), S, 1)
+    return (data.reshape(*data.shape[:-1], S, -1) * mask).reshape(data.shape)
+
+def count_visible_tokens(mask, causal = False):
+    """Number of ones of the mask the outputs are masked with, for a B x S token mask.
+
+    With causal = True (decoder self attention substitutes) the count is the one of the B x T x T mask the decoder
+    outputs used to be masked with (no-look-forward & padding), which sets the scale of the training loss: a sentence
+    of length l counts l(l+1)/2 for its positions i < l, which see the tokens 0, ..., i, plus l for each of its T - l
+    padded positions, whose rows keep the l tokens of the sentence.
+    """
+    lengths = mask.sum(dim = 1)
+    if causal:
+        T = mask.shape[1]
+        return (lengths * (lengths + 1) // 2 + (T - lengths) * lengths).sum().item()
+    return lengths.sum().item()
+
+def causal_prefix_forward(layers, data, mask):
+    """Runs the FF of a decoder substitute on every causal prefix of the sentences at once.
+
+    Target position i of sentence b sees the sentence with every token masked by mask[b, i] zeroed. Instead of running
+    the layers once per position, the masked copies of all the non-padded positions are stacked along the batch
+    dimension and go through the layers in a single pass, padded positions are left at 0.
+
+    Args:
+        layers (nn.ModuleList): layers of the FF, applied in order to the flattened (T * MD) sentence
+        data (Tensor): B x T x MD
+        mask (Tensor): B x T padding mask, position i then sees the tokens 0, ..., i. Or B x T x T, the last row is
+            the padding mask
+
+    Returns:
+        Tensor: B x T x output dimension of the last layer
+    """
+    B, T = data.shape[0], data.shape[1]
+    if mask.dim() == 2:
+        b, i = torch.nonzero(mask, as_tuple=True)
+        # no-look-forward rows computed from the positions, the padded tokens come after position i anyway
+        prefix_mask = torch.arange(T, device=data.device)[None, :] <= i[:, None]
+    else:
+        b, i = torch.nonzero(mask[:, -1], as_tuple=True)
+        prefix_mask = mask[b, i]
+    prefixes = (data[b] * prefix_mask.unsqueeze(-1)).reshape(len(b), -1)
+    for layer in layers:
+        prefixes = layer(prefixes)
+    outputs = prefixes.new_zeros((B, T, prefixes.shape[-1]))
+    outputs[b, i] = prefixes
+    return outputs
+
+class LengthAdaptiveFF(nn.Module):
+    """Evaluates a trained substitute on the tokens of the batch only, instead of on sentences zero-padded to MAX_LEN.
+
+    The padded columns of the input are 0 only before the first LayerNorm: its statistics are taken over the whole
+    MAX_LEN * MD width and the padded columns come out of it as -mean/std * gamma + beta. Their contribution to the
+    first Linear is -mean/std * W[:, pad] @ gamma[pad] + W[:, pad] @ beta[pad], the two matrix-vector products are
+    precomputed for every possible sentence length. The first Linear then only multiplies the columns of the tokens in
+    the batch and gives the same result as the padded path. The rows of the last Linear producing padded tokens, which
+    are masked anyway, are skipped as well.
+
+    The tables are computed from the weights at construction time, the module is meant for evaluation.
+    """
+
+    def __init__(self, ff, num_segments = 1):
+        """
+        Args:
+            ff (nn.Module): ALR or ALRR substitute, ff.layers must start with a LayerNorm followed by a Linear
+            num_segments (int): number of MAX_LEN x MD sentences concatenated in the input of ff (2 for the cross attention)
+        """
+        super().__init__()
+        self.ff = ff
+        self.token_width = ff.model_dimension
+        self.num_segments = num_segments
+        norm, linear = ff.layers[0], ff.layers[1]
+        if type(linear) != nn.Linear:
+            raise ValueError(f"ERROR: length adaptive evaluation needs a dense first Linear, found {type(linear).__name__}.")
+        self.full_width = norm.normalized_shape[0]
+        self.segment_width = self.full_width // num_segments
+        self.segment_length = self.segment_width // self.token_width
+        # the decoder self attention substitutes output a single token representation for every causal prefix
+        self.causal = ff.layers[-1].out_features == ff.model_dimension
+        with torch.no_grad():
+            gamma_terms, beta_terms = [], []
+            for j in range(num_segments):
+                for affine, terms in ((norm.weight, gamma_terms), (norm.bias, beta_terms)):
+                    # per_token[t] = W[:, columns of token t] @ affine[columns of token t], shape = L x hidden
+                    per_token = []
+                    for t in range(self.segment_length):
+                        columns = slice(j * self.segment_width + t * self.token_width, j * self.segment_width + (t + 1) * self.token_width)
+                        per_token.append(linear.weight[:, columns].double() @ affine[columns].double())
+                    per_token = torch.stack(per_token)
+                    # terms[j][l] = contribution of the tokens l, ..., L-1 of segment j, i.e. of the padding of a length l sentence
+                    suffix = torch.flip(torch.cumsum(torch.flip(per_token, dims=[0]), dim=0), dims=[0])
+                    terms.append(torch.cat([suffix, suffix.new_zeros((1, suffix.shape[1]))]))
+        # shape = num_segments x (L + 1) x hidden. Plain attributes moved by _apply rather than buffers: they are derived
+        # from the weights and stay out of the state dict (non persistent buffers need PyTorch >= 1.6)
+        self.gamma_terms = torch.stack(gamma_terms).to(linear.weight.dtype)
+        self.beta_terms = torch.stack(beta_terms).to(linear.weight.dtype)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        self.gamma_terms = fn(self.gamma_terms)
+        self.beta_terms = fn(self.beta_terms)
+        return self
+
+    def features(self, data, lengths):
+        """Output of ff for the unpadded inputs.
+
+        Args:
+            data (Tensor): B x sum(lengths) * MD, concatenation of the first lengths[j] tokens of every segment
+            lengths (list[int]): number of tokens kept in every segment
+
+        Returns:
+            Tensor: B x lengths[-1] * MD, or B x MD for the decoder self attention substitutes
+        """
+        norm, linear = self.ff.layers[0], self.ff.layers[1]
+        n_pad = self.full_width - sum(lengths) * self.token_width
+        # LayerNorm statistics of the zero-padded input
+        mean = data.sum(dim=-1, keepdim=True) / self.full_width
+        centered = data - mean
+        var = (centered.pow(2).sum(dim=-1, keepdim=True) + n_pad * mean.pow(2)) / self.full_width
+        rstd = torch.rsqrt(var + norm.eps)
+        gamma_pad = sum(self.gamma_terms[j, l] for j, l in enumerate(lengths))
+        beta_pad = sum(self.beta_terms[j, l] for j, l in enumerate(lengths))
+        hidden = torch.addcmul(linear.bias + beta_pad, -mean * rstd, gamma_pad)
+        offset = 0
+        for j, l in enumerate(lengths):
+            width = l * self.token_width
+            columns = slice(j * self.segment_width, j * self.segment_width + width)
+            x = centered[:, offset:offset + width] * rstd * norm.weight[columns] + norm.bias[columns]
+            hidden = torch.addmm(hidden, x, linear.weight[:, columns].t())
+            offset += width
+        for layer in self.ff.layers[2:-1]:
+            hidden = layer(hidden)
+        last = self.ff.layers[-1]
+        if self.causal:
+            return last(hidden)
+        rows = lengths[-1] * self.token_width
+        return nn.functional.linear(hidden, last.weight[:rows], last.bias[:rows])
+
+    def forward(self, data, mask, lengths):
+        """Same as ff.forward(data, mask) on the inputs cut to the tokens of the batch.
+
+        Args:
+            data (Tensor): B x sum(lengths) * MD, or B x T x MD for the decoder self attention substitutes
+            mask (Tensor): B x lengths[-1] token mask, or B x T padding mask for the decoder self attention substitutes
+            lengths (list[int]): number of tokens kept in every segment of the input
+        """
+        if self.causal:
+            return causal_prefix_forward((partial(self.features, lengths=lengths),), data, mask)
+        return apply_token_mask(self.features(data, lengths), mask)
+
 class FFNetwork_XS(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
         super(FFNetwork_XS, self).__init__()
@@ -19,7 +182,7 @@ class FFNetwork_XS(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_S(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -38,7 +201,7 @@ class FFNetwork_S(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_M(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -57,7 +220,7 @@ class FFNetwork_M(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_L(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -76,7 +239,7 @@ class FFNetwork_L(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_XL(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -95,7 +258,7 @@ class FFNetwork_XL(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_decoder_XS(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -114,16 +277,7 @@ class FFNetwork_decoder_XS(nn.ModuleList):
                 self.layers[-1] = nn.Linear(self.width // widths[i], model_dimension)
                 
     def forward(self,data,mask:torch.Tensor):
-        padding_mask = mask[:,-1]
-        mask = mask.repeat_interleave(self.model_dimension, dim = -1)
-        data = torch.reshape(data, (data.shape[0],data.shape[1]*data.shape[2]))
-        outputs = []
-        for i in range(mask.shape[1]):
-            o = data * mask[:, i, :]
-            for layer in self.layers:
-                o = layer(o)
-            outputs.append(o * padding_mask[:, i].view((-1, 1)).repeat_interleave(self.model_dimension, dim = 1))
-        return torch.stack(outputs, dim = 1)
+        return causal_prefix_forward(self.layers, data, mask)
 
 class FFNetwork_decoder_S(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -142,16 +296,7 @@ class FFNetwork_decoder_S(nn.ModuleList):
                 self.layers[-1] = nn.Linear(self.width // widths[i], model_dimension)
                 
     def forward(self,data,mask:torch.Tensor):
-        padding_mask = mask[:,-1]
-        mask = mask.repeat_interleave(self.model_dimension, dim = -1)
-        data = torch.reshape(data, (data.shape[0],data.shape[1]*data.shape[2]))
-        outputs = []
-        for i in range(mask.shape[1]):
-            o = data * mask[:, i, :]
-            for layer in self.layers:
-                o = layer(o)
-            outputs.append(o * padding_mask[:, i].view((-1, 1)).repeat_interleave(self.model_dimension, dim = 1))
-        return torch.stack(outputs, dim = 1)
+        return causal_prefix_forward(self.layers, data, mask)
 
 class FFNetwork_decoder_M(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -170,16 +315,7 @@ class FFNetwork_decoder_M(nn.ModuleList):
                 self.layers[-1] = nn.Linear(self.width // widths[i], model_dimension)
                 
     def forward(self,data,mask:torch.Tensor):
-        padding_mask = mask[:,-1]
-        mask = mask.repeat_interleave(self.model_dimension, dim = -1)
-        data = torch.reshape(data, (data.shape[0],data.shape[1]*data.shape[2]))
-        outputs = []
-        for i in range(mask.shape[1]):
-            o = data * mask[:, i, :]
-            for layer in self.layers:
-                o = layer(o)
-            outputs.append(o * padding_mask[:, i].view((-1, 1)).repeat_interleave(self.model_dimension, dim = 1))
-        return torch.stack(outputs, dim = 1)
+        return causal_prefix_forward(self.layers, data, mask)
     
 class FFNetwork_decoder_L(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -198,16 +334,7 @@ class FFNetwork_decoder_L(nn.ModuleList):
                 self.layers[-1] = nn.Linear(self.width // widths[i], model_dimension)
                 
     def forward(self,data,mask:torch.Tensor):
-        padding_mask = mask[:,-1]
-        mask = mask.repeat_interleave(self.model_dimension, dim = -1)
-        data = torch.reshape(data, (data.shape[0],data.shape[1]*data.shape[2]))
-        outputs = []
-        for i in range(mask.shape[1]):
-            o = data * mask[:, i, :]
-            for layer in self.layers:
-                o = layer(o)
-            outputs.append(o * padding_mask[:, i].view((-1, 1)).repeat_interleave(self.model_dimension, dim = 1))
-        return torch.stack(outputs, dim = 1)
+        return causal_prefix_forward(self.layers, data, mask)
     
 class FFNetwork_decoder_XL(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -226,16 +353,7 @@ class FFNetwork_decoder_XL(nn.ModuleList):
                 self.layers[-1] = nn.Linear(self.width * widths[i], model_dimension)
                 
     def forward(self,data,mask:torch.Tensor):
-        padding_mask = mask[:,-1]
-        mask = mask.repeat_interleave(self.model_dimension, dim = -1)
-        data = torch.reshape(data, (data.shape[0],data.shape[1]*data.shape[2]))
-        outputs = []
-        for i in range(mask.shape[1]):
-            o = data * mask[:, i, :]
-            for layer in self.layers:
-                o = layer(o)
-            outputs.append(o * padding_mask[:, i].view((-1, 1)).repeat_interleave(self.model_dimension, dim = 1))
-        return torch.stack(outputs, dim = 1)
+        return causal_prefix_forward(self.layers, data, mask)
     
     
 class FFNetwork_cross_decoder_XS(nn.ModuleList):
@@ -256,7 +374,7 @@ class FFNetwork_cross_decoder_XS(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_cross_decoder_S(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -275,7 +393,7 @@ class FFNetwork_cross_decoder_S(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_cross_decoder_M(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -294,7 +412,7 @@ class FFNetwork_cross_decoder_M(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_cross_decoder_L(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -313,7 +431,7 @@ class FFNetwork_cross_decoder_L(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_cross_decoder_XL(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -333,4 +451,4 @@ class FFNetwork_cross_decoder_XL(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
\ No newline at end of file
+        return apply_token_mask(data, mask)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from torch import nn
 from utils.constants import *
+from models.definitions.ALR_FF import apply_token_mask
 import torch
 
 class FFNetwork_XS(nn.ModuleList):
@@ -20,7 +21,7 @@ class FFNetwork_XS(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_S(nn.ModuleList):
     def __init__(self, output_dim=800,model_dimension=128,sentence_length=MAX_LEN):
@@ -40,7 +41,7 @@ class FFNetwork_S(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_M(nn.ModuleList):
     def __init__(self, output_dim=800,model_dimension=128,sentence_length=MAX_LEN):
@@ -60,7 +61,7 @@ class FFNetwork_M(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 
 class FFNetwork_L(nn.ModuleList):
@@ -81,7 +82,7 @@ class FFNetwork_L(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_XL(nn.ModuleList):
     def __init__(self, output_dim=800,model_dimension=128,sentence_length=MAX_LEN):
@@ -101,4 +102,70 @@ class FFNetwork_XL(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
+
+class FusedHeadsFF(nn.Module):
+    """The FFs of all the heads of a layer evaluated together.
+
+    All the heads get the same input, so the statistics of the first LayerNorm are computed once. The parameters of
+    the heads are stacked along a leading head dimension and every Linear layer is a single batched matmul
+    (NH x B x in) @ (NH x in x out) instead of one call per head.
+
+    Args:
+        ff_list (list[FFNetwork_*]): the FFs of the heads, all of the same class
+    """
+    def __init__(self, ff_list):
+        super(FusedHeadsFF, self).__init__()
+        self.number_of_heads = len(ff_list)
+        # (kind, argument) for every layer of the FFs, the stacked parameters are in self.weights/self.biases
+        self.stages = []
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for j, layer in enumerate(ff_list[0].layers):
+            modules = [ff.layers[j] for ff in ff_list]
+            if isinstance(layer, nn.LayerNorm):
+                self.stages.append(("norm", layer.eps))
+                self.weights.append(nn.Parameter(torch.stack([m.weight.detach() for m in modules]).unsqueeze(1)))  # NH x 1 x W
+                self.biases.append(nn.Parameter(torch.stack([m.bias.detach() for m in modules]).unsqueeze(1)))     # NH x 1 x W
+            elif isinstance(layer, nn.Linear):
+                self.stages.append(("linear", None))
+                self.weights.append(nn.Parameter(torch.stack([m.weight.detach().t() for m in modules])))        # NH x in x out
+                self.biases.append(nn.Parameter(torch.stack([m.bias.detach() for m in modules]).unsqueeze(1)))  # NH x 1 x out
+            elif isinstance(layer, nn.LeakyReLU):
+                self.stages.append(("leaky_relu", layer.negative_slope))
+            else:
+                raise TypeError(f"ERROR: layer {type(layer)} cannot be fused.")
+
+    @classmethod
+    def from_checkpoints(cls, FF_net, model_paths, map_location=None):
+        """Packs the per-head checkpoints (MHA_SEPARATE_CHECKPOINT_FORMAT, one path per head) into the fused form."""
+        ff_list = []
+        for model_path in model_paths:
+            ff_net = FF_net()
+            ff_net.load_state_dict(torch.load(model_path, map_location=map_location))
+            ff_list.append(ff_net)
+        return cls(ff_list)
+
+    def forward(self, data, mask):
+        """
+        Args:
+            data (Tensor): B x W, the flattened sentence shared by all the heads
+            mask (Tensor): B x S token mask (see apply_token_mask), or B x NH x output_dim
+
+        Returns:
+            Tensor: B x NH x output_dim
+        """
+        x = data.unsqueeze(0)
+        parameters = 0
+        for (kind, argument) in self.stages:
+            if kind == "norm":
+                # the statistics are shared as long as the input is the same for every head
+                x = nn.functional.layer_norm(x, (x.shape[-1],), eps=argument)
+                x = x * self.weights[parameters] + self.biases[parameters]
+                parameters += 1
+            elif kind == "linear":
+                x = torch.baddbmm(self.biases[parameters], x.expand(self.number_of_heads, -1, -1), self.weights[parameters])
+                parameters += 1
+            else:
+                x = nn.functional.leaky_relu(x, argument)
+        return apply_token_mask(x.transpose(0, 1), mask)
@@ -1,5 +1,6 @@
 from torch import nn
 from utils.constants import *
+from models.definitions.ALR_FF import apply_token_mask
 import torch
 
 class FFNetwork_XS(nn.ModuleList):
@@ -19,7 +20,7 @@ class FFNetwork_XS(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_S(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -38,7 +39,7 @@ class FFNetwork_S(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_M(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -57,7 +58,7 @@ class FFNetwork_M(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_L(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -76,7 +77,7 @@ class FFNetwork_L(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 class FFNetwork_XL(nn.ModuleList):
     def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
@@ -95,6 +96,6 @@ class FFNetwork_XL(nn.ModuleList):
     def forward(self,data,mask):
         for layer in self.layers:
             data=layer(data)
-        return data*mask
+        return apply_token_mask(data, mask)
 
 
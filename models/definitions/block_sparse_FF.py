@@ -0,0 +1,82 @@
+from torch import nn
+from models.definitions.ALR_FF import LengthAdaptiveFF
+import torch
+
+"""
+    Block-sparse execution of the FF substitutes pruned with utils/pruning_utils.py. The pruned checkpoints are dense
+    with zeroed blocks; to_block_sparse converts their Linears to BlockSparseLinear, which only stores and multiplies the
+    non zero blocks.
+"""
+
+BLOCK_SIZE = (32, 32)
+
+class BlockSparseLinear(nn.Module):
+    """Linear whose weight is stored as its non zero out x in blocks (block_rows[k], block_cols[k]) = blocks[k]."""
+
+    def __init__(self, in_features, out_features, block_size, block_rows, block_cols, blocks, bias):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.block_size = tuple(block_size)
+        self.register_buffer("block_rows", block_rows)
+        self.register_buffer("block_cols", block_cols)
+        # shape = nnz x block out x block in
+        self.blocks = nn.Parameter(blocks)
+        self.bias = nn.Parameter(bias)
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear, block_size = BLOCK_SIZE):
+        bo, bi = block_size
+        if linear.out_features % bo != 0 or linear.in_features % bi != 0:
+            raise ValueError(f"ERROR: block size {block_size} does not divide the {linear.out_features} x {linear.in_features} weight.")
+        blocks = linear.weight.reshape(linear.out_features // bo, bo, linear.in_features // bi, bi).transpose(1, 2)
+        block_rows, block_cols = torch.nonzero(blocks.abs().sum(dim=(2, 3)) != 0, as_tuple=True)
+        return cls(linear.in_features, linear.out_features, block_size, block_rows, block_cols, blocks[block_rows, block_cols].clone(), linear.bias.clone())
+
+    def density(self):
+        bo, bi = self.block_size
+        return len(self.blocks) / ((self.out_features // bo) * (self.in_features // bi))
+
+    def forward(self, data):
+        bo, bi = self.block_size
+        shape = data.shape[:-1]
+        # in blocks x N x bi
+        data = data.reshape(-1, self.in_features // bi, bi).transpose(0, 1)
+        # one small matmul per non zero block, batched: nnz x N x bo
+        products = torch.bmm(data[self.block_cols], self.blocks.transpose(1, 2))
+        outputs = products.new_zeros((self.out_features // bo, products.shape[1], bo)).index_add_(0, self.block_rows, products)
+        return outputs.transpose(0, 1).reshape(*shape, self.out_features) + self.bias
+
+    def weight_matrix(self):
+        """Equivalent dense out x in weight."""
+        bo, bi = self.block_size
+        weight = self.blocks.new_zeros((self.out_features // bo, self.in_features // bi, bo, bi))
+        weight[self.block_rows, self.block_cols] = self.blocks
+        return weight.transpose(1, 2).reshape(self.out_features, self.in_features)
+
+def block_density(linear, block_size = BLOCK_SIZE):
+    bo, bi = block_size
+    blocks = linear.weight.reshape(linear.out_features // bo, bo, linear.in_features // bi, bi)
+    return (blocks.abs().sum(dim=(1, 3)) != 0).float().mean().item()
+
+def to_block_sparse(module, block_size = BLOCK_SIZE, max_density = 0.5):
+    """Replaces in place the Linears of module with at most max_density of non zero blocks by BlockSparseLinear. The
+    dense Linears (e.g. the ones of the baseline) are left as they are, as well as the length adaptive substitutes which
+    read the weights of their first Linear directly.
+
+    Returns:
+        int: number of converted Linears
+    """
+    converted = 0
+    for name, child in module.named_children():
+        if isinstance(child, LengthAdaptiveFF):
+            continue
+        if type(child) == nn.Linear:
+            bo, bi = block_size
+            if child.out_features % bo == 0 and child.in_features % bi == 0 and block_density(child, block_size) <= max_density:
+                setattr(module, name, BlockSparseLinear.from_linear(child, block_size))
+                converted += 1
+            continue
+        converted += to_block_sparse(child, block_size, max_density)
+    return converted
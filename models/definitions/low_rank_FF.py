@@ -0,0 +1,223 @@
+import math
+
+from torch import nn
+from utils.constants import *
+from models.definitions.ALR_FF import apply_token_mask, causal_prefix_forward
+import torch
+
+"""
+    Factorized versions of the sentence-wide substitutes of ALR_FF.py, ALRR_FF.py and ELR_FF.py. The layers keep the
+    LayerNorm -> Linear -> LeakyReLU -> LayerNorm -> Linear layout of the dense networks (same indices in self.layers),
+    every Linear is replaced by:
+        - low_rank: W = U @ V with U: out x rank and V: rank x in.
+        - kronecker: W = sum_r A_r (x) B_r. The widths are multiples of the model dimension (the token representations
+          are concatenated), A_r mixes the token slots (out / MD x in / MD) and B_r the features (MD x MD).
+    They can be trained from scratch or initialized from trained dense checkpoints by truncated SVD with
+    scripts/full_sentence/factorize_substitutes.py. They plug into the same adapters as the dense networks, the length
+    adaptive evaluation (LengthAdaptiveFF) needs a dense first Linear and is not supported.
+"""
+
+FACTORIZATIONS = ["low_rank", "kronecker"]
+
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.V = nn.Linear(in_features, rank, bias=False)
+        self.U = nn.Linear(rank, out_features)
+
+    def forward(self, data):
+        return self.U(self.V(data))
+
+    def weight_matrix(self):
+        """Equivalent dense out x in weight."""
+        return self.U.weight @ self.V.weight
+
+    @torch.no_grad()
+    def load_from_linear(self, linear):
+        """Truncated SVD of the weight of a dense Linear, the singular values are split evenly between U and V."""
+        U, S, V = torch.svd(linear.weight.detach().float())
+        root = S[:self.rank].sqrt()
+        self.U.weight.copy_(U[:, :self.rank] * root)
+        self.V.weight.copy_(V[:, :self.rank].t() * root[:, None])
+        self.U.bias.copy_(linear.bias)
+        return self
+
+class KroneckerLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank, model_dimension=128):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.model_dimension = model_dimension
+        self.in_slots = in_features // model_dimension
+        self.out_slots = out_features // model_dimension
+        self.A = nn.Parameter(torch.empty((rank, self.out_slots, self.in_slots)))
+        self.B = nn.Parameter(torch.empty((rank, model_dimension, model_dimension)))
+        self.bias = nn.Parameter(torch.empty(out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same output scale as the default initialization of nn.Linear, split between the factors and the terms
+        nn.init.uniform_(self.A, -1 / math.sqrt(self.in_slots), 1 / math.sqrt(self.in_slots))
+        nn.init.uniform_(self.B, -1 / math.sqrt(self.model_dimension * self.rank), 1 / math.sqrt(self.model_dimension * self.rank))
+        nn.init.uniform_(self.bias, -1 / math.sqrt(self.in_features), 1 / math.sqrt(self.in_features))
+
+    def forward(self, data):
+        shape = data.shape[:-1]
+        data = data.reshape(-1, self.in_slots, self.model_dimension)
+        # (A_r (x) B_r) x = A_r X B_r^T for the in_slots x MD matrix X of the input
+        data = torch.einsum('nbq,rpq->nrbp', data, self.B)
+        data = torch.einsum('rab,nrbp->nap', self.A, data)
+        return data.reshape(*shape, self.out_features) + self.bias
+
+    def weight_matrix(self):
+        """Equivalent dense out x in weight."""
+        return torch.einsum('rab,rpq->apbq', self.A, self.B).reshape(self.out_features, self.in_features)
+
+    @torch.no_grad()
+    def load_from_linear(self, linear):
+        """Nearest sum of rank Kronecker products (Van Loan-Pitsianis): truncated SVD of the rearranged weight whose
+        rows are the (token slot, token slot) pairs and columns the (feature, feature) pairs."""
+        MD = self.model_dimension
+        rearranged = linear.weight.detach().float().reshape(self.out_slots, MD, self.in_slots, MD).permute(0, 2, 1, 3)
+        U, S, V = torch.svd(rearranged.reshape(self.out_slots * self.in_slots, MD * MD))
+        root = S[:self.rank].sqrt()
+        self.A.copy_((U[:, :self.rank] * root).t().reshape(self.rank, self.out_slots, self.in_slots))
+        self.B.copy_((V[:, :self.rank] * root).t().reshape(self.rank, MD, MD))
+        self.bias.copy_(linear.bias)
+        return self
+
+def factorized_linear(in_features, out_features, factorization, rank, model_dimension=128):
+    """Factorized Linear, or a dense one when the factorization would not save parameters (e.g. the MD-wide output
+    layer of the decoder substitutes)."""
+    if factorization == "low_rank":
+        if rank * (in_features + out_features) >= in_features * out_features:
+            return nn.Linear(in_features, out_features)
+        return LowRankLinear(in_features, out_features, rank)
+    if factorization == "kronecker":
+        if rank * ((in_features // model_dimension) * (out_features // model_dimension) + model_dimension ** 2) >= in_features * out_features:
+            return nn.Linear(in_features, out_features)
+        return KroneckerLinear(in_features, out_features, rank, model_dimension)
+    raise ValueError(f"ERROR: factorization must be in {FACTORIZATIONS}, got {factorization}.")
+
+class FactorizedFFNetwork(nn.Module):
+    def __init__(self, widths, factorization, ranks, causal=False, model_dimension=128, sentence_length=MAX_LEN):
+        """
+        Args:
+            widths (list[int]): input, hidden and output widths, as in the dense network
+            ranks (list[int]): rank of every Linear
+            causal (bool): decoder self attention substitute, run on every causal prefix (see causal_prefix_forward)
+        """
+        super().__init__()
+        self.sentence_length=sentence_length
+        self.model_dimension=model_dimension
+        self.width=widths[0]
+        self.factorization=factorization
+        self.causal=causal
+        self.depth=len(widths)-1
+        self.layers=nn.ModuleList()
+        for i in range(self.depth):
+            self.layers.extend([nn.LayerNorm(widths[i]), factorized_linear(widths[i], widths[i+1], factorization, ranks[i], model_dimension)])
+            if(i<self.depth-1):
+                self.layers.append(nn.LeakyReLU())
+
+    def forward(self,data,mask):
+        if self.causal:
+            return causal_prefix_forward(self.layers, data, mask)
+        for layer in self.layers:
+            data=layer(data)
+        return apply_token_mask(data, mask)
+
+    @torch.no_grad()
+    def load_from_dense(self, dense):
+        """Copies the LayerNorms of a trained dense network with the same widths and factorizes its Linears.
+
+        Returns:
+            dict: relative Frobenius error of the factorized weight of every layer index
+        """
+        errors = {}
+        for i, (layer, dense_layer) in enumerate(zip(self.layers, dense.layers)):
+            if type(layer) == nn.LeakyReLU:
+                continue
+            if type(layer) == nn.LayerNorm or type(layer) == nn.Linear:
+                layer.load_state_dict(dense_layer.state_dict())
+                continue
+            layer.load_from_linear(dense_layer)
+            errors[i] = (torch.norm(layer.weight_matrix() - dense_layer.weight) / torch.norm(dense_layer.weight)).item()
+        return errors
+
+def get_substitute_class(module, substitute_class):
+    """Substitute class by name, from module (ALR_FF, ALRR_FF or ELR_FF) or from the factorized family."""
+    if hasattr(module, substitute_class):
+        return getattr(module, substitute_class)
+    import models.definitions.low_rank_FF as low_rank
+    if hasattr(low_rank, substitute_class):
+        return getattr(low_rank, substitute_class)
+    raise ValueError(f"ERROR: substitute class {substitute_class} not found in {module.__name__} nor in {low_rank.__name__}.")
+
+# Factorized counterparts of the L and XL networks. The encoder ones (ALR encoder, ALRR and ELR) have the widths of
+# FFNetwork_L/XL, the decoder ones of FFNetwork_decoder_L/XL and the cross attention ones of FFNetwork_cross_decoder_L/XL.
+# Parameters of the first layer, e.g. FFNetwork_XL: 82M dense, 19.7M low rank, 0.7M kronecker.
+
+class FFNetwork_L_LR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_L_LR, self).__init__([width, width//2, width], "low_rank", [512, 512], False, model_dimension, sentence_length)
+
+class FFNetwork_XL_LR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_XL_LR, self).__init__([width, width*2, width], "low_rank", [1024, 1024], False, model_dimension, sentence_length)
+
+class FFNetwork_L_KR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_L_KR, self).__init__([width, width//2, width], "kronecker", [32, 32], False, model_dimension, sentence_length)
+
+class FFNetwork_XL_KR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_XL_KR, self).__init__([width, width*2, width], "kronecker", [32, 32], False, model_dimension, sentence_length)
+
+class FFNetwork_decoder_L_LR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_decoder_L_LR, self).__init__([width, width//2, model_dimension], "low_rank", [512, 512], True, model_dimension, sentence_length)
+
+class FFNetwork_decoder_XL_LR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_decoder_XL_LR, self).__init__([width, width*2, model_dimension], "low_rank", [1024, 1024], True, model_dimension, sentence_length)
+
+class FFNetwork_decoder_L_KR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_decoder_L_KR, self).__init__([width, width//2, model_dimension], "kronecker", [32, 32], True, model_dimension, sentence_length)
+
+class FFNetwork_decoder_XL_KR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=sentence_length*model_dimension
+        super(FFNetwork_decoder_XL_KR, self).__init__([width, width*2, model_dimension], "kronecker", [32, 32], True, model_dimension, sentence_length)
+
+class FFNetwork_cross_decoder_L_LR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=2*sentence_length*model_dimension
+        super(FFNetwork_cross_decoder_L_LR, self).__init__([width, width//2, width//2], "low_rank", [512, 512], False, model_dimension, sentence_length)
+
+class FFNetwork_cross_decoder_XL_LR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=2*sentence_length*model_dimension
+        super(FFNetwork_cross_decoder_XL_LR, self).__init__([width, width*2, width//2], "low_rank", [1024, 1024], False, model_dimension, sentence_length)
+
+class FFNetwork_cross_decoder_L_KR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=2*sentence_length*model_dimension
+        super(FFNetwork_cross_decoder_L_KR, self).__init__([width, width//2, width//2], "kronecker", [32, 32], False, model_dimension, sentence_length)
+
+class FFNetwork_cross_decoder_XL_KR(FactorizedFFNetwork):
+    def __init__(self, model_dimension=128,sentence_length=MAX_LEN):
+        width=2*sentence_length*model_dimension
+        super(FFNetwork_cross_decoder_XL_KR, self).__init__([width, width*2, width//2], "kronecker", [32, 32], False, model_dimension, sentence_length)
@@ -87,6 +87,45 @@ class Transformer(nn.Module):
 
         return trg_log_probs  # the reason I use log here is that PyTorch's nn.KLDivLoss expects log probabilities
 
+    def fuse_qkv(self):
+        # Packed query/key/value projections in all the (not substituted) multi-headed attentions, see MultiHeadedAttention
+        for module in self.modules():
+            if type(module) == MultiHeadedAttention:
+                module.fuse_qkv()
+        return self
+
+    # Incremental decoding: the decoder can't look ahead, so the activations of the already decoded target tokens don't
+    # change when a new token is appended. Their self-attention keys/values and the cross-attention keys/values of the
+    # source sentence are cached and every step only runs the newest target token through the decoder.
+    def supports_incremental_decoding(self):
+        # Substituted attentions (see utils/full_sentence_utils.py) need the whole target sentence
+        return all(type(decoder_layer) == DecoderLayer
+                   and type(decoder_layer.trg_multi_headed_attention) == MultiHeadedAttention
+                   and type(decoder_layer.src_multi_headed_attention) == MultiHeadedAttention
+                   for decoder_layer in self.decoder.decoder_layers)
+
+    def init_decoder_cache(self, src_representations_batch, max_target_tokens=MAX_LEN):
+        return self.decoder.init_cache(src_representations_batch, max_target_tokens)
+
+    def select_decoder_cache(self, cache, indices):
+        # Keeps (in the given order) only the sentences at the given batch indices, e.g. to drop the finished sentences
+        for layer_cache in cache["layers"]:
+            for name, tensor in layer_cache.items():
+                layer_cache[name] = tensor.index_select(0, indices)
+
+    def decode_step(self, trg_token_ids_batch, cache, trg_mask, src_mask):
+        """
+            Same as the last target position of decode(), the previous target tokens are read from the cache.
+
+            trg_token_ids_batch shape = (B, 1), the newest target token of every sentence
+            trg_mask shape = (B, 1, 1, T), padding mask of the T target tokens decoded so far (the newest one included)
+            Returns log probabilities of shape (B, V)
+        """
+        trg_embeddings_batch = self.trg_embedding(trg_token_ids_batch)
+        trg_embeddings_batch = self.trg_pos_embedding(trg_embeddings_batch, start_position=cache["length"])
+        trg_representations_batch = self.decoder.decode_step(trg_embeddings_batch, cache, trg_mask, src_mask)
+        return self.decoder_generator(trg_representations_batch).squeeze(1)
+
 
 #
 # Encoder architecture
@@ -166,6 +205,16 @@ class Decoder(nn.Module):
         # check out the SublayerLogic module)
         return self.norm(trg_representations_batch)
 
+    def init_cache(self, src_representations_batch, max_target_tokens):
+        return {"length": 0, "layers": [decoder_layer.init_cache(src_representations_batch, max_target_tokens) for decoder_layer in self.decoder_layers]}
+
+    def decode_step(self, trg_embeddings_batch, cache, trg_mask, src_mask):
+        trg_representations_batch = trg_embeddings_batch
+        for decoder_layer, layer_cache in zip(self.decoder_layers, cache["layers"]):
+            trg_representations_batch = decoder_layer.decode_step(trg_representations_batch, layer_cache, cache["length"], trg_mask, src_mask)
+        cache["length"] += 1
+        return self.norm(trg_representations_batch)
+
 
 class DecoderLayer(nn.Module):
 
@@ -195,6 +244,32 @@ class DecoderLayer(nn.Module):
 
         return trg_representations_batch
 
+    def init_cache(self, src_representations_batch, max_target_tokens):
+        # Source keys/values are the same for every decoding step, target keys/values are filled step by step
+        batch_size = src_representations_batch.shape[0]
+        mha = self.trg_multi_headed_attention
+        src_key, src_value = self.src_multi_headed_attention.project_key_value(src_representations_batch, src_representations_batch)
+        trg_key, trg_value = [src_representations_batch.new_zeros((batch_size, mha.number_of_heads, max_target_tokens, mha.head_dimension)) for _ in range(2)]
+        return {"src_key": src_key, "src_value": src_value, "trg_key": trg_key, "trg_value": trg_value}
+
+    def decode_step(self, trg_representations_batch, cache, position, trg_mask, src_mask):
+        """
+            Same as forward for the target token at the given position, shape = (B, 1, D).
+            The keys/values of the previous target tokens are read from the cache and the ones of this token are added.
+        """
+        def decoder_trg_self_attention(trb):
+            key, value = self.trg_multi_headed_attention.project_key_value(trb, trb)
+            cache["trg_key"][:, :, position] = key[:, :, 0]
+            cache["trg_value"][:, :, position] = value[:, :, 0]
+            return self.trg_multi_headed_attention.attend(trb, cache["trg_key"][:, :, :position+1], cache["trg_value"][:, :, :position+1], trg_mask)
+        decoder_src_attention = lambda trb: self.src_multi_headed_attention.attend(trb, cache["src_key"], cache["src_value"], src_mask)
+
+        trg_representations_batch = self.sublayers[0](trg_representations_batch, decoder_trg_self_attention)
+        trg_representations_batch = self.sublayers[1](trg_representations_batch, decoder_src_attention)
+        trg_representations_batch = self.sublayers[2](trg_representations_batch, self.pointwise_net)
+
+        return trg_representations_batch
+
 
 #
 # Helper modules (designed with modularity in mind) and organized top to bottom.
@@ -277,6 +352,11 @@ class MultiHeadedAttention(nn.Module):
         I'm doing it like this - using 3 "feed forward nets" (without activation/identity hence the quotation marks).
         Conceptually both implementations are the same.
 
+        fuse_qkv() switches a trained module to that packed projection (qkv_projection) in place, self attention then
+        projects the queries, keys and values with a single matmul and the attention itself goes through
+        torch.nn.functional.scaled_dot_product_attention (when available and the weights are not logged).
+        Checkpoints of unfused modules can be converted with fuse_qkv_state_dict.
+
         PyTorch's query/key/value are of different shape namely (max token sequence length, batch size, model dimension)
         whereas I'm using (batch size, max token sequence length, model dimension) because it's easier to understand
         and consistent with computer vision apps (batch dimension is always first followed by the number of channels (C)
@@ -304,6 +384,52 @@ class MultiHeadedAttention(nn.Module):
 
         self.log_attention_weights = log_attention_weights  # should we log attention weights
         self.attention_weights = None  # for visualization purposes, I cache the weights here (translation_script.py)
+        self.fused = False  # see fuse_qkv
+
+    def fuse_qkv(self):
+        # Packs the 3 qkv_nets into a single (3 * D, D) projection, the module computes the same function.
+        # Note: the attention substitutes (utils/full_sentence_utils.py) need the unfused qkv_nets.
+        if self.fused:
+            return
+        model_dimension = self.number_of_heads * self.head_dimension
+        qkv_projection = nn.Linear(model_dimension, 3 * model_dimension).to(self.qkv_nets[0].weight)
+        with torch.no_grad():
+            qkv_projection.weight.copy_(torch.cat([net.weight for net in self.qkv_nets]))
+            qkv_projection.bias.copy_(torch.cat([net.bias for net in self.qkv_nets]))
+        del self.qkv_nets
+        self.qkv_projection = qkv_projection
+        self.fused = True
+
+    def project(self, x, i):
+        # i = 0, 1, 2 for the query, key and value projections
+        # Shape goes from (B, S/T, NH*HD) over (B, S/T, NH, HD) to (B, NH, S/T, HD) (NH*HD=D where D is model dimension)
+        if self.fused:
+            model_dimension = self.number_of_heads * self.head_dimension
+            rows = slice(i * model_dimension, (i + 1) * model_dimension)
+            x = nn.functional.linear(x, self.qkv_projection.weight[rows], self.qkv_projection.bias[rows])
+        else:
+            x = self.qkv_nets[i](x)
+        return x.view(x.shape[0], -1, self.number_of_heads, self.head_dimension).transpose(1, 2)
+
+    def project_qkv(self, query, key, value):
+        if self.fused and query is key and key is value:
+            # Self attention: a single matmul, (B, S/T, 3*NH*HD) is split into the heads of the queries, keys and values
+            batch_size = query.shape[0]
+            qkv = self.qkv_projection(query).view(batch_size, -1, 3, self.number_of_heads, self.head_dimension)
+            return qkv.permute(2, 0, 3, 1, 4).unbind(0)
+        return [self.project(x, i) for i, x in enumerate((query, key, value))]
+
+    def attention_core(self, query, key, value, mask):
+        # Same as attention but through the fused kernel of PyTorch, the attention weights are not materialized
+        if self.fused and not self.log_attention_weights and hasattr(nn.functional, 'scaled_dot_product_attention'):
+            dropout_probability = self.attention_dropout.p if self.training else 0.
+            return nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_probability)
+        intermediate_token_representations, attention_weights = self.attention(query, key, value, mask)
+        # Potentially, for visualization purposes, log the attention weights, turn off during training though!
+        # I had memory problems when I leave this on by default
+        if self.log_attention_weights:
+            self.attention_weights = attention_weights
+        return intermediate_token_representations
 
     def attention(self, query, key, value, mask):
         # Step 1: Scaled dot-product attention, Page 4, Chapter 3.2.1 "Scaled Dot-Product Attention"
@@ -337,16 +463,10 @@ class MultiHeadedAttention(nn.Module):
         # Step 1: Input linear projection
         # Notation: B - batch size, NH - number of heads, S/T - max src/trg token-sequence length, HD - head dimension
         # Shape goes from (B, S/T, NH*HD) over (B, S/T, NH, HD) to (B, NH, S/T, HD) (NH*HD=D where D is model dimension)
-        query, key, value = [net(x).view(batch_size, -1, self.number_of_heads, self.head_dimension).transpose(1, 2)
-                             for net, x in zip(self.qkv_nets, (query, key, value))]
+        query, key, value = self.project_qkv(query, key, value)
 
         # Step 2: Apply attention - compare query with key and use that to combine values (see the function for details)
-        intermediate_token_representations, attention_weights = self.attention(query, key, value, mask)
-
-        # Potentially, for visualization purposes, log the attention weights, turn off during training though!
-        # I had memory problems when I leave this on by default
-        if self.log_attention_weights:
-            self.attention_weights = attention_weights
+        intermediate_token_representations = self.attention_core(query, key, value, mask)
 
         # Step 3: Reshape from (B, NH, S/T, HD) over (B, S/T, NH, HD) (via transpose) into (B, S/T, NHxHD) which is
         # the same shape as in the beginning of this forward function i.e. input to MHA (multi-head attention) module
@@ -357,6 +477,18 @@ class MultiHeadedAttention(nn.Module):
 
         return token_representations
 
+    # Used by the incremental decoding (DecoderLayer.decode_step), keys and values are projected once and cached
+    def project_key_value(self, key, value):
+        return [self.project(key, 1), self.project(value, 2)]
+
+    def attend(self, query, key, value, mask):
+        # Same as forward with key and value already projected, shape = (B, NH, S/T, HD)
+        batch_size = query.shape[0]
+        query = self.project(query, 0)
+        intermediate_token_representations = self.attention_core(query, key, value, mask)
+        reshaped = intermediate_token_representations.transpose(1, 2).reshape(batch_size, -1, self.number_of_heads * self.head_dimension)
+        return self.out_projection_net(reshaped)
+
 
 #
 # Input modules
@@ -402,13 +534,14 @@ class PositionalEncoding(nn.Module):
         # these are not trainable (not model's parameters) so they otherwise would be excluded from the state_dict
         self.register_buffer('positional_encodings_table', positional_encodings_table)
 
-    def forward(self, embeddings_batch):
+    def forward(self, embeddings_batch, start_position=0):
         assert embeddings_batch.ndim == 3 and embeddings_batch.shape[-1] == self.positional_encodings_table.shape[1], \
             f'Expected (batch size, max token sequence length, model dimension) got {embeddings_batch.shape}'
 
         # embedding_batch's shape = (B, S/T, D), where S/T max src/trg token-sequence length, D - model dimension
         # So here we get (S/T, D) shape which will get broad-casted to (B, S/T, D) when we try and add it to embeddings
-        positional_encodings = self.positional_encodings_table[:embeddings_batch.shape[1]]
+        # (start_position is used by the incremental decoding where only the newest target token is embedded)
+        positional_encodings = self.positional_encodings_table[start_position:start_position + embeddings_batch.shape[1]]
 
         # (stated in the paper) Applying dropout to the sum of positional encodings and token embeddings
         # Page 7, Chapter 5.4 "Regularization"
@@ -425,6 +558,16 @@ def get_clones(module, num_of_deep_copies):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(num_of_deep_copies)])
 
 
+def fuse_qkv_state_dict(state_dict):
+    # Converts (in place) the qkv_nets.{0,1,2} weights/biases of a checkpoint of unfused multi-headed attentions into
+    # the qkv_projection weight/bias of the fused ones (see MultiHeadedAttention.fuse_qkv)
+    for key in [key for key in state_dict.keys() if key.endswith('qkv_nets.0.weight')]:
+        prefix = key[:-len('qkv_nets.0.weight')]
+        for kind in ('weight', 'bias'):
+            state_dict[f'{prefix}qkv_projection.{kind}'] = torch.cat([state_dict.pop(f'{prefix}qkv_nets.{i}.{kind}') for i in range(3)])
+    return state_dict
+
+
 # Count how many trainable weights the model has <- just for having a feeling for how big the model is
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
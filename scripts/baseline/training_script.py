@@ -26,6 +26,7 @@ from utils.data_utils import get_data_loaders, get_masks_and_count_tokens, get_s
 import utils.utils as utils
 from utils.constants import *
 from utils.full_sentence_utils import substitute_attention
+from utils.precision_utils import PRECISIONS, autocast, report_loss_parity
 
 # Global vars for logging purposes
 num_of_trg_tokens_processed = 0
@@ -53,14 +54,19 @@ def get_train_val_loop(baseline_transformer, custom_lr_optimizer, kl_div_loss, l
             src_token_ids_batch, trg_token_ids_batch_input, trg_token_ids_batch_gt = get_src_and_trg_batches(token_ids_batch)
             src_mask, trg_mask, num_src_tokens, num_trg_tokens = get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch_input, pad_token_id, device)
 
-            # log because the KL loss expects log probabilities (just an implementation detail)
-            predicted_log_distributions = baseline_transformer(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask)
             smooth_target_distributions = label_smoothing(trg_token_ids_batch_gt)  # these are regular probabilities
+            # log because the KL loss expects log probabilities (just an implementation detail)
+            compute_loss = lambda: kl_div_loss(baseline_transformer(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask), smooth_target_distributions)
+
+            if is_train and batch_idx == 0:
+                report_loss_parity(compute_loss, training_config['precision'], device, baseline_transformer, prefix=f'epoch={epoch + 1} | ')
 
             if is_train:
                 custom_lr_optimizer.zero_grad()  # clean the trainable weights gradients in the computational graph
 
-            loss = kl_div_loss(predicted_log_distributions, smooth_target_distributions)
+            # the forward pass and the loss run in the precision of the policy, the backward pass is outside of autocast
+            with autocast(training_config['precision'], device):
+                loss = compute_loss()
 
             if is_train:
                 loss.backward()  # compute the gradients for every trainable weight in the computational graph
@@ -191,7 +197,7 @@ def train_transformer(training_config):
         with torch.no_grad():
             train_val_loop(is_train=False, token_ids_loader=val_token_ids_loader, epoch=epoch)
 
-            bleu_score = utils.calculate_bleu_score(baseline_transformer, val_token_ids_loader, trg_field_processor)
+            bleu_score = utils.calculate_bleu_score(baseline_transformer, val_token_ids_loader, trg_field_processor, precision=training_config['precision'])
 
     # Save the latest transformer in the binaries directory
     model_name = f"Transformer_{training_config['substitute_type']}_{training_config['substitute_class']}_{training_config['num_of_epochs']}.pth"
@@ -227,6 +233,7 @@ if __name__ == "__main__":
     parser.add_argument("--epoch", type = int, help="Epoch checkpoint to use.", default=20)
     parser.add_argument("--substitute_type", type = str, help="Type of the substitute layer.", choices=["ALRR", "ALR", "ALSR", "None"], default="None")
     parser.add_argument("--untrained", type=bool, default = True)
+    parser.add_argument("--precision", choices=PRECISIONS, help="fp32, or bf16 autocast for the forward passes (see utils/precision_utils.py)", default="fp32")
     args = parser.parse_args()
     # Wrapping training configuration into a dictionary
     training_config = dict()
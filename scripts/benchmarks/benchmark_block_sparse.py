@@ -0,0 +1,76 @@
+import argparse
+import copy
+import time
+
+import torch
+
+# Local imports
+from pathlib import Path
+import sys
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+import models.definitions.ALR_FF as FF_models
+from models.definitions.block_sparse_FF import to_block_sparse
+from utils.constants import *
+from utils.full_sentence_utils import AttentionSubstitute
+from utils.pruning_utils import BlockMagnitudePruner
+
+"""
+CPU latency of an encoder ALR substitute (FFNetwork_L by default) run dense and block-sparse through AttentionSubstitute,
+for increasing block sparsities. The network is randomly initialized and pruned by block magnitude in one shot, the
+latency only depends on the number of non zero blocks. The maximum absolute difference between the block-sparse
+outputs and the outputs of the pruned dense network is printed as well.
+
+"""
+
+device = torch.device("cpu")
+
+def make_inputs(batch_size, length):
+    value = torch.randn((batch_size, length, BASELINE_MODEL_DIMENSION))
+    mask = torch.ones((batch_size, 1, 1, length), dtype=torch.bool)
+    return value, value, value, mask
+
+def time_substitute(substitute, inputs, repetitions):
+    with torch.no_grad():
+        substitute(*inputs)  # warm up
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            outputs = substitute(*inputs)
+        return (time.perf_counter() - start) / repetitions, outputs
+
+def benchmark(config):
+    torch.set_num_threads(config["num_threads"])
+    torch.manual_seed(0)
+    ff = getattr(FF_models, config["substitute_class"])()
+    ff.eval()
+    dense = AttentionSubstitute(ff, device = device)
+    inputs = make_inputs(config["batch_size"], config["length"])
+    dense_time, _ = time_substitute(dense, inputs, config["repetitions"])
+
+    print(f"{config['substitute_class']}, batch size {config['batch_size']}, length {config['length']}, blocks {config['block_size']}, {config['num_threads']} threads")
+    print(f"dense: {dense_time*1000:.2f} ms")
+    print(f"{'sparsity':>8} {'block-sparse (ms)':>18} {'speedup':>8} {'max abs diff':>13}")
+    for sparsity in config["sparsities"]:
+        pruned = copy.deepcopy(ff)
+        BlockMagnitudePruner(pruned, sparsity, config["block_size"], start_epoch = 0, end_epoch = 0).update(0)
+        sparse = copy.deepcopy(pruned)
+        to_block_sparse(sparse, config["block_size"], max_density = 1.)
+        _, pruned_outputs = time_substitute(AttentionSubstitute(pruned, device = device), inputs, 1)
+        sparse_time, sparse_outputs = time_substitute(AttentionSubstitute(sparse, device = device), inputs, config["repetitions"])
+        diff = (pruned_outputs - sparse_outputs).abs().max().item()
+        print(f"{sparsity:>8.2f} {sparse_time*1000:>18.2f} {dense_time/sparse_time:>8.2f} {diff:>13.2e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--substitute_class", type=str, help="name of the encoder FF defined in models/definitions/ALR_FF.py", default="FFNetwork_L")
+    parser.add_argument("--batch_size", type=int, help="number of sentences in a batch", default=32)
+    parser.add_argument("--length", type=int, help="sentence length", default=MAX_LEN)
+    parser.add_argument("--block_size", type=int, nargs=2, help="out x in size of the pruned blocks", default=[32, 32])
+    parser.add_argument("--sparsities", type=float, nargs="+", help="fractions of zero blocks to time", default=[0.5, 0.75, 0.9, 0.95])
+    parser.add_argument("--repetitions", type=int, help="number of timed forward passes per sparsity", default=10)
+    parser.add_argument("--num_threads", type=int, help="number of CPU threads used by torch", default=torch.get_num_threads())
+    args = parser.parse_args()
+    benchmark_config = dict()
+    for arg in vars(args):
+        benchmark_config[arg] = getattr(args, arg)
+    benchmark(benchmark_config)
@@ -0,0 +1,90 @@
+import argparse
+import copy
+import time
+
+import torch
+
+# Local imports
+from pathlib import Path
+import sys
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+from models.definitions.transformer_model import MultiHeadedAttention, fuse_qkv_state_dict
+from utils.constants import *
+
+"""
+Checks that the fused MultiHeadedAttention (packed q/k/v projection + scaled_dot_product_attention) matches the
+original module and compares their CPU throughput. The check covers the 3 contexts the attention is used in: encoder
+self attention with padding, decoder self attention with the no-look-forward mask and the source attending attention
+of the decoder, as well as loading an unfused state dict converted with fuse_qkv_state_dict.
+Randomly initialized weights are used, the latency does not depend on them.
+
+"""
+
+device = torch.device("cpu")
+
+def make_inputs(batch_size, length, context):
+    # the sentences have random lengths in [1, length], as in a bucket
+    lengths = torch.randint(1, length + 1, (batch_size,))
+    lengths[0] = length
+    padding_mask = torch.arange(length)[None, :] < lengths[:, None]
+    trg = torch.randn((batch_size, length, BASELINE_MODEL_DIMENSION))
+    if context == "encoder":
+        return trg, trg, trg, padding_mask.view(batch_size, 1, 1, length)
+    if context == "decoder":
+        no_look_forward_mask = torch.tril(torch.ones((length, length), dtype=torch.bool))
+        return trg, trg, trg, padding_mask.view(batch_size, 1, 1, length) & no_look_forward_mask
+    src = torch.randn((batch_size, length, BASELINE_MODEL_DIMENSION))
+    return trg, src, src, padding_mask.view(batch_size, 1, 1, length)
+
+def time_module(module, inputs, repetitions):
+    with torch.no_grad():
+        module(*inputs)  # warm up
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            module(*inputs)
+        return (time.perf_counter() - start) / repetitions
+
+def check(mha, fused, inputs, tolerance):
+    with torch.no_grad():
+        diff = (mha(*inputs) - fused(*inputs)).abs().max().item()
+    if diff > tolerance:
+        raise ValueError(f"ERROR: the fused attention differs from the original one by {diff}.")
+    return diff
+
+def benchmark(config):
+    torch.set_num_threads(config["num_threads"])
+    torch.manual_seed(0)
+    mha = MultiHeadedAttention(BASELINE_MODEL_DIMENSION, BASELINE_MODEL_NUMBER_OF_HEADS, dropout_probability=0., log_attention_weights=False).to(device)
+    mha.eval()
+    fused = copy.deepcopy(mha)
+    fused.fuse_qkv()
+    # same weights loaded from the converted state dict of the unfused module
+    loaded = MultiHeadedAttention(BASELINE_MODEL_DIMENSION, BASELINE_MODEL_NUMBER_OF_HEADS, dropout_probability=0., log_attention_weights=False).to(device)
+    loaded.fuse_qkv()
+    loaded.load_state_dict(fuse_qkv_state_dict(copy.deepcopy(mha.state_dict())), strict=True)
+    loaded.eval()
+    print(f"scaled_dot_product_attention available: {hasattr(torch.nn.functional, 'scaled_dot_product_attention')}")
+
+    print(f"batch size {config['batch_size']}, {config['num_threads']} threads")
+    print(f"{'context':>10} {'length':>8} {'original (ms)':>14} {'fused (ms)':>11} {'speedup':>8} {'max abs diff':>13}")
+    for context in ["encoder", "decoder", "decoder_ca"]:
+        for length in config["lengths"]:
+            inputs = make_inputs(config["batch_size"], length, context)
+            diff = max(check(mha, fused, inputs, config["tolerance"]), check(mha, loaded, inputs, config["tolerance"]))
+            original_time = time_module(mha, inputs, config["repetitions"])
+            fused_time = time_module(fused, inputs, config["repetitions"])
+            print(f"{context:>10} {length:>8} {original_time*1000:>14.3f} {fused_time*1000:>11.3f} {original_time/fused_time:>8.2f} {diff:>13.2e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, help="number of sentences in a batch", default=64)
+    parser.add_argument("--lengths", type=int, nargs="+", help="sentence lengths to time", default=[10, 25, MAX_LEN])
+    parser.add_argument("--repetitions", type=int, help="number of timed forward passes per length", default=50)
+    parser.add_argument("--tolerance", type=float, help="maximum absolute difference allowed between the outputs", default=1e-5)
+    parser.add_argument("--num_threads", type=int, help="number of CPU threads used by torch", default=torch.get_num_threads())
+    args = parser.parse_args()
+    benchmark_config = dict()
+    for arg in vars(args):
+        benchmark_config[arg] = getattr(args, arg)
+    benchmark(benchmark_config)
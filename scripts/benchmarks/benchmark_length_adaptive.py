@@ -0,0 +1,71 @@
+import argparse
+import time
+
+import torch
+
+# Local imports
+from pathlib import Path
+import sys
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+import models.definitions.ALR_FF as FF_models
+from models.definitions.ALR_FF import LengthAdaptiveFF
+from utils.constants import *
+from utils.full_sentence_utils import AttentionSubstitute, AttentionSubstituteDecoder, AttentionSubstituteDecoderCA
+
+"""
+CPU latency of the ALR substitutes with the fixed MAX_LEN padding and with LengthAdaptiveFF, for batches of sentences
+of increasing length. Randomly initialized networks are used, the latency does not depend on the weights. The maximum
+absolute difference between the outputs of the two paths is printed as well.
+
+"""
+
+device = torch.device("cpu")
+
+def make_inputs(batch_size, length, att_replacement):
+    # every sentence of the batch has the same length, as in the worst case of a bucket
+    value = torch.randn((batch_size, length, BASELINE_MODEL_DIMENSION))
+    if att_replacement == "decoder":
+        mask = torch.tril(torch.ones((1, 1, length, length), dtype=torch.bool)).repeat(batch_size, 1, 1, 1)
+    else:
+        mask = torch.ones((batch_size, 1, 1, length), dtype=torch.bool)
+    return value, value, value, mask
+
+def time_substitute(substitute, inputs, repetitions):
+    with torch.no_grad():
+        substitute(*inputs)  # warm up
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            outputs = substitute(*inputs)
+        return (time.perf_counter() - start) / repetitions, outputs
+
+def benchmark(config):
+    torch.set_num_threads(config["num_threads"])
+    adapter = {"encoder": AttentionSubstitute, "decoder": AttentionSubstituteDecoder, "decoder_ca": AttentionSubstituteDecoderCA}[config["att_replacement"]]
+    ff = getattr(FF_models, config["substitute_class"])()
+    ff.eval()
+    fixed = adapter(ff, device = device)
+    adaptive = adapter(LengthAdaptiveFF(ff, num_segments = 2 if config["att_replacement"] == "decoder_ca" else 1), device = device)
+
+    print(f"{config['substitute_class']} ({config['att_replacement']}), batch size {config['batch_size']}, {config['num_threads']} threads")
+    print(f"{'length':>8} {'fixed (ms)':>12} {'adaptive (ms)':>14} {'speedup':>8} {'max abs diff':>13}")
+    for length in config["lengths"]:
+        inputs = make_inputs(config["batch_size"], length, config["att_replacement"])
+        fixed_time, fixed_outputs = time_substitute(fixed, inputs, config["repetitions"])
+        adaptive_time, adaptive_outputs = time_substitute(adaptive, inputs, config["repetitions"])
+        diff = (fixed_outputs - adaptive_outputs).abs().max().item()
+        print(f"{length:>8} {fixed_time*1000:>12.2f} {adaptive_time*1000:>14.2f} {fixed_time/adaptive_time:>8.2f} {diff:>13.2e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--substitute_class", type=str, help="name of the FF defined in models/definitions/ALR_FF.py", default="FFNetwork_L")
+    parser.add_argument("--att_replacement", help="Which attention is replaced", choices=["encoder", "decoder", "decoder_ca"], default="encoder")
+    parser.add_argument("--batch_size", type=int, help="number of sentences in a batch", default=32)
+    parser.add_argument("--lengths", type=int, nargs="+", help="sentence lengths to time", default=[8, 16, 24, 32, 40, MAX_LEN])
+    parser.add_argument("--repetitions", type=int, help="number of timed forward passes per length", default=10)
+    parser.add_argument("--num_threads", type=int, help="number of CPU threads used by torch", default=torch.get_num_threads())
+    args = parser.parse_args()
+    benchmark_config = dict()
+    for arg in vars(args):
+        benchmark_config[arg] = getattr(args, arg)
+    benchmark(benchmark_config)
@@ -1,9 +1,11 @@
 import argparse
 import os
+import shutil
 
 import numpy as np
 
 import torch
+import torch.multiprocessing as mp
 
 # Local imports
 from pathlib import Path
@@ -15,16 +17,37 @@ from models.definitions.transformer_model import Transformer
 from utils.data_utils import get_data_loaders, get_masks_and_count_tokens_src, get_src_and_trg_batches, DatasetType, LanguageDirection
 from utils.constants import *
 from utils.simulator import restructure_encoder_layers
+from utils.activation_store import ActivationStoreWriter, is_complete_store
+from utils.async_writer import AsyncHostWriter, ThroughputMeter
+
+"""
+The inputs and outputs of every encoder layer (ELR), of its attention (ALR) and of its attention sublayer including
+the residual connection (ALRR) are written to one activation store per split, <LAYER_OUTPUT_PATH>/<prefix>_<split>.store,
+with the fields {ELR,ALR,ALRR}_layer{i}_{inputs,outputs} and ELR_layernorm_{inputs,outputs} for the final norm.
+Only the non-padded tokens of every sentence are stored, the source lengths are kept as src_lengths metadata.
+The stores are committed after every batch and an interrupted extraction is resumed from the last committed batch,
+see extract_mha.py.
+
+"""
+def get_store_path(output_path, prefix, suffix):
+    return os.path.join(output_path, f"{prefix}_{suffix}.store")
 
 def extract_input_output(training_config):
     prefix = f"{training_config['model_name']}_{training_config['dataset_name']}_{training_config['language_direction']}"
-    # avoid appending to previously generated files
-    for f in os.listdir(LAYER_OUTPUT_PATH):
-        full_name = f"{LAYER_OUTPUT_PATH}/{f}"
-        if os.path.isfile(full_name) and f.startswith(prefix):
-            os.remove(full_name)
+    # avoid appending to previously generated files, by default the stores of an interrupted run are resumed instead
+    if training_config['overwrite']:
+        for f in os.listdir(LAYER_OUTPUT_PATH):
+            full_name = f"{LAYER_OUTPUT_PATH}/{f}"
+            if f.startswith(prefix):
+                if os.path.isfile(full_name):
+                    os.remove(full_name)
+                else:
+                    shutil.rmtree(full_name)
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
+    if training_config['parallel_splits']:
+        # the worker processes are forked and share the weights of the model, this only works on CPU
+        device = torch.device("cpu")
 
     train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
         training_config['dataset_path'],
@@ -45,62 +68,98 @@ def extract_input_output(training_config):
         number_of_layers=BASELINE_MODEL_NUMBER_OF_LAYERS,
         dropout_probability=BASELINE_MODEL_DROPOUT_PROB
     ).to(device)
-    checkpoint = torch.load(training_config["path_to_weights"])
+    checkpoint = torch.load(training_config["path_to_weights"], map_location=device)
     transformer.load_state_dict(checkpoint['state_dict'])
     restructure_encoder_layers(transformer)
 
     transformer.eval()
 
+    # the batch order has to be the same in every run so that an interrupted extraction can be resumed
     train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
         training_config['dataset_path'],
         training_config['language_direction'],
         training_config['dataset_name'],
         training_config['batch_size'],
         device,
-        max_len_train=MAX_LEN)
+        max_len_train=MAX_LEN,
+        seed=training_config['seed'])
     
-    def getf(i, extra_pref, suffix):
+    # lengths of the source sentences of the current batch, set before every forward pass and read by the hooks
+    batch_lengths = {}
+
+    def getf(i, extra_pref, writer, async_writer):
         def write_input_output(model, input, output):
             # input is a tuple with the embeddings in first place
-            inp = input[0].cpu().detach().numpy()
-            out = output.cpu().detach().numpy()
-            in_filename = f"{LAYER_OUTPUT_PATH}/{prefix}_{extra_pref}_layer{i}_inputs_{suffix}"
-            out_filename = f"{LAYER_OUTPUT_PATH}/{prefix}_{extra_pref}_layer{i}_outputs_{suffix}"
-            # ad-hoc appending to the same file
-            with open(in_filename, 'ab') as f:
-                np.save(f, inp)
-            with open(out_filename, 'ab') as f:
-                np.save(f, out)
+            # the tensors are copied to the host and written by the background thread, the forward pass does not wait
+            # padded tokens are dropped, every record holds the rows of the valid tokens only
+            async_writer.submit(writer.append, f"{extra_pref}_layer{i}_inputs", input[0], rows=batch_lengths["src"])
+            async_writer.submit(writer.append, f"{extra_pref}_layer{i}_outputs", output, rows=batch_lengths["src"])
         return write_input_output
 
     def extract(token_ids_loader, suffix):
+        store_path = get_store_path(LAYER_OUTPUT_PATH, prefix, suffix)
+        if is_complete_store(store_path):
+            print(f"Skipping {suffix}, already extracted")
+            return
         print(f"Extracting {suffix}")
+        if training_config['parallel_splits']:
+            # one process per split, share the cores between them
+            torch.set_num_threads(max(1, torch.get_num_threads() // 3))
+        writer = ActivationStoreWriter(store_path, resume=True)
+        if writer.committed_batches > 0:
+            print(f"Resuming {suffix} from batch {writer.committed_batches}")
+        async_writer = AsyncHostWriter(max_pending=training_config['max_pending_writes'])
+        throughput = ThroughputMeter()
         hook_handles = []
         for (i, l) in enumerate(transformer.encoder.encoder_layers):
-            h_ELR = l.register_forward_hook(getf(i, "ELR", suffix))
-            h_ALR = l.sublayer_zero.layer.register_forward_hook(getf(i, "ALR", suffix))
-            h_ALRR = l.sublayer_zero.register_forward_hook(getf(i, "ALRR", suffix))
+            h_ELR = l.register_forward_hook(getf(i, "ELR", writer, async_writer))
+            h_ALR = l.sublayer_zero.layer.register_forward_hook(getf(i, "ALR", writer, async_writer))
+            h_ALRR = l.sublayer_zero.register_forward_hook(getf(i, "ALRR", writer, async_writer))
             hook_handles.append(h_ELR)
             hook_handles.append(h_ALR)
             hook_handles.append(h_ALRR)
-        hook_handles.append(transformer.encoder.norm.register_forward_hook(getf("norm", "ELR", suffix)))
-        mask_filename = f"{LAYER_OUTPUT_PATH}/{prefix}_masks_{suffix}"
+        hook_handles.append(transformer.encoder.norm.register_forward_hook(getf("norm", "ELR", writer, async_writer)))
 
         for batch_idx, token_ids_batch in enumerate(token_ids_loader):
+            if batch_idx < writer.committed_batches:
+                continue
             if (batch_idx % training_config['console_log_freq'] == 0):
-                print(f"Current batch in {suffix}: {batch_idx}")
+                print(f"Current batch in {suffix}: {batch_idx}, {throughput}")
             src_token_ids_batch, _, _ = get_src_and_trg_batches(token_ids_batch)
             src_mask, num_src_tokens = get_masks_and_count_tokens_src(src_token_ids_batch, pad_token_id)
-            with open(mask_filename, 'ab') as f:
-                np.save(f, src_mask.cpu().detach().numpy())
+            # the mask is fully described by the number of non-padded tokens of every sentence
+            src_lengths = (src_token_ids_batch != pad_token_id).sum(dim=1)
+            async_writer.submit(writer.append_metadata, "src_lengths", src_lengths)
+            batch_lengths["src"] = src_lengths
             transformer.encode(src_token_ids_batch, src_mask)
+            # record the progress once all the writes of the batch are done
+            async_writer.submit(writer.commit, batch_idx + 1)
+            throughput.update(src_token_ids_batch.shape[0])
 
         for h in hook_handles:
             h.remove()
-    
-    extract(train_token_ids_loader, "train")
-    extract(val_token_ids_loader, "val")
-    extract(test_token_ids_loader, "test")
+        # wait for the pending writes before closing the store
+        async_writer.close()
+        print(f"Extracted {suffix}: {throughput}, forward pass blocked on the writer for {async_writer.wait_time:.1f}s")
+        writer.close()
+
+    splits = [(train_token_ids_loader, "train"), (val_token_ids_loader, "val"), (test_token_ids_loader, "test")]
+    if not training_config['parallel_splits']:
+        for token_ids_loader, suffix in splits:
+            extract(token_ids_loader, suffix)
+        return
+
+    # fork a worker per split, the weights are in shared memory so the model is not copied
+    transformer.share_memory()
+    context = mp.get_context("fork")
+    workers = [context.Process(target=extract, args=split, name=f"extract_{split[1]}") for split in splits]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Extraction failed in {failed}, restart the script to resume from the last committed batches.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -115,6 +174,10 @@ if __name__ == "__main__":
     parser.add_argument("--console_log_freq", type=int, help="log to output console (batch) freq", default=10)
     parser.add_argument("--model_name", type=str, help="name of the model", default = "128emb_20ep")
     parser.add_argument("--path_to_weights", type=str, help="path to the weights of the trained transformer", required=True)
+    parser.add_argument("--seed", type = int, help = "seed of the batch order, has to be the same to resume an extraction", default = 0)
+    parser.add_argument("--overwrite", action = "store_true", help = "delete previously extracted stores instead of resuming them")
+    parser.add_argument("--parallel_splits", action = "store_true", help = "extract train, val and test concurrently in 3 processes on CPU")
+    parser.add_argument("--max_pending_writes", type = int, help = "maximum number of tensors waiting to be written to disk by the background writer", default = 64)
     args = parser.parse_args()
 
     # Wrapping training configuration into a dictionary
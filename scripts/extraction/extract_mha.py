@@ -1,8 +1,10 @@
 import argparse
 import os
+import shutil
 
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 
 # Handle imports from utils
 from pathlib import Path
@@ -14,6 +16,8 @@ from models.definitions.transformer_model import Transformer
 from utils.data_utils import get_data_loaders, get_masks_and_count_tokens, get_src_and_trg_batches, DatasetType, LanguageDirection
 from utils.constants import *
 from utils.full_sentence_utils import mha_to_mha2
+from utils.activation_store import ActivationStoreWriter, is_complete_store
+from utils.async_writer import AsyncHostWriter, ThroughputMeter
 
 """
 B = batch size
@@ -22,8 +26,24 @@ MD = model dimension
 NH = number of heads 
 Extracted input shape:  B x S x MD  
 Extracted ouptut shape: B x NH x S x (MD/NH)
+
+The values are written to one activation store (see utils/activation_store.py) per attention type and split,
+e.g. <output_path>/encoder/<prefix>_train.store, with the fields layer{i}_{q,k,v}_inputs and layer{i}_outputs.
+The lengths of the source/target sentences replace the masks and are stored as src_lengths/trg_lengths metadata.
+Inputs which are the same tensor (q = k = v in self-attention, k = v in cross attention) are written once and the
+other fields are recorded as aliases in the store, unless --no_dedup_inputs is given.
+Only the non-padded tokens of every sentence are written (src tokens for the encoder and the keys/values of the cross
+attention, trg tokens for the rest), so record j of a field has exactly as many rows as sentence j has tokens.
+
+The stores are committed after every batch. A restarted job skips the splits which are complete and resumes the others
+from their last committed batch (the batch order is made reproducible with --seed), unless --overwrite is given.
+With --parallel_splits the three splits are extracted on CPU by concurrent processes sharing the weights of one model.
     
 """
+def get_store_path(output_path, prefix, suffix):
+    return os.path.join(output_path, f"{prefix}_{suffix}.store")
+
+
 def extract_input_output(training_config):
     output_path_encoder = os.path.join(training_config["output_path"], "encoder")
     output_path_decoder_self = os.path.join(training_config["output_path"], "decoder_self")
@@ -34,21 +54,21 @@ def extract_input_output(training_config):
     os.makedirs(output_path_decoder_cross, exist_ok=True)
     
     prefix = f"{training_config['model_name']}_{training_config['dataset_name']}_{training_config['language_direction']}"
-    # avoid appending to previously generated files
-    for f in os.listdir(output_path_encoder):
-        full_name = f"{output_path_encoder}/{f}"
-        if os.path.isfile(full_name) and f.startswith(prefix):
-            os.remove(full_name)
-    for f in os.listdir(output_path_decoder_self):
-        full_name = f"{output_path_decoder_self}/{f}"
-        if os.path.isfile(full_name) and f.startswith(prefix):
-            os.remove(full_name)
-    for f in os.listdir(output_path_decoder_cross):
-        full_name = f"{output_path_decoder_cross}/{f}"
-        if os.path.isfile(full_name) and f.startswith(prefix):
-            os.remove(full_name)
+    # avoid appending to previously generated files, by default the stores of an interrupted run are resumed instead
+    if training_config['overwrite']:
+        for output_path in [output_path_encoder, output_path_decoder_self, output_path_decoder_cross]:
+            for f in os.listdir(output_path):
+                full_name = f"{output_path}/{f}"
+                if f.startswith(prefix):
+                    if os.path.isfile(full_name):
+                        os.remove(full_name)
+                    else:
+                        shutil.rmtree(full_name)
             
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
+    if training_config['parallel_splits']:
+        # the worker processes are forked and share the weights of the model, this only works on CPU
+        device = torch.device("cpu")
     train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
         training_config['dataset_path'],
         training_config['language_direction'],
@@ -68,16 +88,18 @@ def extract_input_output(training_config):
         number_of_layers=BASELINE_MODEL_NUMBER_OF_LAYERS,
         dropout_probability=BASELINE_MODEL_DROPOUT_PROB
     ).to(device)
-    checkpoint = torch.load(training_config["path_to_weights"])
+    checkpoint = torch.load(training_config["path_to_weights"], map_location=device)
     transformer.load_state_dict(checkpoint['state_dict'])
     
+    # the batch order has to be the same in every run so that an interrupted extraction can be resumed
     train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
         training_config['dataset_path'],
         training_config['language_direction'],
         training_config['dataset_name'],
         training_config['batch_size'],
         device,
-        max_len_train=MAX_LEN)
+        max_len_train=MAX_LEN,
+        seed=training_config['seed'])
     
     mha_to_mha2(transformer, attention_type = "encoder")
     mha_to_mha2(transformer, attention_type = "decoder")
@@ -85,82 +107,135 @@ def extract_input_output(training_config):
     
     transformer.eval()
 
-    def getf(i, suffix, output_path):
+    # lengths of the sentences of the current batch, set before every forward pass and read by the hooks
+    batch_lengths = {}
+    # inputs already written in the current batch per store: (tensor, lengths, field name), used to detect aliases
+    batch_inputs = {}
+    # index of the current batch and number of batches every store has committed in a previous run
+    batch_state = {"batch": 0, "committed": {}}
+
+    def submit(async_writer, writer, fn, *args, **kwargs):
+        # A run killed between the commits of the stores leaves some of them one batch ahead, don't write it twice
+        if batch_state["batch"] >= batch_state["committed"][id(writer)]:
+            async_writer.submit(fn, *args, **kwargs)
+
+    def write_input(writer, async_writer, name, tensor, lengths):
+        if training_config['dedup_inputs']:
+            for (other, other_lengths, other_name) in batch_inputs.setdefault(id(writer), []):
+                if other is tensor and other_lengths == lengths:
+                    submit(async_writer, writer, writer.add_alias, name, other_name)
+                    return
+            batch_inputs[id(writer)].append((tensor, lengths, name))
+        submit(async_writer, writer, writer.append, name, tensor, rows=batch_lengths[lengths])
+
+    def getf(i, writer, async_writer, q_lengths, kv_lengths):
         def write_input_output(model, input, output):
             # input is a tuple  (queries, keys, values, mask)
             # mask is ignored, queries, keys and values are stored separately
-            # In self-attention queries = keys = values 
-            q = input[0].cpu().detach().numpy()
-            k = input[1].cpu().detach().numpy() 
-            v = input[2].cpu().detach().numpy() 
-            out = output.cpu().detach().numpy()
-            in_filename_q = f"{output_path}/{prefix}_layer{i}_q_inputs_{suffix}"
-            in_filename_k = f"{output_path}/{prefix}_layer{i}_k_inputs_{suffix}"
-            in_filename_v = f"{output_path}/{prefix}_layer{i}_v_inputs_{suffix}"
-            out_filename = f"{output_path}/{prefix}_layer{i}_outputs_{suffix}"
-
-            # ad-hoc appending to the same file
-            with open(in_filename_q, 'ab') as f:
-                np.save(f, q)
-            with open(in_filename_k, 'ab') as f:
-                np.save(f, k)
-            with open(in_filename_v, 'ab') as f:
-                np.save(f, v)
-            with open(out_filename, 'ab') as f:
-                np.save(f, out)
+            # In self-attention queries = keys = values and in cross attention keys = values = output of the encoder
+            # (the same tensor for every layer), aliased inputs are written once and recorded as aliases of the first one
+            # The tensors are copied to the host and written by the background thread, the forward pass does not wait
+            q, k, v = input[0], input[1], input[2]
+
+            # padded tokens are dropped, queries/outputs have one row per query token and keys/values one per key token
+            # values go first so that they are always stored as a real field, the training scripts read v_inputs
+            write_input(writer, async_writer, f"layer{i}_v_inputs", v, kv_lengths)
+            write_input(writer, async_writer, f"layer{i}_k_inputs", k, kv_lengths)
+            write_input(writer, async_writer, f"layer{i}_q_inputs", q, q_lengths)
+            # B x NH x S x HD is stored token-major i.e. every record has shape S x NH x HD
+            submit(async_writer, writer, writer.append, f"layer{i}_outputs", output, rows=batch_lengths[q_lengths], token_axis=2)
         return write_input_output
 
     def extract(token_ids_loader, suffix):
+        store_paths = [get_store_path(output_path, prefix, suffix) for output_path in [output_path_encoder, output_path_decoder_self, output_path_decoder_cross]]
+        if all(is_complete_store(path) for path in store_paths):
+            print(f"Skipping {suffix}, already extracted")
+            return
         print(f"Extracting {suffix}")
+        if training_config['parallel_splits']:
+            # one process per split, share the cores between them
+            torch.set_num_threads(max(1, torch.get_num_threads() // 3))
+        store_dtype = np.dtype(training_config['store_dtype'])
+        writer_enc, writer_dec_self, writer_dec_cross = [ActivationStoreWriter(path, dtype=store_dtype, resume=True) for path in store_paths]
+        writers = [writer_enc, writer_dec_self, writer_dec_cross]
+        batch_state["committed"] = {id(writer): writer.committed_batches for writer in writers}
+        first_batch = min(writer.committed_batches for writer in writers)
+        if first_batch > 0:
+            print(f"Resuming {suffix} from batch {first_batch}")
+        async_writer = AsyncHostWriter(max_pending=training_config['max_pending_writes'])
+        throughput = ThroughputMeter()
+
         hook_handles = []
         # Register hooks on encoder self attention
         for (i, l) in enumerate(transformer.encoder.encoder_layers):
-            h = l.multi_headed_attention.attention.register_forward_hook(getf(i, suffix, output_path_encoder))
+            h = l.multi_headed_attention.attention.register_forward_hook(getf(i, writer_enc, async_writer, "src", "src"))
             hook_handles.append(h)
-        mask_filename_enc = f"{output_path_encoder}/{prefix}_masks_{suffix}"
         
         # register hooks on decoder self attention
         for (i, l) in enumerate(transformer.decoder.decoder_layers):
-            h = l.trg_multi_headed_attention.attention.register_forward_hook(getf(i, suffix, output_path_decoder_self))
+            h = l.trg_multi_headed_attention.attention.register_forward_hook(getf(i, writer_dec_self, async_writer, "trg", "trg"))
             hook_handles.append(h)
-        mask_filename_dec_self = f"{output_path_decoder_self}/{prefix}_masks_{suffix}"
         
         # register hooks on decoder cross attention
         for (i, l) in enumerate(transformer.decoder.decoder_layers):
-            h = l.src_multi_headed_attention.attention.register_forward_hook(getf(i, suffix, output_path_decoder_cross))
+            h = l.src_multi_headed_attention.attention.register_forward_hook(getf(i, writer_dec_cross, async_writer, "trg", "src"))
             hook_handles.append(h)
-        mask_filename_dec_cross = f"{output_path_decoder_cross}/{prefix}_masks_{suffix}"
-        mask_filename_dec_cross_src = f"{output_path_decoder_cross}/{prefix}_masks_{suffix}_src"
         
         
         for batch_idx, token_ids_batch in enumerate(token_ids_loader):
+            if batch_idx < first_batch:
+                continue
+            batch_state["batch"] = batch_idx
             if (batch_idx % training_config['console_log_freq'] == 0):
-                print(f"Current batch in {suffix}: {batch_idx}")
+                print(f"Current batch in {suffix}: {batch_idx}, {throughput}")
                 
             src_token_ids_batch, trg_token_ids_batch_input, _ = get_src_and_trg_batches(token_ids_batch)
             src_mask, trg_mask, num_src_tokens, num_trg_tokens = get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch_input, pad_token_id, device)
-            
 
-            with open(mask_filename_enc, 'ab') as f:
-                np.save(f, src_mask.cpu().detach().numpy())
-                
-            with open(mask_filename_dec_self, 'ab') as f:
-                np.save(f, trg_mask.cpu().detach().numpy())
-            
-            with open(mask_filename_dec_cross, 'ab') as f:
-                np.save(f, trg_mask.cpu().detach().numpy())
-            
-            with open(mask_filename_dec_cross_src, 'ab') as f:
-                np.save(f, src_mask.cpu().detach().numpy())
+            # The masks are fully described by the number of non-padded tokens of every sentence
+            # the lengths stay on the device, they are copied to the host together with the activations
+            src_lengths = (src_token_ids_batch != pad_token_id).sum(dim=1)
+            trg_lengths = (trg_token_ids_batch_input != pad_token_id).sum(dim=1)
+            submit(async_writer, writer_enc, writer_enc.append_metadata, "src_lengths", src_lengths)
+            submit(async_writer, writer_dec_self, writer_dec_self.append_metadata, "trg_lengths", trg_lengths)
+            submit(async_writer, writer_dec_cross, writer_dec_cross.append_metadata, "src_lengths", src_lengths)
+            submit(async_writer, writer_dec_cross, writer_dec_cross.append_metadata, "trg_lengths", trg_lengths)
+            batch_lengths["src"] = src_lengths
+            batch_lengths["trg"] = trg_lengths
+            batch_inputs.clear()
             
             transformer.forward(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask)
+            batch_inputs.clear()
+            # record the progress once all the writes of the batch are done
+            for writer in writers:
+                submit(async_writer, writer, writer.commit, batch_idx + 1)
+            throughput.update(src_token_ids_batch.shape[0])
 
         for h in hook_handles:
             h.remove()
-            
-    extract(val_token_ids_loader, "val")
-    extract(train_token_ids_loader, "train")
-    extract(test_token_ids_loader, "test")
+        # wait for the pending writes before closing the stores
+        async_writer.close()
+        print(f"Extracted {suffix}: {throughput}, forward pass blocked on the writer for {async_writer.wait_time:.1f}s")
+        for writer in writers:
+            writer.close()
+
+    splits = [(val_token_ids_loader, "val"), (train_token_ids_loader, "train"), (test_token_ids_loader, "test")]
+    if not training_config['parallel_splits']:
+        for token_ids_loader, suffix in splits:
+            extract(token_ids_loader, suffix)
+        return
+
+    # fork a worker per split, the weights are in shared memory so the model is not copied
+    transformer.share_memory()
+    context = mp.get_context("fork")
+    workers = [context.Process(target=extract, args=split, name=f"extract_{split[1]}") for split in splits]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Extraction failed in {failed}, restart the script to resume from the last committed batches.")
 
 if __name__ == "__main__":
     #
@@ -181,6 +256,12 @@ if __name__ == "__main__":
     parser.add_argument("--model_name", type=str, help="name of the model", default = ' 128emb_20ep')
     parser.add_argument("--path_to_weights", type=str, help="path to the weights to load", required=True)
     parser.add_argument("--output_path", type = str, help = "path where the extracted values should be saved", default = MHA_OUTPUT_PATH)
+    parser.add_argument("--store_dtype", choices = ["float32", "float16"], help = "precision of the stored activations", default = "float32")
+    parser.add_argument("--no_dedup_inputs", dest = "dedup_inputs", action = "store_false", help = "write aliased queries/keys/values separately instead of recording them as aliases")
+    parser.add_argument("--seed", type = int, help = "seed of the batch order, has to be the same to resume an extraction", default = 0)
+    parser.add_argument("--overwrite", action = "store_true", help = "delete previously extracted stores instead of resuming them")
+    parser.add_argument("--parallel_splits", action = "store_true", help = "extract train, val and test concurrently in 3 processes on CPU")
+    parser.add_argument("--max_pending_writes", type = int, help = "maximum number of tensors waiting to be written to disk by the background writer", default = 64)
     args = parser.parse_args()
 
     # Wrapping training configuration into a dictionary
@@ -0,0 +1,66 @@
+import argparse
+import os
+
+import torch
+
+# Local imports
+from pathlib import Path
+import sys
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+import models.definitions.ALR_FF as ALR_models
+import models.definitions.ALRR_FF as ALRR_models
+import models.definitions.ELR_FF as ELR_models
+import models.definitions.low_rank_FF as low_rank_models
+from utils.constants import *
+
+"""
+Initializes factorized substitutes (models/definitions/low_rank_FF.py) from trained dense checkpoints by truncated SVD.
+For every layer the dense checkpoint <substitute_model_path>/layer{l}/ff_network_{epoch}_layer_{l}.pth is loaded, its
+Linears are factorized and the result is saved with the same format under
+CHECKPOINTS_SCRATCH/<substitute_type>/<factorized_class>, where validation_script.py looks for it, e.g.
+python3 ./scripts/full_sentence/factorize_substitutes.py --substitute_type ALR --substitute_class FFNetwork_XL --factorized_class FFNetwork_XL_LR
+python3 ./scripts/full_sentence/validation_script.py --substitute_type ALR --substitute_class FFNetwork_XL_LR
+
+"""
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+def factorize(config):
+    m = {"ALR": ALR_models, "ALRR": ALRR_models, "ELR": ELR_models}[config["substitute_type"]]
+    FF_net = getattr(m, config["substitute_class"])
+    factorized_FF_net = getattr(low_rank_models, config["factorized_class"])
+    substitute_model_path = config["substitute_model_path"]
+    if substitute_model_path is None:
+        substitute_model_path = os.path.join(CHECKPOINTS_SCRATCH, config["substitute_type"], config["substitute_class"])
+    output_path = os.path.join(CHECKPOINTS_SCRATCH, config["substitute_type"], config["factorized_class"])
+    layers = config["layers"] if config["layers"] is not None else range(6)
+    for l in layers:
+        ckpt_model_name = ALR_CHECKPOINT_FORMAT.format(config["epoch"], l)
+        model_path = os.path.join(substitute_model_path, f'layer{l}', ckpt_model_name)
+        print(f"Loading weights from {model_path}")
+        dense = FF_net()
+        dense.load_state_dict(torch.load(model_path, map_location="cpu"))
+        factorized = factorized_FF_net()
+        errors = factorized.load_from_dense(dense)
+        for i, error in errors.items():
+            print(f"layer {l}, Linear {i}: relative error of the factorized weight = {error:.4f}")
+        print(f"layer {l}: {count_parameters(dense)} -> {count_parameters(factorized)} parameters")
+        os.makedirs(os.path.join(output_path, f'layer{l}'), exist_ok = True)
+        torch.save(factorized.state_dict(), os.path.join(output_path, f'layer{l}', ckpt_model_name))
+    print(f"Factorized checkpoints saved in {output_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--substitute_type", type = str, help="Type of the dense substitute", choices=["ALR", "ALRR", "ELR"], default="ALR")
+    parser.add_argument("--substitute_class", type=str, help="trained dense class e.g. FFNetwork_XL", required=True)
+    parser.add_argument("--factorized_class", type=str, help="factorized class with the same widths defined in models/definitions/low_rank_FF.py e.g. FFNetwork_XL_LR", required=True)
+    parser.add_argument("--substitute_model_path", type=str, help="folder of the dense checkpoints, one subfolder per layer. Defaults to CHECKPOINTS_SCRATCH/<substitute_type>/<substitute_class>", default = None)
+    parser.add_argument("--layers", nargs='+', type = int, help = "List of layers to factorize. If layer is not specified, all layers are factorized")
+    parser.add_argument("--epoch", type = int, help="Epoch checkpoint to use.", default = 21)
+    args = parser.parse_args()
+    factorize_config = dict()
+    for arg in vars(args):
+        factorize_config[arg] = getattr(args, arg)
+    factorize(factorize_config)
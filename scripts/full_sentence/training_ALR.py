@@ -1,4 +1,3 @@
-from pickle import UnpicklingError
 import os
 import argparse
 import time
@@ -8,7 +7,6 @@ import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 from torch.optim import Adam
-from torch.nn.utils.rnn import pad_sequence
 from torch.nn.functional import pad
 
 # Local imports
@@ -17,8 +15,13 @@ import sys
 path_root = Path(__file__).parents[2]
 sys.path.append(str(path_root))
 import models.definitions.ALR_FF as FF_models
+from models.definitions.ALR_FF import count_visible_tokens
+from models.definitions.low_rank_FF import get_substitute_class
 from utils.constants import SCRATCH, MAX_LEN, CHECKPOINTS_SCRATCH, ALR_CHECKPOINT_FORMAT
 from utils.data_utils import LanguageDirection
+from utils.activation_store import ActivationStore
+from utils.precision_utils import PRECISIONS, autocast, report_loss_parity
+from utils.pruning_utils import BlockMagnitudePruner
 DATA_PATH=os.path.join(SCRATCH,"pytorch-original-transformer", "mha_outputs")
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
 def MAPE(target, output):
@@ -27,7 +30,11 @@ def MAPE(target, output):
         relative_error = torch.abs(output - target) / torch.max(torch.abs(target), torch.ones(output.shape, device = device)*1e-32)
         return torch.mean(relative_error)
          
-def prepare_data(data_path,language_direction, chosen_layer = 0, batch_size = 5, t = "train", att_replacement = 'encoder'):
+def get_store_path(data_path, language_direction, att_replacement, t):
+    return os.path.join(data_path, att_replacement, f"128emb_20ep_IWSLT_{language_direction}_{t}.store")
+
+def get_dataset(data_path, language_direction, chosen_layer = 0, t = "train", att_replacement = 'encoder'):
+    """Returns the dataset of the chosen layer and the collate function which builds its batches from lists of indices."""
     if t not in ["train", "test", "val"]:
         raise ValueError("ERROR: t must be train, test, or val.")
     if t == "val":
@@ -35,39 +42,72 @@ def prepare_data(data_path,language_direction, chosen_layer = 0, batch_size = 5,
         print("ATTENTION VALIDATION USED IN TRAINING, ONLY OK FOR DEBUGGING")
         print("#"*100)
     if (att_replacement == 'encoder'):
-        in_path =   os.path.join(data_path,"encoder", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_v_inputs_{t}")
-        out_path =  os.path.join(data_path,"encoder", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_outputs_{t}")
-        mask_path = os.path.join(data_path,"encoder", f"128emb_20ep_IWSLT_{language_direction}_masks_{t}")
-        dataset = AttentionEncoderDataset(in_path, out_path, mask_path, MAX_LEN)
-        return DataLoader(dataset,  collate_fn=collate_batch, batch_size= batch_size)
+        store_path = get_store_path(data_path, language_direction, "encoder", t)
+        dataset = AttentionEncoderDataset(store_path, chosen_layer, MAX_LEN)
+        return dataset, FixedLengthCollator(dataset, att_replacement)
     elif(att_replacement == 'decoder'):
-        in_path =   os.path.join(data_path,"decoder_self", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_v_inputs_{t}")
-        out_path =  os.path.join(data_path,"decoder_self", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_outputs_{t}")
-        mask_path = os.path.join(data_path,"decoder_self", f"128emb_20ep_IWSLT_{language_direction}_masks_{t}")
-        dataset = AttentionDecoderDataset(in_path, out_path, mask_path, MAX_LEN)
-        return DataLoader(dataset, collate_fn=collate_batch_decoder, batch_size = batch_size )
+        store_path = get_store_path(data_path, language_direction, "decoder_self", t)
+        dataset = AttentionDecoderDataset(store_path, chosen_layer, MAX_LEN)
+        return dataset, FixedLengthCollator(dataset, att_replacement)
     elif(att_replacement == 'decoder_ca'):
-        in_enc_path =   os.path.join(data_path,"decoder_cross", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_v_inputs_{t}")
-        in_dec_path =   os.path.join(data_path,"decoder_cross", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_q_inputs_{t}")
-        out_path =  os.path.join(data_path,"decoder_cross", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_outputs_{t}")
-        src_mask_path = os.path.join(data_path,"decoder_cross", f"128emb_20ep_IWSLT_{language_direction}_masks_{t}_src")
-        trg_mask_path = os.path.join(data_path,"decoder_cross", f"128emb_20ep_IWSLT_{language_direction}_masks_{t}")
-        dataset = AttentionDecoderCADataset(in_enc_path, in_dec_path, out_path, src_mask_path, trg_mask_path, MAX_LEN)
-        return DataLoader(dataset, collate_fn=collate_batch_decoder_ca, batch_size = batch_size )
+        store_path = get_store_path(data_path, language_direction, "decoder_cross", t)
+        dataset = AttentionDecoderCADataset(store_path, chosen_layer, MAX_LEN)
+        return dataset, FixedLengthCollator(dataset, att_replacement)
     else:
         raise ValueError("ERROR: att_replacement must be encoder, decoder or decoder_ca.")
-    
-def training_replacement_FF(params):
-    FF_net = getattr(FF_models, params["substitute_class"])
+
+def prepare_data(data_path,language_direction, chosen_layer = 0, batch_size = 5, t = "train", att_replacement = 'encoder'):
+    dataset, collate_fn = get_dataset(data_path, language_direction, chosen_layer, t, att_replacement)
+    # the loader only batches the indices, the collate function gathers the records of the whole batch at once
+    return DataLoader(range(len(dataset)), collate_fn=collate_fn, batch_size= batch_size)
+
+def prepare_data_multi_layer(data_path, language_direction, layers, batch_size = 5, t = "train", att_replacement = 'encoder'):
+    """Data loader whose batches are lists with one (data, label, mask) batch per layer, all for the same sentences."""
+    datasets, collate_fns = [], []
+    for layer in layers:
+        dataset, collate_fn = get_dataset(data_path, language_direction, layer, t, att_replacement)
+        datasets.append(dataset)
+        collate_fns.append(collate_fn)
+    for dataset in datasets:
+        assert (dataset.indices == datasets[0].indices).all(), "The datasets must contain the same sentences."
+    return DataLoader(range(len(datasets[0])), collate_fn=lambda idx: [collate_fn(idx) for collate_fn in collate_fns], batch_size = batch_size)
+
+def train_step(model, lr_optimizer, mse_loss, data, label, mask, precision = "fp32"):
+    """One optimization step, returns the loss summed over the embeddings and the number of embeddings."""
+    lr_optimizer.zero_grad()
+    with autocast(precision, device):
+        pred=model(data,mask)
+        with torch.no_grad():
+            # the decoder self attention substitutes (B x T x MD outputs) count the tokens of every causal prefix
+            num_embeddings=count_visible_tokens(mask, causal = pred.dim() == 3)
+            loss_normalizer=num_embeddings/(mask.shape[0]*mask.shape[1])
+        loss=mse_loss(label,pred)/loss_normalizer
+    loss.backward()
+    loss /= loss_normalizer
+    lr_optimizer.step()
+    return loss.item()*num_embeddings, num_embeddings, pred
+
+def create_model(substitute_class, multi_device):
+    FF_net = get_substitute_class(FF_models, substitute_class)
     print(f"Training model: {FF_net}")
     model=FF_net()
-    if not params["multi_device"]:
+    if not multi_device:
         model.to(device)
     # print(model)
     #model.init_weights()
     model.train(True)
-    print("FF model created")
     lr_optimizer = Adam(model.parameters(), lr=0.0001,betas=(0.9, 0.98), eps=1e-9)
+    return model, lr_optimizer
+
+def training_replacement_FF(params):
+    model, lr_optimizer = create_model(params["substitute_class"], params["multi_device"])
+    print("FF model created")
+    if params["init_checkpoint"] is not None:
+        print(f"Fine-tuning from {params['init_checkpoint']}")
+        model.load_state_dict(torch.load(params["init_checkpoint"], map_location=next(model.parameters()).device))
+    pruner = None
+    if params["prune_sparsity"] > 0:
+        pruner = BlockMagnitudePruner(model, params["prune_sparsity"], params["prune_block_size"], params["prune_start_epoch"], params["prune_end_epoch"])
     print("Preparing data")
     data_loader=prepare_data(params['dataset_path'], params['language_direction'], chosen_layer = params['num_of_curr_trained_layer'], batch_size = params["batch_size"], att_replacement = params["att_replacement"]) 
     mse_loss=nn.MSELoss()
@@ -77,372 +117,252 @@ def training_replacement_FF(params):
         num_embeddings=0
         mapes = []
         start = time.time()
-        for (data,label, mask) in data_loader:
-            lr_optimizer.zero_grad()
-            pred=model(data,mask)
-            with torch.no_grad():
-                num_embeddings+=torch.sum(torch.flatten(mask)).item()
-                loss_normalizer=torch.sum(torch.flatten(mask)).item()/(mask.shape[0]*mask.shape[1])
-            loss=mse_loss(label,pred)/loss_normalizer
-            loss.backward()
-            loss /= loss_normalizer
-            lr_optimizer.step()
-            with torch.no_grad():
-                epoch_loss+=loss.item()*torch.sum(torch.flatten(mask)).item()
-                mapes.append(MAPE(label, pred))
-        if epoch % 20 == 0:
+        if pruner is not None:
+            print(f"Block sparsity: {pruner.update(epoch):.3f}")
+        for batch_idx, (data,label, mask) in enumerate(data_loader):
+            if batch_idx == 0:
+                report_loss_parity(lambda: mse_loss(label, model(data, mask)), params["precision"], device, model)
+            batch_loss, batch_embeddings, pred = train_step(model, lr_optimizer, mse_loss, data, label, mask, params["precision"])
+            if pruner is not None:
+                # the optimizer step moves the pruned weights away from 0
+                pruner.apply()
+            epoch_loss+=batch_loss
+            num_embeddings+=batch_embeddings
+            mapes.append(MAPE(label, pred))
+        if epoch % 20 == 0 or (pruner is not None and epoch == params['num_of_epochs'] - 1):
             ckpt_model_name = ALR_CHECKPOINT_FORMAT.format(epoch+1, params['num_of_curr_trained_layer'])
             torch.save(model.state_dict(), os.path.join(params["checkpoints_folder"], ckpt_model_name))
         print(f"Loss per embedding element:{epoch_loss/num_embeddings}, MAPE: {MAPE(label, pred)}, time: {time.time() - start}")
 
+def training_replacement_FF_multi(params):
+    """
+        Trains one FF for every (layer, substitute class) pair of params["pairs"] in a single data pass: the data of
+        every layer is loaded once and all the models are stepped on every batch.
+    """
+    layers = sorted(set(layer for (layer, _) in params["pairs"]))
+    models = {}
+    for (layer, substitute_class) in params["pairs"]:
+        models[(layer, substitute_class)] = create_model(substitute_class, params["multi_device"])
+    print(f"{len(models)} FF models created")
+    print("Preparing data")
+    data_loader=prepare_data_multi_layer(params['dataset_path'], params['language_direction'], layers, batch_size = params["batch_size"], att_replacement = params["att_replacement"])
+    mse_loss=nn.MSELoss()
+    for epoch in range(params['num_of_epochs']):
+        print("Epoch: ",epoch)
+        epoch_loss = {pair: 0 for pair in models}
+        num_embeddings = {pair: 0 for pair in models}
+        start = time.time()
+        for batch_idx, layer_batches in enumerate(data_loader):
+            for (layer, substitute_class), (model, lr_optimizer) in models.items():
+                data, label, mask = layer_batches[layers.index(layer)]
+                if batch_idx == 0:
+                    report_loss_parity(lambda: mse_loss(label, model(data, mask)), params["precision"], device, model, prefix=f"{substitute_class} layer {layer}: ")
+                batch_loss, batch_embeddings, _ = train_step(model, lr_optimizer, mse_loss, data, label, mask, params["precision"])
+                epoch_loss[(layer, substitute_class)]+=batch_loss
+                num_embeddings[(layer, substitute_class)]+=batch_embeddings
+        for (layer, substitute_class), (model, _) in models.items():
+            if epoch % 20 == 0:
+                ckpt_model_name = ALR_CHECKPOINT_FORMAT.format(epoch+1, layer)
+                torch.save(model.state_dict(), os.path.join(get_checkpoints_folder(substitute_class, layer), ckpt_model_name))
+            print(f"{substitute_class} layer {layer}: loss per embedding element:{epoch_loss[(layer, substitute_class)]/num_embeddings[(layer, substitute_class)]}")
+        print(f"Epoch time: {time.time() - start}")
+
+def get_checkpoints_folder(substitute_class, layer):
+    return os.path.join(CHECKPOINTS_SCRATCH,"ALR", substitute_class, f"layer{layer}")
+
+def select_records(lengths, n, t):
+    """Returns the indices of the sentences of length <= n (t = "max") or exactly n (t = "exact")."""
+    if t == "max":
+        return np.nonzero(lengths <= n)[0]
+    if t == "exact":
+        return np.nonzero(lengths == n)[0]
+    raise ValueError("ERROR: t has to be either 'max' or 'exact'.")
+
+def load_record(store, name, idx):
+    # records only hold the non-padded tokens of the sentence, no slicing needed
+    return torch.from_numpy(np.asarray(store.get(name, idx), dtype=np.float32))
+
 class AttentionEncoderDataset(torch.utils.data.Dataset):
-    def __init__(self, input_path, output_path, mask_path, n, t = "max"):
-        print(f"Starting to load datasets from {input_path} and {output_path} and {mask_path}")
+    def __init__(self, store_path, layer, n, t = "max"):
+        print(f"Starting to load dataset of layer {layer} from {store_path}")
         start = time.time()
 
         self.n = n
-        if t != "max" and t != "exact":
-            raise ValueError("ERROR: t has to be either 'max' or 'exact'.")
         self.t = t
-        self.input = []
-        self.output = []
-        if t == "max":
-            self.mask = []
-            mask_cache = f"{mask_path}_fixed_{n}_{t}.cache"
-
-        in_cache = f"{input_path}_fixed_{n}_{t}.cache"
-        out_cache = f"{output_path}_fixed_{n}_{t}.cache"
-
-        if os.path.exists(in_cache) and os.path.exists(out_cache) and (t == "exact" or os.path.exists(mask_cache)):
-            self.input = torch.load(in_cache)
-            self.output = torch.load(out_cache)
-            if t == "max":
-                self.mask = torch.load(mask_cache)
-                print(f"Finished loading mask dataset from cache {mask_cache}")
-            print(f"Finished loading datasets from cache {in_cache} and {out_cache}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-            return
-
-        inf = open(input_path, "rb")
-        outf = open(output_path, "rb")
-        maskf = open(mask_path, "rb")
-        try:
-            while(True):
-                # i represents one batch of sentences -> dim: batch size x padded sentence length x embedding size
-                i = torch.from_numpy(np.load(inf))
-                m = torch.from_numpy(np.load(maskf))
-                m = torch.squeeze(m, dim=1)
-                m = torch.squeeze(m, dim=1)
-                o = torch.from_numpy(np.load(outf))
-                l = torch.sum(m, dim = 1)
-                for j in range(i.shape[0]):
-                    if t == "max":
-                        if l[j] <= n:
-                            self.input.append(i[j, :l[j]])
-                            self.output.append(o[j,:,:l[j]])
-                            self.mask.append(m[j,  :l[j]])
-                    else:
-                        if l[j] == n:
-                            self.input.append(i[j, :l[j]])
-                            self.output.append(o[j, :l[j]])
-        except (UnpicklingError, ValueError):
-            print(f"Finished loading datasets from {input_path} and {output_path}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-        finally:
-            inf.close()
-            outf.close()
-            maskf.close()
-        # self.input = torch.cat(self.input, dim=0)
-        # self.output = torch.cat(self.output, dim=0)
-        print(self.input[0].shape)
-        torch.save(self.input, in_cache)
-        torch.save(self.output, out_cache)
-        if t == "max":
-            # self.mask = torch.cat(self.mask, dim=0)
-            torch.save(self.mask, mask_cache)
+        self.store = ActivationStore(store_path)
+        self.in_field = f"layer{layer}_v_inputs"
+        self.out_field = f"layer{layer}_outputs"
+        self.lengths = self.store.metadata("src_lengths")
+        self.indices = select_records(self.lengths, n, t)
+        print(f"Loaded {len(self.indices)} samples in {time.time() - start}s")
 
     def __len__(self):
-        return len(self.input)
+        return len(self.indices)
 
     def __getitem__(self, idx):
+        j = self.indices[idx]
+        l = int(self.lengths[j])
+        inputs = load_record(self.store, self.in_field, j)
+        # stored as S x NH x HD, the collate function expects NH x S x HD
+        outputs = load_record(self.store, self.out_field, j).transpose(0, 1)
         # if we have exactly the same length, there is no need for padding/masking
         if self.t == "exact":
-            return (self.input[idx], self.output[idx])
-        return (self.input[idx], self.output[idx], self.mask[idx])
+            return (inputs, outputs)
+        return (inputs, outputs, torch.ones(l, dtype=torch.bool))
+
+    def gather(self, idx, inputs, outputs):
+        """Writes the sentences idx into inputs (B x MAX_LEN x MD) and outputs (B x MAX_LEN x NH x HD), zero padded, returns their lengths."""
+        j = self.indices[idx]
+        self.store.gather(self.in_field, j, inputs)
+        return self.store.gather(self.out_field, j, outputs)
 
     def emb_size(self):
-        return self.input.shape[1]
+        return self.store.feature_shape(self.in_field)[-1]
 
 class AttentionDecoderCADataset(torch.utils.data.Dataset):
-    def __init__(self, in_enc_path, in_dec_path, out_path, src_mask_path, trg_mask_path,  n, t = "max"):
-        print(f"Starting to load datasets from {in_enc_path}, {in_dec_path}, {out_path}, {src_mask_path}  and {trg_mask_path}")
+    def __init__(self, store_path, layer, n, t = "max"):
+        print(f"Starting to load dataset of layer {layer} from {store_path}")
         start = time.time()
 
         self.n = n
-        if t != "max" and t != "exact":
-            raise ValueError("ERROR: t has to be either 'max' or 'exact'.")
+        if t != "max":
+            raise ValueError("ERROR: only t = 'max' is supported for cross attention.")
         self.t = t
-        self.input_enc = []
-        self.input_dec = []
-        self.output = []
-        if t == "max":
-            self.src_mask = []
-            self.trg_mask = []
-            src_mask_cache = f"{src_mask_path}_fixed_{n}_{t}.cache"
-            trg_mask_cache = f"{trg_mask_path}_fixed_{n}_{t}.cache"
-
-        in_enc_cache = f"{in_enc_path}_fixed_{n}_{t}.cache"
-        in_dec_cache = f"{in_dec_path}_fixed_{n}_{t}.cache"
-        out_cache = f"{out_path}_fixed_{n}_{t}.cache"
-
-        if os.path.exists(in_enc_cache) and os.path.exists(in_dec_cache) and os.path.exists(out_cache) and (t == "exact" or (os.path.exists(src_mask_cache) and os.path.exists(trg_mask_cache))):
-            self.input_enc = torch.load(in_enc_cache)
-            self.input_dec = torch.load(in_dec_cache)
-            self.output = torch.load(out_cache)
-            if t == "max":
-                self.src_mask = torch.load(src_mask_cache)
-                self.trg_mask = torch.load(trg_mask_cache)
-                print(f"Finished loading mask dataset from cache {src_mask_cache} and {trg_mask_cache}")
-            print(f"Finished loading datasets from cache {in_enc_cache}, {in_dec_cache} and {out_cache}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-            return
-
-        inf_enc = open(in_enc_path, "rb")
-        inf_dec = open(in_dec_path, "rb")
-        outf = open(out_path, "rb")
-        maskf_enc = open(src_mask_path, "rb")
-        maskf_dec = open(trg_mask_path, "rb")
-
-        i_enc_list = []
-        i_dec_list = []
-        o_list = []
-        m_enc_list = []
-        m_dec_list = []
-        l1_list = []
-        l2_list = []
-
-        try:
-            while(True):
-                # i represents one batch of sentences -> dim: batch size x padded sentence length x embedding size
-                i_enc = torch.from_numpy(np.load(inf_enc))
-                i_dec = torch.from_numpy(np.load(inf_dec))
-                o = torch.from_numpy(np.load(outf))
-                
-                m = torch.from_numpy(np.load(maskf_enc))
-                m = torch.squeeze(m, dim=1)
-                m_enc = torch.squeeze(m, dim=1)
-
-                m = torch.from_numpy(np.load(maskf_dec))
-                m = m[:,:,-1]
-                m_dec = torch.squeeze(m, dim=1)
-
-                l1 = torch.sum(m_enc, dim = 1)
-                l2 = torch.sum(m_dec, dim = 1)
-
-                i_enc_list.extend(list(i_enc))
-                i_dec_list.extend(list(i_dec))
-                o_list.extend(list(o))
-                m_enc_list.extend(list(m_enc))
-                m_dec_list.extend(list(m_dec))
-                l1_list.extend(list(l1))
-                l2_list.extend(list(l2))
-
-
-        except (UnpicklingError, ValueError):
-            print(f"Finished loading datasets from {in_enc_path}, {in_dec_path} and {out_path}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-        finally:
-            inf_enc.close()
-            inf_dec.close()
-            outf.close()
-            maskf_enc.close()
-            maskf_dec.close()
-        
-        for j in range(len(i_enc_list)):
-            if t == "max":
-                if l1_list[j] <= n and l2_list[j] <= n:
-                    self.input_enc.append(i_enc_list[j][:l1_list[j]])
-                    self.src_mask.append(m_enc_list[j][:l1_list[j]])
-
-                    self.input_dec.append(i_dec_list[j][:l2_list[j]])
-                    self.output.append(o_list[j][:,:l2_list[j]])
-                    self.trg_mask.append(m_dec_list[j][:l2_list[j]])
-
-        print(f"Encoder input shape: {self.input_enc[0].shape}")
-        print(f"Decoder input shape: {self.input_dec[0].shape}")
-        torch.save(self.input_enc, in_enc_cache)
-        torch.save(self.input_dec, in_dec_cache)
-        torch.save(self.output, out_cache)
-        if t == "max":
-            torch.save(self.src_mask, src_mask_cache)
-            torch.save(self.trg_mask, trg_mask_cache)
+        self.store = ActivationStore(store_path)
+        self.in_enc_field = f"layer{layer}_v_inputs"
+        self.in_dec_field = f"layer{layer}_q_inputs"
+        self.out_field = f"layer{layer}_outputs"
+        self.src_lengths = self.store.metadata("src_lengths")
+        self.trg_lengths = self.store.metadata("trg_lengths")
+        self.indices = np.nonzero((self.src_lengths <= n) & (self.trg_lengths <= n))[0]
+        print(f"Loaded {len(self.indices)} samples in {time.time() - start}s")
 
     def __len__(self):
-        return len(self.input_enc)
+        return len(self.indices)
 
     def __getitem__(self, idx):
-        # if we have exactly the same length, there is no need for padding/masking
-        if self.t == "exact":
-            return (self.input_enc[idx],self.input_dec[idx], self.output[idx])
-        return (self.input_enc[idx],self.input_dec[idx], self.output[idx], self.src_mask[idx], self.trg_mask[idx])
+        j = self.indices[idx]
+        l1 = int(self.src_lengths[j])
+        l2 = int(self.trg_lengths[j])
+        input_enc = load_record(self.store, self.in_enc_field, j)
+        input_dec = load_record(self.store, self.in_dec_field, j)
+        output = load_record(self.store, self.out_field, j).transpose(0, 1)
+        return (input_enc, input_dec, output, torch.ones(l1, dtype=torch.bool), torch.ones(l2, dtype=torch.bool))
+
+    def gather(self, idx, inputs_enc, inputs_dec, outputs):
+        """Same as AttentionEncoderDataset.gather for the source and target inputs, returns the source and target lengths."""
+        j = self.indices[idx]
+        src_lengths = self.store.gather(self.in_enc_field, j, inputs_enc)
+        self.store.gather(self.in_dec_field, j, inputs_dec)
+        return src_lengths, self.store.gather(self.out_field, j, outputs)
 
     def emb_size(self):
-        return self.input.shape[1]
+        return self.store.feature_shape(self.in_enc_field)[-1]
 
 class AttentionDecoderDataset(torch.utils.data.Dataset):
-    def __init__(self, input_path, output_path, mask_path, n, t = "max"):
-        print(f"Starting to load datasets from {input_path} and {output_path} and {mask_path}")
+    def __init__(self, store_path, layer, n, t = "max"):
+        print(f"Starting to load dataset of layer {layer} from {store_path}")
         start = time.time()
 
         self.n = n
-        if t != "max" and t != "exact":
-            raise ValueError("ERROR: t has to be either 'max' or 'exact'.")
         self.t = t
-        self.input = []
-        self.output = []
-        if t == "max":
-            self.mask = []
-            mask_cache = f"{mask_path}_fixed_{n}_{t}.cache"
-
-        in_cache = f"{input_path}_fixed_{n}_{t}.cache"
-        out_cache = f"{output_path}_fixed_{n}_{t}.cache"
-
-        if os.path.exists(in_cache) and os.path.exists(out_cache) and (t == "exact" or os.path.exists(mask_cache)):
-            self.input = torch.load(in_cache)
-            self.output = torch.load(out_cache)
-            if t == "max":
-                self.mask = torch.load(mask_cache)
-                print(f"Finished loading mask dataset from cache {mask_cache}")
-            print(f"Finished loading datasets from cache {in_cache} and {out_cache}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-            return
-
-        inf = open(input_path, "rb")
-        outf = open(output_path, "rb")
-        maskf = open(mask_path, "rb")
-        try:
-            while(True):
-                # i represents one batch of sentences -> dim: batch size x padded sentence length x embedding size
-                i = torch.from_numpy(np.load(inf))
-                m = torch.from_numpy(np.load(maskf))
-                m = torch.squeeze(m, dim = 1)
-                o = torch.from_numpy(np.load(outf))
-                l = torch.max(torch.sum(m, dim = -1), dim = -1).values
-                for j in range(i.shape[0]):
-                    if t == "max":
-                        if l[j] <= n:
-                            self.input.append(i[j, :l[j]])
-                            self.output.append(o[j,:,:l[j]])
-                            self.mask.append(m[j,  :l[j], :l[j]])
-                    else:
-                        if l[j] == n:
-                            self.input.append(i[j, :n])
-                            self.output.append(o[j, :n])
-        except (UnpicklingError, ValueError):
-            print(f"Finished loading datasets from {input_path} and {output_path}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-        finally:
-            inf.close()
-            outf.close()
-            maskf.close()
-        # self.input = torch.cat(self.input, dim=0)
-        # self.output = torch.cat(self.output, dim=0)
-        torch.save(self.input, in_cache)
-        torch.save(self.output, out_cache)
-        if t == "max":
-            # self.mask = torch.cat(self.mask, dim=0)
-            torch.save(self.mask, mask_cache)
+        self.store = ActivationStore(store_path)
+        self.in_field = f"layer{layer}_v_inputs"
+        self.out_field = f"layer{layer}_outputs"
+        self.lengths = self.store.metadata("trg_lengths")
+        self.indices = select_records(self.lengths, n, t)
+        print(f"Loaded {len(self.indices)} samples in {time.time() - start}s")
 
     def __len__(self):
-        return len(self.input)
+        return len(self.indices)
 
     def __getitem__(self, idx):
+        j = self.indices[idx]
+        l = int(self.lengths[j])
+        inputs = load_record(self.store, self.in_field, j)
+        outputs = load_record(self.store, self.out_field, j).transpose(0, 1)
         # if we have exactly the same length, there is no need for padding/masking
         if self.t == "exact":
-            return (self.input[idx], self.output[idx])
-        return (self.input[idx], self.output[idx], self.mask[idx])
+            return (inputs, outputs)
+        # padding and no-look-forward mask of the sentence, shape = (S, S)
+        return (inputs, outputs, torch.tril(torch.ones((l, l), dtype=torch.bool)))
+
+    def gather(self, idx, inputs, outputs):
+        """Writes the sentences idx into inputs (B x MAX_LEN x MD) and outputs (B x MAX_LEN x NH x HD), zero padded, returns their lengths."""
+        j = self.indices[idx]
+        self.store.gather(self.in_field, j, inputs)
+        return self.store.gather(self.out_field, j, outputs)
 
     def emb_size(self):
-        return self.input.shape[1]
-
-def collate_batch_decoder(batch):
-    NH = batch[0][1].shape[0]
-    HD = batch[0][1].shape[2]
-    batch_size = len(batch)
-    inputs  = pad_sequence([x[0] for x in batch], batch_first=True, padding_value=0)
-    outputs = pad_sequence([x[1].transpose(0,1).reshape(-1, NH * HD) for x in batch], batch_first=True, padding_value=0) # this reshaping must be transfered to the adapter as well
-    trg_padding_mask = pad_sequence([x[2][-1] for x in batch], batch_first=True, padding_value=0)
-    inputs = torch.cat([inputs, torch.zeros(pad_shape(inputs))], dim = 1).to(device)
-    outputs = torch.cat([outputs, torch.zeros(pad_shape(outputs))], dim = 1).to(device)    
-    trg_padding_mask = torch.cat([trg_padding_mask, torch.zeros(pad_shape(trg_padding_mask, masks = True), dtype=torch.bool)], dim = 1).view(batch_size, 1, -1).to(device)
-    
-    # Pad to fixed length    
-    trg_no_look_forward_mask = torch.triu(torch.ones((1, MAX_LEN, MAX_LEN), device=device) == 1).transpose(1, 2)
-
-    # logic AND operation (both padding mask and no-look-forward must be true to attend to a certain target token)
-    trg_mask = trg_padding_mask & trg_no_look_forward_mask  # final shape = (B, T, T)
-    return inputs, outputs, trg_mask    
-
-def pad_shape(batch, masks = False):
-    shape = batch.shape
-    if masks:
-        return shape[0],MAX_LEN-shape[1] 
-    return shape[0], MAX_LEN-shape[1], shape[2]
-
-def collate_batch(batch):   
-    # print("COLLATE")
-    # print(batch[0][0].shape)
-    # print(batch[0][1].shape)
-    # print(batch[0][2].shape)
-    
-    # Pad all elements to the same length
-    NH = batch[0][1].shape[0]
-    HD = batch[0][1].shape[2]
-    inputs  = pad_sequence([x[0] for x in batch], batch_first=True, padding_value=0)
-    outputs = pad_sequence([x[1].transpose(0,1).reshape(-1, NH * HD) for x in batch], batch_first=True, padding_value=0) # this reshaping must be transfered to the adapter as well
-    masks   = pad_sequence([x[2] for x in batch], batch_first=True, padding_value=0) 
-    # print(inputs.shape)
-    # print(outputs.shape)
-    # print(masks.shape)
-    
-    # Pad to fixed length
-    inputs = torch.cat([inputs, torch.zeros(pad_shape(inputs))], dim = 1).to(device)
-    outputs = torch.cat([outputs, torch.zeros(pad_shape(outputs))], dim = 1).to(device)
-    masks = torch.cat([masks, torch.zeros(pad_shape(masks, masks = True), dtype=torch.bool)], dim = 1).to(device)
-    
-    # Reshape concatenating the embeddings for each sentence
-    masks = torch.repeat_interleave(masks, inputs.shape[-1] ,dim=1)
-    inputs = torch.reshape(inputs, (inputs.shape[0],inputs.shape[1]*inputs.shape[2]))
-    outputs = torch.reshape(outputs, (outputs.shape[0],outputs.shape[1]*outputs.shape[2]))
-    return inputs, outputs, masks
-
-def collate_batch_decoder_ca(batch):   
-    # Pad all elements to the same length
-    NH = batch[0][2].shape[0]
-    HD = batch[0][2].shape[2]
-    inputs_enc  = pad_sequence([x[0] for x in batch], batch_first=True, padding_value=0)
-    inputs_dec  = pad_sequence([x[1] for x in batch], batch_first=True, padding_value=0)
-    outputs = pad_sequence([x[2].transpose(0,1).reshape(-1, NH * HD) for x in batch], batch_first=True, padding_value=0) # this reshaping must be transfered to the adapter as well
-    src_masks   = pad_sequence([x[3] for x in batch], batch_first=True, padding_value=0) 
-    trg_masks   = pad_sequence([x[4] for x in batch], batch_first=True, padding_value=0) 
-    # print(inputs.shape)
-    # print(outputs.shape)
-    # print(masks.shape)
-    
-    # Pad to fixed length
-    inputs_enc = torch.cat([inputs_enc, torch.zeros(pad_shape(inputs_enc))], dim = 1).to(device)
-    inputs_dec = torch.cat([inputs_dec, torch.zeros(pad_shape(inputs_dec))], dim = 1).to(device)
-    outputs = torch.cat([outputs, torch.zeros(pad_shape(outputs))], dim = 1).to(device)
-    src_masks = torch.cat([src_masks, torch.zeros(pad_shape(src_masks, masks = True), dtype=torch.bool)], dim = 1).to(device)
-    trg_masks = torch.cat([trg_masks, torch.zeros(pad_shape(trg_masks, masks = True), dtype=torch.bool)], dim = 1).to(device)
-    # Reshape concatenating the embeddings for each sentence
-    src_masks = torch.repeat_interleave(src_masks, inputs_enc.shape[-1] ,dim=1)
-    trg_masks = torch.repeat_interleave(trg_masks, inputs_dec.shape[-1] ,dim=1)
-    inputs_enc = torch.reshape(inputs_enc, (inputs_enc.shape[0],inputs_enc.shape[1]*inputs_enc.shape[2]))
-    inputs_dec = torch.reshape(inputs_dec, (inputs_dec.shape[0],inputs_dec.shape[1]*inputs_dec.shape[2]))
-    inputs = torch.cat([inputs_enc, inputs_dec], dim = 1)
-    outputs = torch.reshape(outputs, (outputs.shape[0],outputs.shape[1]*outputs.shape[2]))
-    return inputs, outputs, trg_masks
+        return self.store.feature_shape(self.in_field)[-1]
+
+class FixedLengthCollator:
+    """
+        Builds the batches padded to MAX_LEN directly in preallocated host buffers, which are pinned when a GPU is
+        used so that the copies to the device don't block. The records of the batch are gathered from the store into
+        the buffers with tensor indexing (see ActivationStore.gather), there is no per-sentence tensor. The masks are
+        the compact B x MAX_LEN token masks, the FF networks broadcast them over the features of every token (see
+        apply_token_mask in ALR_FF.py).
+
+        Two sets of buffers are used in turn, a set is only rewritten once the copies of the batch it held are done.
+        The collate function takes a list of indices of the dataset.
+    """
+    def __init__(self, dataset, att_replacement):
+        self.dataset = dataset
+        self.att_replacement = att_replacement
+        self.model_dimension = dataset.emb_size()
+        self.heads_shape = dataset.store.feature_shape(dataset.out_field)  # NH, HD
+        self.buffers = [None, None]
+        self.copies_done = [None, None]
+        self.turn = 0
+
+    def get_buffers(self, batch_size, widths):
+        # one B x MAX_LEN x width float buffer per width, None stands for a B x MAX_LEN mask
+        turn = self.turn
+        self.turn = 1 - turn
+        if self.copies_done[turn] is not None:
+            self.copies_done[turn].synchronize()
+        buffers = self.buffers[turn]
+        if buffers is None or buffers[0].shape[0] < batch_size:
+            buffers = [torch.zeros((batch_size, MAX_LEN) if width is None else (batch_size, MAX_LEN, width),
+                                   dtype=torch.bool if width is None else torch.float32, pin_memory=device.type == "cuda")
+                       for width in widths]
+            self.buffers[turn] = buffers
+        return turn, [buffer[:batch_size] for buffer in buffers]
+
+    def to_device(self, turn, buffers):
+        buffers = [buffer.to(device, non_blocking=True) for buffer in buffers]
+        if device.type == "cuda":
+            self.copies_done[turn] = torch.cuda.Event()
+            self.copies_done[turn].record()
+        return buffers
+
+    @staticmethod
+    def fill_mask(mask, lengths):
+        mask.copy_(torch.arange(MAX_LEN)[None, :] < torch.from_numpy(lengths)[:, None])
+
+    def __call__(self, idx):
+        B = len(idx)
+        MD = self.model_dimension
+        NH, HD = self.heads_shape
+        if self.att_replacement == "decoder_ca":
+            turn, (inputs, outputs, trg_masks) = self.get_buffers(B, [2 * MD, NH * HD, None])
+            # the source tokens go to the first MAX_LEN tokens of the buffer, the target ones to the last MAX_LEN
+            tokens = inputs.view(B, 2 * MAX_LEN, MD).numpy()
+            _, trg_lengths = self.dataset.gather(idx, tokens[:, :MAX_LEN], tokens[:, MAX_LEN:], outputs.view(B, MAX_LEN, NH, HD).numpy())
+            self.fill_mask(trg_masks, trg_lengths)
+            inputs, outputs, trg_masks = self.to_device(turn, (inputs, outputs, trg_masks))
+            return inputs.reshape(B, -1), outputs.reshape(B, -1), trg_masks
+
+        turn, (inputs, outputs, masks) = self.get_buffers(B, [MD, NH * HD, None])
+        lengths = self.dataset.gather(idx, inputs.numpy(), outputs.view(B, MAX_LEN, NH, HD).numpy())
+        self.fill_mask(masks, lengths)
+        inputs, outputs, masks = self.to_device(turn, (inputs, outputs, masks))
+        if self.att_replacement == "decoder":
+            # masks is the B x T padding mask, the FF applies the no-look-forward part (see causal_prefix_forward)
+            return inputs, outputs, masks
+        # Reshape concatenating the embeddings for each sentence
+        return inputs.reshape(B, -1), outputs.reshape(B, -1), masks
 
 
 if __name__ == "__main__":
@@ -452,20 +372,51 @@ if __name__ == "__main__":
     parser.add_argument("--model_dimension", type=str, help='embedding size', default=128)
     parser.add_argument("--batch_size", type=str, help='batch_size', default=2000)
     parser.add_argument("--multi_device", action = "store_true")
+    parser.add_argument("--precision", choices=PRECISIONS, help="fp32, or bf16 autocast for the forward passes (see utils/precision_utils.py)", default="fp32")
     
     # Params to set
     parser.add_argument("--num_of_curr_trained_layer", type=str, help='num_of_curr_trained_layer', default=0)
-    parser.add_argument("--substitute_class", type = str, help="name of the FF to train defined in models/definitions/ALR.py", required=True)
+    parser.add_argument("--substitute_class", type = str, help="name of the FF to train defined in models/definitions/ALR.py")
     parser.add_argument("--att_replacement", help = "Which attention to replace", choices = ["encoder", "decoder", "decoder_ca"], default = "encoder")
     parser.add_argument("--language_direction", choices=[el.name for el in LanguageDirection], help='which direction to translate', default=LanguageDirection.de_en.name)
+
+    # Block magnitude pruning while fine-tuning a trained substitute (single layer/class only)
+    parser.add_argument("--init_checkpoint", type=str, help="checkpoint of the substitute to fine-tune", default=None)
+    parser.add_argument("--prune_sparsity", type=float, help="final fraction of zero blocks of every Linear, 0 disables pruning", default=0.)
+    parser.add_argument("--prune_block_size", type=int, nargs=2, help="out x in size of the pruned blocks, e.g. 1 6400 prunes whole rows", default=[32, 32])
+    parser.add_argument("--prune_start_epoch", type=int, help="epoch where the sparsity starts to increase", default=0)
+    parser.add_argument("--prune_end_epoch", type=int, help="epoch where the final sparsity is reached", default=10)
+
+    # Train several layers/classes in one process, every class is trained for every layer
+    parser.add_argument("--layers", type=int, nargs="+", help="layers to train in the same data pass, replaces num_of_curr_trained_layer")
+    parser.add_argument("--substitute_classes", type=str, nargs="+", help="FFs to train in the same data pass, replaces substitute_class")
     args = parser.parse_args()
     # Wrapping training configuration into a dictionary
     training_config = dict()
     for arg in vars(args):
         training_config[arg] = getattr(args, arg)
     print("Training arguments parsed")
-    training_config["checkpoints_folder"] = os.path.join(CHECKPOINTS_SCRATCH,"ALR", training_config["substitute_class"], f"layer{training_config['num_of_curr_trained_layer']}")
-    os.makedirs(training_config["checkpoints_folder"], exist_ok = True)
-    print(training_config["checkpoints_folder"])
-    print(training_config)
-    training_replacement_FF(training_config)
+    if training_config["layers"] is None and training_config["substitute_classes"] is None:
+        if training_config["substitute_class"] is None:
+            parser.error("--substitute_class or --substitute_classes is required")
+        checkpoints_class = training_config["substitute_class"]
+        if training_config["prune_sparsity"] > 0:
+            # the pruned checkpoints are dense with zeroed blocks, saved next to the dense ones
+            checkpoints_class = f"{checkpoints_class}_block_sparse{round(training_config['prune_sparsity'] * 100)}"
+        training_config["checkpoints_folder"] = get_checkpoints_folder(checkpoints_class, training_config['num_of_curr_trained_layer'])
+        os.makedirs(training_config["checkpoints_folder"], exist_ok = True)
+        print(training_config["checkpoints_folder"])
+        print(training_config)
+        training_replacement_FF(training_config)
+    else:
+        if training_config["prune_sparsity"] > 0 or training_config["init_checkpoint"] is not None:
+            parser.error("--prune_sparsity and --init_checkpoint train a single layer/class, not with --layers/--substitute_classes")
+        layers = training_config["layers"] or [int(training_config["num_of_curr_trained_layer"])]
+        substitute_classes = training_config["substitute_classes"] or [training_config["substitute_class"]]
+        if None in substitute_classes:
+            parser.error("--substitute_class or --substitute_classes is required")
+        training_config["pairs"] = [(layer, substitute_class) for layer in layers for substitute_class in substitute_classes]
+        for (layer, substitute_class) in training_config["pairs"]:
+            os.makedirs(get_checkpoints_folder(substitute_class, layer), exist_ok = True)
+        print(training_config)
+        training_replacement_FF_multi(training_config)
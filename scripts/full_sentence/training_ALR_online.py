@@ -0,0 +1,204 @@
+import os
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+from torch.optim import Adam
+from torch.nn.functional import pad
+
+# Local imports
+from pathlib import Path
+import sys
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+import models.definitions.ALR_FF as FF_models
+from models.definitions.transformer_model import Transformer
+from utils.constants import *
+from utils.data_utils import get_data_loaders, get_masks_and_count_tokens, get_src_and_trg_batches, DatasetType, LanguageDirection
+from utils.full_sentence_utils import mha_to_mha2
+from scripts.full_sentence.training_ALR import train_step
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
+
+"""
+Online distillation: instead of extracting the attention inputs/outputs to disk (extract_mha.py) and training one FF
+per layer from the stored values (training_ALR.py), the frozen baseline transformer is run on every batch and its
+attention inputs/outputs are captured with the same forward hooks as in extract_mha.py. They are turned into the
+inputs/labels/masks the collate functions of training_ALR.py produce and used right away to train the FF substitutes
+of all the chosen layers in the same step. The checkpoints use the same layout as training_ALR.py.
+
+"""
+
+def MAPE(target, output):
+    #Mean Absolute Percentage Error
+    with torch.no_grad():
+        relative_error = torch.abs(output - target) / torch.max(torch.abs(target), torch.ones(output.shape, device = device)*1e-32)
+        return torch.mean(relative_error)
+
+def token_mask(lengths, max_len = MAX_LEN):
+    # (B, max_len) True for the non-padded tokens
+    return torch.arange(max_len, device=lengths.device)[None, :] < lengths[:, None]
+
+def pad_to_max_len(batch, lengths):
+    # B x S x D -> B x MAX_LEN x D, the padded tokens are set to 0 as in the collate functions of training_ALR.py
+    batch = pad(batch, (0, 0, 0, MAX_LEN - batch.shape[1]))
+    return batch * token_mask(lengths).unsqueeze(-1)
+
+def heads_to_tokens(output):
+    # B x NH x S x HD -> B x S x (NH * HD)
+    return output.transpose(1, 2).reshape(output.shape[0], output.shape[2], -1)
+
+def encoder_batch(captured, src_lengths, trg_lengths):
+    # Same as collate_batch in training_ALR.py
+    _, _, v, output = captured
+    inputs = pad_to_max_len(v, src_lengths)
+    outputs = pad_to_max_len(heads_to_tokens(output), src_lengths)
+    masks = token_mask(src_lengths)
+    inputs = torch.reshape(inputs, (inputs.shape[0], inputs.shape[1]*inputs.shape[2]))
+    outputs = torch.reshape(outputs, (outputs.shape[0], outputs.shape[1]*outputs.shape[2]))
+    return inputs, outputs, masks
+
+def decoder_batch(captured, src_lengths, trg_lengths):
+    # Same as collate_batch_decoder in training_ALR.py
+    _, _, v, output = captured
+    inputs = pad_to_max_len(v, trg_lengths)
+    outputs = pad_to_max_len(heads_to_tokens(output), trg_lengths)
+    # B x T padding mask, the FF applies the no-look-forward part (see causal_prefix_forward)
+    return inputs, outputs, token_mask(trg_lengths)
+
+def decoder_ca_batch(captured, src_lengths, trg_lengths):
+    # Same as collate_batch_decoder_ca in training_ALR.py
+    q, _, v, output = captured
+    inputs_enc = pad_to_max_len(v, src_lengths)
+    inputs_dec = pad_to_max_len(q, trg_lengths)
+    outputs = pad_to_max_len(heads_to_tokens(output), trg_lengths)
+    trg_masks = token_mask(trg_lengths)
+    inputs_enc = torch.reshape(inputs_enc, (inputs_enc.shape[0], inputs_enc.shape[1]*inputs_enc.shape[2]))
+    inputs_dec = torch.reshape(inputs_dec, (inputs_dec.shape[0], inputs_dec.shape[1]*inputs_dec.shape[2]))
+    inputs = torch.cat([inputs_enc, inputs_dec], dim = 1)
+    outputs = torch.reshape(outputs, (outputs.shape[0], outputs.shape[1]*outputs.shape[2]))
+    return inputs, outputs, trg_masks
+
+def get_attention_modules(transformer, att_replacement):
+    if att_replacement == "encoder":
+        return [l.multi_headed_attention.attention for l in transformer.encoder.encoder_layers]
+    if att_replacement == "decoder":
+        return [l.trg_multi_headed_attention.attention for l in transformer.decoder.decoder_layers]
+    if att_replacement == "decoder_ca":
+        return [l.src_multi_headed_attention.attention for l in transformer.decoder.decoder_layers]
+    raise ValueError("ERROR: att_replacement must be encoder, decoder or decoder_ca.")
+
+def load_teacher(params):
+    train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        params['dataset_path'],
+        params['language_direction'],
+        params['dataset_name'],
+        params['batch_size'],
+        device,
+        max_len_train=MAX_LEN)
+
+    transformer = Transformer(
+        model_dimension=BASELINE_MODEL_DIMENSION,
+        src_vocab_size=len(src_field_processor.vocab),
+        trg_vocab_size=len(trg_field_processor.vocab),
+        number_of_heads=BASELINE_MODEL_NUMBER_OF_HEADS,
+        number_of_layers=BASELINE_MODEL_NUMBER_OF_LAYERS,
+        dropout_probability=BASELINE_MODEL_DROPOUT_PROB
+    ).to(device)
+    checkpoint = torch.load(params["path_to_weights"], map_location=device)
+    transformer.load_state_dict(checkpoint['state_dict'])
+    mha_to_mha2(transformer, attention_type = params["att_replacement"])
+    # the teacher is frozen
+    transformer.eval()
+    for p in transformer.parameters():
+        p.requires_grad = False
+    pad_token_id = src_field_processor.vocab.stoi[PAD_TOKEN]  # pad token id is the same for target as well
+    return transformer, train_token_ids_loader, pad_token_id
+
+def training_replacement_FF_online(params):
+    transformer, data_loader, pad_token_id = load_teacher(params)
+    make_batch = {"encoder": encoder_batch, "decoder": decoder_batch, "decoder_ca": decoder_ca_batch}[params["att_replacement"]]
+
+    FF_net = getattr(FF_models, params["substitute_class"])
+    print(f"Training model: {FF_net} for layers {params['layers']}")
+    models, optimizers = {}, {}
+    for layer in params["layers"]:
+        models[layer] = FF_net().to(device)
+        models[layer].train(True)
+        optimizers[layer] = Adam(models[layer].parameters(), lr=0.0001,betas=(0.9, 0.98), eps=1e-9)
+    print("FF models created")
+
+    # the hooks keep the (queries, keys, values, output) of the attention of every trained layer for the current batch
+    captured = {}
+    def getf(layer):
+        def capture_input_output(model, input, output):
+            captured[layer] = (input[0], input[1], input[2], output)
+        return capture_input_output
+    attention_modules = get_attention_modules(transformer, params["att_replacement"])
+    hook_handles = [attention_modules[layer].register_forward_hook(getf(layer)) for layer in params["layers"]]
+
+    mse_loss=nn.MSELoss()
+    for epoch in range(params['num_of_epochs']):
+        print("Epoch: ",epoch)
+        epoch_loss = {layer: 0 for layer in params["layers"]}
+        num_embeddings = {layer: 0 for layer in params["layers"]}
+        start = time.time()
+        for token_ids_batch in data_loader:
+            src_token_ids_batch, trg_token_ids_batch_input, _ = get_src_and_trg_batches(token_ids_batch)
+            src_mask, trg_mask, _, _ = get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch_input, pad_token_id, device)
+            src_lengths = (src_token_ids_batch != pad_token_id).sum(dim=1)
+            trg_lengths = (trg_token_ids_batch_input != pad_token_id).sum(dim=1)
+
+            # run the teacher, the activations of all the layers are captured by the hooks
+            with torch.no_grad():
+                if params["att_replacement"] == "encoder":
+                    transformer.encode(src_token_ids_batch, src_mask)
+                else:
+                    transformer.forward(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask)
+
+            for layer in params["layers"]:
+                with torch.no_grad():
+                    data, label, mask = make_batch(captured[layer], src_lengths, trg_lengths)
+                # same step as the offline training, so that the logged losses are comparable
+                batch_loss, batch_embeddings, _ = train_step(models[layer], optimizers[layer], mse_loss, data, label, mask)
+                epoch_loss[layer]+=batch_loss
+                num_embeddings[layer]+=batch_embeddings
+            captured.clear()
+
+        for layer in params["layers"]:
+            if epoch % 20 == 0:
+                ckpt_model_name = ALR_CHECKPOINT_FORMAT.format(epoch+1, layer)
+                torch.save(models[layer].state_dict(), os.path.join(params["checkpoints_folder"], f"layer{layer}", ckpt_model_name))
+            print(f"Layer {layer}: loss per embedding element:{epoch_loss[layer]/num_embeddings[layer]}")
+        print(f"Epoch time: {time.time() - start}")
+
+    for h in hook_handles:
+        h.remove()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_of_epochs", type=int, help="number of training epochs", default=21)
+    parser.add_argument("--batch_size", type=int, help="target number of tokens in a src/trg batch", default=1500)
+
+    # Data related args
+    parser.add_argument("--dataset_name", choices=[el.name for el in DatasetType], help='which dataset to use for training', default=DatasetType.IWSLT.name)
+    parser.add_argument("--language_direction", choices=[el.name for el in LanguageDirection], help='which direction to translate', default=LanguageDirection.de_en.name)
+    parser.add_argument("--dataset_path", type=str, help='download dataset to this path', default=DATA_DIR_PATH)
+    parser.add_argument("--path_to_weights", type=str, help="path to the weights of the trained transformer", required=True)
+
+    # Params to set
+    parser.add_argument("--layers", type=int, nargs="+", help="layers whose attention is replaced", default=list(range(BASELINE_MODEL_NUMBER_OF_LAYERS)))
+    parser.add_argument("--substitute_class", type = str, help="name of the FF to train defined in models/definitions/ALR.py", required=True)
+    parser.add_argument("--att_replacement", help = "Which attention to replace", choices = ["encoder", "decoder", "decoder_ca"], default = "encoder")
+    args = parser.parse_args()
+    # Wrapping training configuration into a dictionary
+    training_config = dict()
+    for arg in vars(args):
+        training_config[arg] = getattr(args, arg)
+    print("Training arguments parsed")
+    training_config["checkpoints_folder"] = os.path.join(CHECKPOINTS_SCRATCH,"ALR", training_config["substitute_class"])
+    for layer in training_config["layers"]:
+        os.makedirs(os.path.join(training_config["checkpoints_folder"], f"layer{layer}"), exist_ok = True)
+    print(training_config)
+    training_replacement_FF_online(training_config)
@@ -1,4 +1,3 @@
-from pickle import UnpicklingError
 import argparse
 import os
 import time
@@ -19,6 +18,8 @@ sys.path.append(str(path_root))
 from utils.constants import MHA_SEPARATE_CHECKPOINT_FORMAT, SCRATCH, MAX_LEN, CHECKPOINTS_SCRATCH
 import models.definitions.ALSR_FF as nets
 from utils.data_utils import LanguageDirection
+from utils.activation_store import ActivationStore
+from utils.precision_utils import PRECISIONS, autocast, report_loss_parity
 
 DATA_PATH=os.path.join(SCRATCH,"pytorch-original-transformer", "mha_outputs")
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
@@ -32,10 +33,8 @@ def MAPE(target, output):
 def prepare_data(data_path, language_direction, head = 0, chosen_layer = 0, batch_size = 5, t = "train", dev = False):
     if t not in ["train", "test", "val"]:
         raise ValueError("ERROR: t must be train, test, or val.")
-    in_path =   os.path.join(data_path, "encoder", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_v_inputs_{t}")
-    out_path =  os.path.join(data_path, "encoder", f"128emb_20ep_IWSLT_{language_direction}_layer{chosen_layer}_outputs_{t}")
-    mask_path = os.path.join(data_path, "encoder", f"128emb_20ep_IWSLT_{language_direction}_masks_{t}")
-    dataset = SeparateHeadsDataset(in_path, out_path, mask_path, head, MAX_LEN)
+    store_path = os.path.join(data_path, "encoder", f"128emb_20ep_IWSLT_{language_direction}_{t}.store")
+    dataset = SeparateHeadsDataset(store_path, chosen_layer, head, MAX_LEN)
     print("Training head {0}".format(head))
     if dev:
         dataset, _ = dataset = random_split(dataset, [0.2, 0.8])
@@ -61,13 +60,16 @@ def training_replacement_FF(params):
             num_embeddings=0
             mapes = []
             start = time.time()
-            for (data,label, mask) in data_loader:
+            for batch_idx, (data,label, mask) in enumerate(data_loader):
+                if batch_idx == 0:
+                    report_loss_parity(lambda: mse_loss(label, model(data, mask)), params["precision"], device, model)
                 lr_optimizer.zero_grad()
-                pred=model(data,mask)
-                with torch.no_grad():
-                    num_embeddings+=torch.sum(torch.flatten(mask)).item()
-                    loss_normalizer=torch.sum(torch.flatten(mask)).item()/(mask.shape[0]*mask.shape[1])
-                loss=mse_loss(label,pred)/loss_normalizer
+                with autocast(params["precision"], device):
+                    pred=model(data,mask)
+                    with torch.no_grad():
+                        num_embeddings+=torch.sum(torch.flatten(mask)).item()
+                        loss_normalizer=torch.sum(torch.flatten(mask)).item()/(mask.shape[0]*mask.shape[1])
+                    loss=mse_loss(label,pred)/loss_normalizer
                 loss.backward()
                 lr_optimizer.step()
                 with torch.no_grad():
@@ -80,81 +82,38 @@ def training_replacement_FF(params):
 
 class SeparateHeadsDataset(torch.utils.data.Dataset):
     # NOTE: added h to specify which head to use
-    def __init__(self, input_path, output_path, mask_path, h, n, t = "max"):
-        print(f"Starting to load datasets from {input_path} and {output_path} and {mask_path}")
+    def __init__(self, store_path, layer, h, n, t = "max"):
+        print(f"Starting to load dataset of layer {layer} from {store_path}")
         start = time.time()
 
         self.n = n
         if t != "max" and t != "exact":
             raise ValueError("ERROR: t has to be either 'max' or 'exact'.")
         self.t = t
-        self.input = []
-        self.output = []
-        if t == "max":
-            self.mask = []
-            mask_cache = f"{mask_path}_h_{h}_fixed_{n}_{t}.cache"
-
-        in_cache = f"{input_path}_h_{h}_fixed_{n}_{t}.cache"
-        out_cache = f"{output_path}_h_{h}_fixed_{n}_{t}.cache"
-
-        if os.path.exists(in_cache) and os.path.exists(out_cache) and (t == "exact" or os.path.exists(mask_cache)):
-            self.input = torch.load(in_cache)
-            self.output = torch.load(out_cache)
-            if t == "max":
-                self.mask = torch.load(mask_cache)
-                print(f"Finished loading mask dataset from cache {mask_cache}")
-            print(f"Finished loading datasets from cache {in_cache} and {out_cache}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-            return
-
-        inf = open(input_path, "rb")
-        outf = open(output_path, "rb")
-        maskf = open(mask_path, "rb")
-        try:
-            while(True):
-                # i represents one batch of sentences -> dim: batch size x padded sentence length x embedding size
-                i = torch.from_numpy(np.load(inf))
-                m = torch.from_numpy(np.load(maskf))
-                m = torch.squeeze(m, dim=1)
-                m = torch.squeeze(m, dim=1)
-                o = torch.from_numpy(np.load(outf))
-                l = torch.sum(m, dim = 1)
-                for j in range(i.shape[0]):
-                    if t == "max":
-                        if l[j] <= n:
-                            self.input.append(i[j, :l[j]])
-                            self.output.append(o[j,h,:l[j]])
-                            self.mask.append(m[j, :l[j]])
-                    else:
-                        if l[j] == n:
-                            self.input.append(i[j,h ,:l[j]])
-                            self.output.append(o[j, :l[j]])
-        except (UnpicklingError, ValueError):
-            print(f"Finished loading datasets from {input_path} and {output_path}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-        finally:
-            inf.close()
-            outf.close()
-            maskf.close()
-        # self.input = torch.cat(self.input, dim=0)
-        # self.output = torch.cat(self.output, dim=0)
-        torch.save(self.input, in_cache)
-        torch.save(self.output, out_cache)
-        if t == "max":
-            # self.mask = torch.cat(self.mask, dim=0)
-            torch.save(self.mask, mask_cache)
+        self.h = h
+        self.store = ActivationStore(store_path)
+        self.in_field = f"layer{layer}_v_inputs"
+        self.out_field = f"layer{layer}_outputs"
+        self.lengths = self.store.metadata("src_lengths")
+        self.indices = np.nonzero(self.lengths <= n)[0] if t == "max" else np.nonzero(self.lengths == n)[0]
+        print(f"Loaded {len(self.indices)} samples in {time.time() - start}s")
 
     def __len__(self):
-        return len(self.input)
+        return len(self.indices)
 
     def __getitem__(self, idx):
+        j = self.indices[idx]
+        l = int(self.lengths[j])
+        inputs = torch.from_numpy(np.asarray(self.store.get(self.in_field, j), dtype=np.float32))
+        # outputs are stored as S x NH x HD, keep only the selected head
+        outputs = torch.from_numpy(np.asarray(self.store.get(self.out_field, j)[:, self.h], dtype=np.float32))
         # if we have exactly the same length, there is no need for padding/masking
         if self.t == "exact":
-            return (self.input[idx], self.output[idx])
-        return (self.input[idx], self.output[idx], self.mask[idx])
+            return (inputs, outputs)
+        return (inputs, outputs, torch.ones(l, dtype=torch.bool))
 
     def emb_size(self):
-        return self.input.shape[1]
+        return self.store.feature_shape(self.in_field)[-1]
     
 def pad_shape(batch, masks = False):
     shape = batch.shape
@@ -199,6 +158,7 @@ if __name__ == "__main__":
     parser.add_argument("--dataset_path", type=str, help='download dataset to this path', default=DATA_PATH)
     parser.add_argument("--model_dimension", type=str, help='embedding size', default=128)
     parser.add_argument("--batch_size", type=str, help='batch_size', default=2000)
+    parser.add_argument("--precision", choices=PRECISIONS, help="fp32, or bf16 autocast for the forward passes (see utils/precision_utils.py)", default="fp32")
     
     # Params to set when running the script
     parser.add_argument("--num_of_curr_trained_layer", type=str, help='num_of_curr_trained_layer', default=5)
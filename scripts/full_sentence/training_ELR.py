@@ -2,7 +2,6 @@ import os
 import argparse
 import time
 
-from pickle import UnpicklingError
 import numpy as np
 import torch
 import torch.nn as nn
@@ -19,7 +18,10 @@ sys.path.append(str(path_root))
 
 from utils.constants import ALR_CHECKPOINT_FORMAT, SCRATCH, MAX_LEN,CHECKPOINTS_SCRATCH
 import models.definitions.ELR_FF as nets
+from models.definitions.low_rank_FF import get_substitute_class
 from utils.data_utils import LanguageDirection
+from utils.activation_store import ActivationStore
+from utils.precision_utils import PRECISIONS, autocast, report_loss_parity
 
 DATA_PATH=os.path.join(SCRATCH, "pytorch-original-transformer","layer_outputs")
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
@@ -33,16 +35,14 @@ def MAPE(target, output):
 def prepare_data(data_path, language_direction, chosen_layer = 0, batch_size = 5, t = "train", dev = False):
     if t not in ["train", "test", "val"]:
         raise ValueError("ERROR: t must be train, test, or val.")
-    in_path =   os.path.join(data_path,f"128emb_20ep_IWSLT_{language_direction}_ELR_layer{chosen_layer}_inputs_{t}")
-    out_path =  os.path.join(data_path,f"128emb_20ep_IWSLT_{language_direction}_ELR_layer{chosen_layer}_outputs_{t}")
-    mask_path = os.path.join(data_path,f"128emb_20ep_IWSLT_{language_direction}_masks_{t}")
-    dataset = AttentionDataset(in_path, out_path, mask_path, MAX_LEN)
+    store_path = os.path.join(data_path, f"128emb_20ep_IWSLT_{language_direction}_{t}.store")
+    dataset = AttentionDataset(store_path, f"ELR_layer{chosen_layer}", MAX_LEN)
     if dev:
         dataset, _ = dataset = random_split(dataset, [0.2, 0.8])
     return DataLoader(dataset,  collate_fn=collate_batch, batch_size= batch_size)
     
 def training_replacement_FF(params):
-    FF_net = getattr(nets, params["substitute_class"])
+    FF_net = get_substitute_class(nets, params["substitute_class"])
     print(f"Training model: {FF_net}")
     model=FF_net().to(device)
     model.train(True)
@@ -57,13 +57,16 @@ def training_replacement_FF(params):
         num_embeddings=0
         mapes = []
         start = time.time()
-        for (data,label, mask) in data_loader:
+        for batch_idx, (data,label, mask) in enumerate(data_loader):
+            if batch_idx == 0:
+                report_loss_parity(lambda: mse_loss(label, model(data, mask)), params["precision"], device, model)
             lr_optimizer.zero_grad()
-            pred=model(data,mask)
-            with torch.no_grad():
-                num_embeddings+=torch.sum(torch.flatten(mask)).item()
-                loss_normalizer=torch.sum(torch.flatten(mask)).item()/(mask.shape[0]*mask.shape[1])
-            loss=mse_loss(label,pred)/loss_normalizer
+            with autocast(params["precision"], device):
+                pred=model(data,mask)
+                with torch.no_grad():
+                    num_embeddings+=torch.sum(torch.flatten(mask)).item()
+                    loss_normalizer=torch.sum(torch.flatten(mask)).item()/(mask.shape[0]*mask.shape[1])
+                loss=mse_loss(label,pred)/loss_normalizer
             loss.backward()
             lr_optimizer.step()
             with torch.no_grad():
@@ -75,81 +78,39 @@ def training_replacement_FF(params):
         print(f"Loss per embedding element:{epoch_loss/num_embeddings}, MAPE: {MAPE(label, pred)}, time: {time.time() - start}")
 
 class AttentionDataset(torch.utils.data.Dataset):
-    def __init__(self, input_path, output_path, mask_path, n, t = "max"):
-        print(f"Starting to load datasets from {input_path} and {output_path} and {mask_path}")
+    def __init__(self, store_path, field_prefix, n, t = "max"):
+        print(f"Starting to load dataset {field_prefix} from {store_path}")
         start = time.time()
 
         self.n = n
         if t != "max" and t != "exact":
             raise ValueError("ERROR: t has to be either 'max' or 'exact'.")
         self.t = t
-        self.input = []
-        self.output = []
-        if t == "max":
-            self.mask = []
-            mask_cache = f"{mask_path}_fixed_{n}_{t}.cache"
-
-        in_cache = f"{input_path}_fixed_{n}_{t}.cache"
-        out_cache = f"{output_path}_fixed_{n}_{t}.cache"
-
-        if os.path.exists(in_cache) and os.path.exists(out_cache) and (t == "exact" or os.path.exists(mask_cache)):
-            self.input = torch.load(in_cache)
-            self.output = torch.load(out_cache)
-            if t == "max":
-                self.mask = torch.load(mask_cache)
-                print(f"Finished loading mask dataset from cache {mask_cache}")
-            print(f"Finished loading datasets from cache {in_cache} and {out_cache}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-            return
-
-        inf = open(input_path, "rb")
-        outf = open(output_path, "rb")
-        maskf = open(mask_path, "rb")
-        try:
-            while(True):
-                # i represents one batch of sentences -> dim: batch size x padded sentence length x embedding size
-                i = torch.from_numpy(np.load(inf))
-                m = torch.from_numpy(np.load(maskf))
-                m = torch.squeeze(m, dim=1)
-                m = torch.squeeze(m, dim=1)
-                o = torch.from_numpy(np.load(outf))
-                l = torch.sum(m, dim = 1)
-                for j in range(i.shape[0]):
-                    if t == "max":
-                        if l[j] <= n:
-                            self.input.append( i[ j, : l[j] ] )
-                            self.output.append(o[ j, : l[j] ] )
-                            self.mask.append(  m[ j, : l[j] ] )
-                    else:
-                        if l[j] == n:
-                            self.input.append(i[j, :l[j]])
-                            self.output.append(o[j, :l[j]])
-        except (UnpicklingError, ValueError):
-            print(f"Finished loading datasets from {input_path} and {output_path}")
-            print(f"Loaded {len(self.output)} samples in {time.time() - start}s")
-        finally:
-            inf.close()
-            outf.close()
-            maskf.close()
-        # self.input = torch.cat(self.input, dim=0)
-        # self.output = torch.cat(self.output, dim=0)
-        torch.save(self.input, in_cache)
-        torch.save(self.output, out_cache)
+        self.store = ActivationStore(store_path)
+        self.in_field = f"{field_prefix}_inputs"
+        self.out_field = f"{field_prefix}_outputs"
+        self.lengths = self.store.metadata("src_lengths")
         if t == "max":
-            # self.mask = torch.cat(self.mask, dim=0)
-            torch.save(self.mask, mask_cache)
+            self.indices = np.nonzero(self.lengths <= n)[0]
+        else:
+            self.indices = np.nonzero(self.lengths == n)[0]
+        print(f"Loaded {len(self.indices)} samples in {time.time() - start}s")
 
     def __len__(self):
-        return len(self.input)
+        return len(self.indices)
 
     def __getitem__(self, idx):
+        j = self.indices[idx]
+        # records only hold the non-padded tokens of the sentence
+        inputs = torch.from_numpy(np.asarray(self.store.get(self.in_field, j), dtype=np.float32))
+        outputs = torch.from_numpy(np.asarray(self.store.get(self.out_field, j), dtype=np.float32))
         # if we have exactly the same length, there is no need for padding/masking
         if self.t == "exact":
-            return (self.input[idx], self.output[idx])
-        return (self.input[idx], self.output[idx], self.mask[idx])
+            return (inputs, outputs)
+        return (inputs, outputs, torch.ones(inputs.shape[0], dtype=torch.bool))
 
     def emb_size(self):
-        return self.input.shape[1]
+        return self.store.feature_shape(self.in_field)[-1]
     
 def pad_shape(batch, masks = False):
     shape = batch.shape
@@ -180,6 +141,7 @@ if __name__ == "__main__":
     parser.add_argument("--model_dimension", type=str, help='embedding size', default=128)
     parser.add_argument("--num_of_curr_trained_layer", type=str, help='num_of_curr_trained_layer', default=0)
     parser.add_argument("--batch_size", type=str, help='batch_size', default=2000)
+    parser.add_argument("--precision", choices=PRECISIONS, help="fp32, or bf16 autocast for the forward passes (see utils/precision_utils.py)", default="fp32")
     parser.add_argument("--substitute_class", type = str, help="name of the FF to train defined in models/definitions/ALR.py", required=True)
     parser.add_argument("--language_direction", choices=[el.name for el in LanguageDirection], help='which direction to translate', default=LanguageDirection.de_en.name)
     
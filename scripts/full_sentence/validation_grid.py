@@ -0,0 +1,154 @@
+import argparse
+import json
+import time
+
+import torch
+
+
+# Local imports
+from pathlib import Path
+import sys
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from models.definitions.transformer_model import Transformer
+from utils.data_utils import get_data_loaders, DatasetType, LanguageDirection
+from utils.decoding_utils import DecodingMethod
+from utils.full_sentence_utils import substitute_from_config, SUBSTITUTION_CONFIG_SUFFIXES
+import utils.utils as utils
+from utils.constants import *
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
+
+"""
+Evaluates a grid of substitution configurations in a single process. The data loaders and the baseline weights are
+loaded only once and every configuration gets a fresh copy of the baseline. The encoder outputs of the configurations
+which don't substitute the encoder are computed once and reused, so that evaluating several decoder substitutes only
+runs the decoders. At the end one BLEU table is printed (and optionally written as csv).
+
+The grid is a json file with a list of configurations, each one a dictionary with the arguments of
+validation_script.py (missing keys take the same defaults) and an optional name, e.g.
+[
+    {"name": "baseline"},
+    {"substitute_type": "ALR", "substitute_class": "FFNetwork_L", "epoch": 21},
+    {"substitute_type_d": "ALR", "substitute_class_d": "FFNetwork_decoder_L", "layers_d": [0, 1]}
+]
+
+"""
+
+def describe(config, suffix):
+    substitute_type = config.get("substitute_type" + suffix, "None")
+    if substitute_type == "None":
+        return "-"
+    layers = config.get("layers" + suffix)
+    layers = "all" if layers is None else ",".join(str(l) for l in layers)
+    return f"{substitute_type} {config.get('substitute_class' + suffix, 'FFNetwork_L')} layers={layers} epoch={config.get('epoch' + suffix, 21)}"
+
+def print_table(results):
+    header = ["name"] + list(SUBSTITUTION_CONFIG_SUFFIXES) + ["BLEU", "time (s)"]
+    rows = [header] + [[r["name"]] + [r[att] for att in SUBSTITUTION_CONFIG_SUFFIXES] + [f"{r['bleu']:.4f}", f"{r['time']:.1f}"] for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for j, row in enumerate(rows):
+        print(" | ".join(cell.ljust(w) for cell, w in zip(row, widths)))
+        if j == 0:
+            print("-+-".join("-" * w for w in widths))
+
+def evaluate_grid(grid_config):
+    with open(grid_config["grid"]) as f:
+        configurations = json.load(f)
+
+    # Step 1: Prepare data loaders, once for all the configurations
+    train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        grid_config['dataset_path'],
+        grid_config['language_direction'],
+        grid_config['dataset_name'],
+        grid_config['batch_size'],
+        device)
+    src_vocab_size = len(src_field_processor.vocab)
+    trg_vocab_size = len(trg_field_processor.vocab)
+    # reloading the data, filtering sentences of len>50: the vocab is built on the filtered train split, as the one the
+    # baseline was trained with (see training_script.py)
+    train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        grid_config['dataset_path'],
+        grid_config['language_direction'],
+        grid_config['dataset_name'],
+        grid_config['batch_size'],
+        device,
+        max_len_train=MAX_LEN)
+    # Every configuration sees the same batches in the same order, needed to reuse the encoder outputs
+    val_batches = list(val_token_ids_loader)
+
+    # Step 2: Load the weights of the baseline once
+    model_path = os.path.join(BINARIES_PATH, grid_config['model_name'])
+    baseline_state = torch.load(model_path, map_location=device)["state_dict"]
+
+    # precision -> batch index -> encoder outputs
+    encoder_outputs = {}
+    results = []
+    for i, config in enumerate(configurations):
+        name = config.get("name", f"config{i}")
+        print("#"*100)
+        print(f"\n\t CONFIGURATION {name}: {config}\n")
+        print("#"*100)
+
+        # Step 3: fresh copy of the baseline, the substitutions modify the model in place
+        baseline_transformer = Transformer(
+            model_dimension=BASELINE_MODEL_DIMENSION,
+            src_vocab_size=src_vocab_size,
+            trg_vocab_size=trg_vocab_size,
+            number_of_heads=BASELINE_MODEL_NUMBER_OF_HEADS,
+            number_of_layers=BASELINE_MODEL_NUMBER_OF_LAYERS,
+            dropout_probability=BASELINE_MODEL_DROPOUT_PROB
+        ).to(device)
+        baseline_transformer.load_state_dict(baseline_state, strict=True)
+        baseline_transformer.eval()
+        substitute_from_config(baseline_transformer, config)
+        precision = config.get("precision", "fp32")
+
+        # Step 4: Compute BLEU, the encoder outputs are shared by the configurations which keep the baseline encoder
+        # and use the same precision
+        start = time.time()
+        with torch.no_grad():
+            bleu_score = utils.calculate_bleu_score(baseline_transformer, val_batches, trg_field_processor,
+                                                    decoding_method = DecodingMethod[grid_config["decoding_method"]],
+                                                    beam_size = grid_config["beam_size"],
+                                                    length_penalty_coefficient = grid_config["length_penalty_coefficient"],
+                                                    encoder_outputs = encoder_outputs.setdefault(precision, {}) if config.get("substitute_type", "None") == "None" else None,
+                                                    precision = precision)
+        result = {"name": name, "bleu": bleu_score, "time": time.time() - start}
+        for att_replacement, suffix in SUBSTITUTION_CONFIG_SUFFIXES.items():
+            result[att_replacement] = describe(config, suffix)
+        results.append(result)
+        del baseline_transformer
+
+    print_table(results)
+    if grid_config["output_path"] is not None:
+        with open(grid_config["output_path"], "w") as f:
+            f.write(",".join(["name"] + list(SUBSTITUTION_CONFIG_SUFFIXES) + ["bleu", "time"]) + "\n")
+            for r in results:
+                f.write(",".join([r["name"]] + [r[att] for att in SUBSTITUTION_CONFIG_SUFFIXES] + [str(r["bleu"]), str(r["time"])]) + "\n")
+        print(f"BLEU table written to {grid_config['output_path']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", type=str, help="json file with the list of configurations to evaluate", required=True)
+    parser.add_argument("--output_path", type=str, help="csv file where the BLEU table is written", default=None)
+    parser.add_argument("--model_name", type=str, help="transformer model name", default=r'Transformer_None_None_20.pth')
+
+    # Keep these 2 in sync with the model you pick via model_name
+    parser.add_argument("--dataset_name", type=str, choices=['IWSLT', 'WMT14'], help='which dataset to use for training', default=DatasetType.IWSLT.name)
+    parser.add_argument("--language_direction", type=str, choices=[el.name for el in LanguageDirection], help='which direction to translate', default=LanguageDirection.de_en.name)
+
+    # Cache files and datasets are downloaded here during training, keep them in sync for speed
+    parser.add_argument("--dataset_path", type=str, help='download dataset to this path', default=DATA_DIR_PATH)
+    parser.add_argument("--batch_size", type=int, help="target number of tokens in a src/trg batch", default=1500)
+    parser.add_argument("--decoding_method", type=str, choices=[el.name for el in DecodingMethod], help="decoding used to compute the BLEU score", default=DecodingMethod.GREEDY.name)
+    parser.add_argument("--beam_size", type=int, help="number of hypotheses per sentence kept by the beam search", default=4)
+    parser.add_argument("--length_penalty_coefficient", type=float, help="exponent of the length penalty of the beam search", default=0.6)
+    args = parser.parse_args()
+    # Wrapping configuration into a dictionary
+    grid_config = dict()
+    for arg in vars(args):
+        grid_config[arg] = getattr(args, arg)
+    print(grid_config)
+    evaluate_grid(grid_config)
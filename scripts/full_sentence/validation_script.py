@@ -1,4 +1,5 @@
 import argparse
+import time
 
 import torch
 
@@ -11,7 +12,10 @@ sys.path.append(str(path_root))
 
 from models.definitions.transformer_model import Transformer
 from utils.data_utils import get_data_loaders, DatasetType, LanguageDirection
-from utils.full_sentence_utils import substitute_attention
+from utils.full_sentence_utils import substitute_from_config
+from utils.decoding_utils import DecodingMethod
+from utils.precision_utils import PRECISIONS
+from utils.quantization_utils import QUANTIZATION_MODES, check_quantization, quantize_transformer, save_quantized, load_quantized, state_dict_size
 import utils.utils as utils
 from utils.constants import *
 
@@ -47,49 +51,13 @@ def evaluate_transformer(evaluate_config):
     
      
     # Step 3: substitute attention
-    if evaluate_config["substitute_type"] != "None":
-        substitute_attention(baseline_transformer, 
-                             evaluate_config["substitute_class"], 
-                             evaluate_config["substitute_model_path"], 
-                             evaluate_config["layers"],
-                             evaluate_config["epoch"],
-                             evaluate_config["substitute_type"],
-                             "encoder",
-                             untrained = evaluate_config["untrained"]) 
-    else:
-        print("#"*100)
-        print("\n\t NO SUBSTITUTION IN ENCODER\n")
-        print("#"*100)
-        
-    if evaluate_config["substitute_type_d"] != "None":
-        substitute_attention(baseline_transformer, 
-                             evaluate_config["substitute_class_d"], 
-                             evaluate_config["substitute_model_path_d"], 
-                             evaluate_config["layers_d"],
-                             evaluate_config["epoch_d"],
-                             evaluate_config["substitute_type_d"],
-                             "decoder",
-                             untrained = evaluate_config["untrained"])
-    else:
-        print("#"*100)
-        print("\n\t NO SUBSTITUTION IN DECODER\n")
-        print("#"*100)
-
-
-    if evaluate_config["substitute_type_d_ca"] != "None":
-        substitute_attention(baseline_transformer, 
-                             evaluate_config["substitute_class_d_ca"], 
-                             evaluate_config["substitute_model_path_d_ca"], 
-                             evaluate_config["layers_d_ca"],
-                             evaluate_config["epoch_d_ca"],
-                             evaluate_config["substitute_type_d_ca"],
-                             "decoder_ca",
-                             untrained = evaluate_config["untrained"])
-    else:
-        print("#"*100)
-        print("\n\t NO SUBSTITUTION IN DECODER CROSS ATTENTION\n")
-        print("#"*100)
-        
+    substitute_from_config(baseline_transformer, evaluate_config)
+    if evaluate_config["fuse_qkv"]:
+        # packed q/k/v projections and fused attention kernel for the attentions which were not substituted
+        baseline_transformer.fuse_qkv()
+
+    # reloading the data, filtering sentences of len>50: the vocab is built on the filtered train split, as the one the
+    # baseline was trained with (see training_script.py)
     train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
         evaluate_config['dataset_path'],
         evaluate_config['language_direction'],
@@ -97,9 +65,35 @@ def evaluate_transformer(evaluate_config):
         evaluate_config['batch_size'],
         device,
         max_len_train=MAX_LEN)
+
     # Step 4: Compute BLEU
-    with torch.no_grad():
-        utils.calculate_bleu_score(baseline_transformer, val_token_ids_loader, trg_field_processor)
+    def compute_bleu():
+        start = time.time()
+        with torch.no_grad():
+            bleu_score = utils.calculate_bleu_score(baseline_transformer, val_token_ids_loader, trg_field_processor,
+                                                    decoding_method = DecodingMethod[evaluate_config["decoding_method"]],
+                                                    beam_size = evaluate_config["beam_size"],
+                                                    length_penalty_coefficient = evaluate_config["length_penalty_coefficient"],
+                                                    precision = evaluate_config["precision"])
+        return bleu_score, time.time() - start
+
+    bleu_score, decoding_time = compute_bleu()
+
+    # Step 5: int8 dynamic quantization, compared with the fp32 model of step 4
+    if evaluate_config["quantize"] != "None":
+        size = state_dict_size(baseline_transformer)
+        quantize_transformer(baseline_transformer, evaluate_config["quantize"])
+        if evaluate_config["load_quantized"] is not None:
+            print(f"Loading quantized weights from {evaluate_config['load_quantized']}")
+            load_quantized(baseline_transformer, evaluate_config["load_quantized"])
+        if evaluate_config["save_quantized"] is not None:
+            save_quantized(baseline_transformer, evaluate_config["save_quantized"])
+            print(f"Quantized weights saved in {evaluate_config['save_quantized']}")
+        quantized_size = state_dict_size(baseline_transformer)
+        quantized_bleu_score, quantized_decoding_time = compute_bleu()
+        print(f"int8 ({evaluate_config['quantize']}) vs fp32: BLEU-4 {quantized_bleu_score:.4f} vs {bleu_score:.4f} (delta {quantized_bleu_score - bleu_score:+.4f}), "
+              f"decoding time {quantized_decoding_time:.1f} vs {decoding_time:.1f} seconds (speedup {decoding_time / quantized_decoding_time:.2f}), "
+              f"weights {quantized_size:.1f} vs {size:.1f} MB")
 
 if __name__ == "__main__":
     #
@@ -118,6 +112,14 @@ if __name__ == "__main__":
     # Cache files and datasets are downloaded here during training, keep them in sync for speed
     parser.add_argument("--dataset_path", type=str, help='download dataset to this path', default=DATA_DIR_PATH)
     parser.add_argument("--batch_size", type=int, help="target number of tokens in a src/trg batch", default=1500)
+    parser.add_argument("--decoding_method", type=str, choices=[el.name for el in DecodingMethod], help="decoding used to compute the BLEU score", default=DecodingMethod.GREEDY.name)
+    parser.add_argument("--beam_size", type=int, help="number of hypotheses per sentence kept by the beam search", default=4)
+    parser.add_argument("--length_penalty_coefficient", type=float, help="exponent of the length penalty of the beam search", default=0.6)
+    parser.add_argument("--fuse_qkv", action = "store_true", help = "use the packed q/k/v projection and the fused attention kernel in the attentions that are not substituted")
+    parser.add_argument("--precision", choices=PRECISIONS, help="fp32, or bf16 autocast for the decoding, the Linear weights of the substitutes are stored in bf16 (see utils/precision_utils.py)", default="fp32")
+    parser.add_argument("--quantize", choices=QUANTIZATION_MODES, help="CPU only: after the fp32 evaluation, quantize the Linears of the substitutes (or of the whole model with all) to int8 and evaluate again", default="None")
+    parser.add_argument("--save_quantized", type=str, help="file where the quantized weights are saved", default=None)
+    parser.add_argument("--load_quantized", type=str, help="quantized weights saved with --save_quantized for the same substitutions and --quantize mode", default=None)
     
     # Params for encoder substitution
     parser.add_argument("--substitute_class", type=str, help="class that substitutes attention e.g. FFNetwork_L", default = "FFNetwork_L")
@@ -126,6 +128,10 @@ if __name__ == "__main__":
     parser.add_argument("--epoch", type = int, help="Epoch checkpoint to use.", default = 21)
     parser.add_argument("--untrained", action = "store_true")
     parser.add_argument("--substitute_type", type = str, help="Type of approach to use for substitution", choices=["ALR", "ELR", "ALRR", "ALSR", "None"], default="None")
+    parser.add_argument("--fused_heads", action = "store_true", help = "ALSR only: evaluate the FFs of the 8 heads of a layer with batched matmuls")
+    parser.add_argument("--length_adaptive", action = "store_true", help = "ALR, ALRR and ELR: run the FFs on the tokens of the batch instead of padding every sentence to MAX_LEN")
+    parser.add_argument("--block_sparse", action = "store_true", help = "run the Linears of pruned substitutes (see training_ALR.py --prune_sparsity) with block-sparse matmuls, --substitute_model_path must point to the pruned checkpoints e.g. CHECKPOINTS_SCRATCH/ALR/FFNetwork_XL_block_sparse90")
+    parser.add_argument("--block_size", type=int, nargs=2, help="out x in block size of the block-sparse format, the one used for pruning", default=[32, 32])
     
     # Params for decoder substitution
     parser.add_argument("--substitute_class_d", type=str, help="class that substitutes attention e.g. FFNetwork_L", default="None")
@@ -145,6 +151,14 @@ if __name__ == "__main__":
 
     # Decoding related args
     args = parser.parse_args()
+    if args.quantize != "None" and args.precision != "fp32":
+        parser.error("--quantize evaluates the int8 model against the fp32 one, use it with --precision fp32")
+    if args.quantize != "None":
+        # fail before the data loading and the fp32 evaluation rather than after them
+        try:
+            check_quantization(device)
+        except ValueError as error:
+            parser.error(str(error))
     # Wrapping training configuration into a dictionary
     evaluate_config = dict()
     for arg in vars(args):
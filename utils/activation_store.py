@@ -0,0 +1,411 @@
+"""
+    Sharded, memory-mapped storage for the activations extracted from the transformer.
+
+    A store is a directory holding any number of named fields. Every field contains one record per sentence and a
+    record is an array of shape (R, *F) where R is the number of stored token rows of that sentence and F is the
+    per-token feature shape (e.g. (MD,) for inputs or (NH, HD) for the outputs of the attention).
+    All the fields of a store share the same record numbering, so record j of every field belongs to sentence j.
+
+    Layout on disk:
+        meta.json              - dtype, feature shape and shard sizes of every field, aliases between fields
+        index.npz              - per field: shard id, row offset inside the shard and number of rows of every record
+                                 plus per-sentence metadata arrays (e.g. src_lengths, trg_lengths)
+        <field>.<shard>.bin    - raw contiguous (rows, *F) arrays, opened with np.memmap
+
+    While a store is being written, the index and the metadata are appended to raw files next to the shards and a
+    progress manifest (progress.json) records how much of every file belongs to committed batches, so that an
+    interrupted extraction can resume from its last commit. Closing the writer turns them into index.npz/meta.json.
+
+    A field can also be an alias of another field holding exactly the same data (e.g. the queries, keys and values of a
+    self-attention), aliases are listed in meta.json and resolved by the reader, no data is written for them.
+
+    Records never straddle two shards, so reading a record is a single slice of a memory-mapped file. This makes
+    random access cheap and lets several processes (e.g. DataLoader workers) read the same store in parallel.
+
+"""
+
+
+import os
+import json
+
+import numpy as np
+
+
+STORE_META_FILE = "meta.json"
+STORE_INDEX_FILE = "index.npz"
+STORE_PROGRESS_FILE = "progress.json"
+STORE_VERSION = 1
+DEFAULT_SHARD_ROWS = 1 << 20  # number of token rows in a shard, ~512MB for fp32 128-dimensional rows
+
+
+def shard_filename(name, shard):
+    return f"{name}.{shard:05d}.bin"
+
+
+def index_filename(name):
+    return f"{name}.index.bin"
+
+
+def metadata_filename(name):
+    return f"meta__{name}.bin"
+
+
+def is_complete_store(path):
+    return os.path.exists(os.path.join(path, STORE_META_FILE))
+
+
+def _truncate(path, size):
+    with open(path, "r+b") as f:
+        f.truncate(size)
+
+
+class _FieldWriter:
+    def __init__(self, store_path, name, dtype, feature_shape, shard_rows, progress=None):
+        self.store_path = store_path
+        self.name = name
+        self.dtype = dtype
+        self.feature_shape = tuple(feature_shape)
+        self.shard_rows = shard_rows
+        self.row_bytes = int(np.dtype(dtype).itemsize * np.prod(self.feature_shape, dtype=np.int64))
+
+        self.shard_sizes = []  # number of rows already written in every shard
+        self.file = None
+        self.num_records = 0
+        index_path = os.path.join(store_path, index_filename(name))
+
+        if progress is not None:
+            # Drop everything written after the last commit and continue appending from there
+            self.shard_sizes = list(progress["shards"])
+            self.num_records = progress["num_records"]
+        shard = len(self.shard_sizes)
+        while os.path.exists(os.path.join(store_path, shard_filename(name, shard))):
+            os.remove(os.path.join(store_path, shard_filename(name, shard)))
+            shard += 1
+        if len(self.shard_sizes) > 0:
+            path = os.path.join(store_path, shard_filename(name, len(self.shard_sizes) - 1))
+            _truncate(path, self.shard_sizes[-1] * self.row_bytes)
+            self.file = open(path, "ab")
+        # Index of the records as (shard, offset, rows) int64 triples, appended with every write so it can be resumed
+        if progress is not None:
+            _truncate(index_path, self.num_records * 3 * 8)
+        self.index_file = open(index_path, "ab" if progress is not None else "wb")
+
+    def _new_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shard_sizes.append(0)
+        self.file = open(os.path.join(self.store_path, shard_filename(self.name, len(self.shard_sizes) - 1)), "wb")
+
+    def write(self, flat, rows):
+        """
+            flat: (sum(rows), *F) rows of consecutive records, rows: (B,) number of rows of each record.
+        """
+        record_starts = np.concatenate([[0], np.cumsum(rows)])
+        first = 0
+        while first < len(rows):
+            # Open a new shard if the next record does not fit anymore (records larger than a shard get their own)
+            if self.file is None or (self.shard_sizes[-1] > 0 and self.shard_sizes[-1] + rows[first] > self.shard_rows):
+                self._new_shard()
+            capacity = self.shard_rows - self.shard_sizes[-1]
+            last = first + 1
+            while last < len(rows) and record_starts[last + 1] - record_starts[first] <= capacity:
+                last += 1
+
+            chunk = flat[record_starts[first]:record_starts[last]]
+            self.file.write(chunk.tobytes())
+
+            entries = np.empty((last - first, 3), dtype=np.int64)
+            entries[:, 0] = len(self.shard_sizes) - 1
+            entries[:, 1] = self.shard_sizes[-1] + record_starts[first:last] - record_starts[first]
+            entries[:, 2] = rows[first:last]
+            self.index_file.write(entries.tobytes())
+            self.shard_sizes[-1] += int(chunk.shape[0])
+            first = last
+        self.num_records += len(rows)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.index_file.close()
+
+    def progress(self):
+        return {"dtype": np.dtype(self.dtype).name, "feature_shape": list(self.feature_shape),
+                "shards": self.shard_sizes, "num_records": self.num_records}
+
+    def meta(self):
+        return {"dtype": np.dtype(self.dtype).name, "feature_shape": list(self.feature_shape), "shards": self.shard_sizes}
+
+    def index(self):
+        path = os.path.join(self.store_path, index_filename(self.name))
+        entries = np.fromfile(path, dtype=np.int64).reshape(-1, 3)
+        return {
+            f"{self.name}__shard": entries[:, 0].astype(np.int32),
+            f"{self.name}__offset": entries[:, 1],
+            f"{self.name}__rows": entries[:, 2].astype(np.int32),
+        }
+
+
+class _MetadataWriter:
+    def __init__(self, store_path, name, dtype, progress=None):
+        self.path = os.path.join(store_path, metadata_filename(name))
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        if progress is not None:
+            self.count = progress["count"]
+            _truncate(self.path, self.count * self.dtype.itemsize)
+        self.file = open(self.path, "ab" if progress is not None else "wb")
+
+    def write(self, values):
+        self.file.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        self.count += len(values)
+
+    def flush(self):
+        self.file.flush()
+
+    def progress(self):
+        return {"dtype": self.dtype.name, "count": self.count}
+
+    def values(self):
+        self.file.close()
+        return np.fromfile(self.path, dtype=self.dtype)
+
+
+class ActivationStoreWriter:
+    """
+        Appends batches of extracted activations to a store, see the module docstring for the format.
+
+        Usage:
+            writer = ActivationStoreWriter(path, dtype=np.float16, resume=True)
+            for batch_idx, batch in enumerate(batches):
+                if batch_idx < writer.committed_batches:
+                    continue                                          # already written by a previous run
+                writer.append_metadata("src_lengths", src_lengths)      # (B,)
+                writer.append("layer0_v_inputs", inputs)                 # (B, S, MD)
+                writer.append("layer0_outputs", outputs, token_axis=2)   # (B, NH, S, HD)
+                writer.add_alias("layer0_q_inputs", "layer0_v_inputs")   # same data as layer0_v_inputs
+                writer.commit(batch_idx + 1)
+            writer.close()
+
+        commit() writes a progress manifest (progress.json). When a writer is created with resume=True on a store with a
+        manifest, everything written after the last commit is dropped and the writer continues from there.
+
+    """
+
+    def __init__(self, path, dtype=np.float32, shard_rows=DEFAULT_SHARD_ROWS, resume=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shard_rows = shard_rows
+        self.fields = {}
+        self.aliases = {}
+        self.metadata = {}
+        self.committed_batches = 0
+        self.closed = False
+
+        progress_path = os.path.join(path, STORE_PROGRESS_FILE)
+        if resume and is_complete_store(path):
+            # nothing left to write, the store was closed by a previous run
+            with open(os.path.join(path, STORE_META_FILE)) as f:
+                self.committed_batches = json.load(f)["batches"]
+            self.closed = True
+        elif resume and os.path.exists(progress_path):
+            with open(progress_path) as f:
+                progress = json.load(f)
+            if np.dtype(progress["dtype"]) != self.dtype or progress["shard_rows"] != shard_rows:
+                raise ValueError(f"ERROR: cannot resume {path}, it was written with dtype {progress['dtype']} and {progress['shard_rows']} rows per shard.")
+            self.committed_batches = progress["batches"]
+            self.aliases = progress["aliases"]
+            for name, field in progress["fields"].items():
+                self.fields[name] = _FieldWriter(path, name, self.dtype, field["feature_shape"], shard_rows, progress=field)
+            for name, values in progress["metadata"].items():
+                self.metadata[name] = _MetadataWriter(path, name, values["dtype"], progress=values)
+        else:
+            # start from scratch, remove the leftovers of a previous run
+            for f in os.listdir(path):
+                os.remove(os.path.join(path, f))
+
+    def append(self, name, batch, rows=None, token_axis=1):
+        """
+            batch: array of shape (B, ..., S, ...) where token_axis is the index of the token dimension S.
+            rows:  optional (B,) number of token rows of every record that have to be stored, all S rows by default.
+        """
+        batch = np.asarray(batch)
+        if token_axis != 1:
+            batch = np.moveaxis(batch, token_axis, 1)
+        num_records, width = batch.shape[0], batch.shape[1]
+        if rows is None:
+            rows = np.full(num_records, width, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        assert rows.shape[0] == num_records, f'Expected {num_records} row counts, got {rows.shape[0]}.'
+
+        if name in self.aliases:
+            raise ValueError(f"ERROR: field {name} is an alias of {self.aliases[name]} and cannot be written.")
+        if name not in self.fields:
+            self.fields[name] = _FieldWriter(self.path, name, self.dtype, batch.shape[2:], self.shard_rows)
+        field = self.fields[name]
+        assert field.feature_shape == tuple(batch.shape[2:]), f'Field {name} expects features of shape {field.feature_shape}, got {batch.shape[2:]}.'
+
+        # Keep only the first rows[j] token rows of record j, in record order
+        if (rows == width).all():
+            flat = batch.reshape((-1,) + batch.shape[2:])
+        else:
+            flat = batch[np.arange(width)[None, :] < rows[:, None]]
+        field.write(np.ascontiguousarray(flat, dtype=self.dtype), rows)
+
+    def add_alias(self, name, target):
+        """Declares that field name holds the same records as field target. Can be repeated for every batch."""
+        target = self.aliases.get(target, target)
+        if name in self.fields:
+            raise ValueError(f"ERROR: field {name} already holds data and cannot become an alias of {target}.")
+        if self.aliases.setdefault(name, target) != target:
+            raise ValueError(f"ERROR: field {name} is already an alias of {self.aliases[name]}, not of {target}.")
+
+    def append_metadata(self, name, values):
+        values = np.asarray(values).reshape(-1)
+        if name not in self.metadata:
+            self.metadata[name] = _MetadataWriter(self.path, name, values.dtype)
+        self.metadata[name].write(values)
+
+    def commit(self, batches):
+        """Makes everything appended so far durable, batches is the number of batches written since the beginning."""
+        for field in self.fields.values():
+            field.flush()
+        for writer in self.metadata.values():
+            writer.flush()
+        progress = {
+            "dtype": self.dtype.name,
+            "shard_rows": self.shard_rows,
+            "batches": batches,
+            "fields": {name: field.progress() for name, field in self.fields.items()},
+            "aliases": self.aliases,
+            "metadata": {name: writer.progress() for name, writer in self.metadata.items()},
+        }
+        # write and rename, a job killed while committing keeps the previous manifest
+        progress_path = os.path.join(self.path, STORE_PROGRESS_FILE)
+        with open(progress_path + ".tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(progress_path + ".tmp", progress_path)
+        self.committed_batches = batches
+
+    def close(self):
+        if self.closed:
+            return
+        counts = {name: field.num_records for name, field in self.fields.items()}
+        counts.update({name: writer.count for name, writer in self.metadata.items()})
+        assert len(set(counts.values())) <= 1, f'All fields must have the same number of records, got {counts}.'
+
+        index = {}
+        for field in self.fields.values():
+            field.close()
+            index.update(field.index())
+        for name, writer in self.metadata.items():
+            index[f"meta__{name}"] = writer.values()
+        np.savez(os.path.join(self.path, STORE_INDEX_FILE), **index)
+
+        meta = {
+            "version": STORE_VERSION,
+            "num_records": next(iter(counts.values())) if len(counts) > 0 else 0,
+            "batches": self.committed_batches,
+            "fields": {name: field.meta() for name, field in self.fields.items()},
+            "aliases": self.aliases,
+            "metadata": sorted(self.metadata.keys()),
+        }
+        with open(os.path.join(self.path, STORE_META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        self.closed = True
+        # the store is complete, the raw index files and the progress manifest are not needed anymore
+        for name in self.fields:
+            os.remove(os.path.join(self.path, index_filename(name)))
+        for name in self.metadata:
+            os.remove(os.path.join(self.path, metadata_filename(name)))
+        progress_path = os.path.join(self.path, STORE_PROGRESS_FILE)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+
+
+class ActivationStore:
+    """
+        Read-only random access to a store written by ActivationStoreWriter. Shards are memory-mapped lazily so that
+        the store can be handed to DataLoader workers and only the pages which are actually read get loaded.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, STORE_META_FILE)) as f:
+            self.meta = json.load(f)
+        with np.load(os.path.join(path, STORE_INDEX_FILE)) as index:
+            self.index = {key: index[key] for key in index.files}
+        self.aliases = self.meta.get("aliases", {})
+        self._shards = {}
+
+    def __len__(self):
+        return self.meta["num_records"]
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in the process that unpickles the store
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    @property
+    def field_names(self):
+        return list(self.meta["fields"].keys()) + list(self.aliases.keys())
+
+    def has_field(self, name):
+        return name in self.meta["fields"] or name in self.aliases
+
+    def resolve(self, name):
+        """Returns the name of the field which holds the data of field name."""
+        return self.aliases.get(name, name)
+
+    def feature_shape(self, name):
+        return tuple(self.meta["fields"][self.resolve(name)]["feature_shape"])
+
+    def metadata(self, name):
+        return self.index[f"meta__{name}"]
+
+    def rows(self, name):
+        return self.index[f"{self.resolve(name)}__rows"]
+
+    def _shard(self, name, shard):
+        key = (name, shard)
+        if key not in self._shards:
+            field = self.meta["fields"][name]
+            shape = (field["shards"][shard],) + tuple(field["feature_shape"])
+            self._shards[key] = np.memmap(os.path.join(self.path, shard_filename(name, shard)), dtype=field["dtype"], mode="r", shape=shape)
+        return self._shards[key]
+
+    def get(self, name, idx):
+        """Returns record idx of the field as a read-only (R, *F) view into the memory-mapped shard."""
+        name = self.resolve(name)
+        shard = int(self.index[f"{name}__shard"][idx])
+        offset = int(self.index[f"{name}__offset"][idx])
+        rows = int(self.index[f"{name}__rows"][idx])
+        return self._shard(name, shard)[offset:offset + rows]
+
+    def gather(self, name, indices, out):
+        """
+            Copies the records indices of the field into out, an array of shape (len(indices), L, *F) with L at least
+            the number of rows of every record: record indices[i] goes to out[i, :rows] and out[i, rows:] is zeroed.
+            The rows of all the records of a shard are read with a single fancy indexing of the memory map.
+            Returns the number of rows of every record.
+        """
+        name = self.resolve(name)
+        indices = np.asarray(indices)
+        shards = self.index[f"{name}__shard"][indices]
+        offsets = self.index[f"{name}__offset"][indices]
+        rows = self.index[f"{name}__rows"][indices]
+        valid = np.arange(out.shape[1])[None, :] < rows[:, None]
+        b, t = np.nonzero(valid)
+        for shard in np.unique(shards):
+            in_shard = shards[b] == shard
+            out[b[in_shard], t[in_shard]] = self._shard(name, int(shard))[offsets[b[in_shard]] + t[in_shard]]
+        out[~valid] = 0
+        return rows
@@ -0,0 +1,121 @@
+"""
+    Background writer used by the extraction scripts to take the disk I/O out of the forward pass.
+
+    The forward hooks only enqueue work: every tensor is copied to a (pinned, if CUDA is used) host buffer with a
+    non-blocking copy and a CUDA event is recorded after the copies. A single worker thread waits for the event,
+    converts the buffers to numpy arrays and calls the write function (e.g. ActivationStoreWriter.append), then
+    gives the buffers back to a pool so that pinned memory is allocated only a few times per run.
+    The queue is bounded, so a slow disk throttles the forward pass instead of filling up the host memory.
+
+"""
+
+
+import threading
+import queue
+import time
+
+import torch
+
+
+class AsyncHostWriter:
+    """
+        Usage:
+            async_writer = AsyncHostWriter(max_pending=64)
+            # inside a hook, tensors can live on the GPU; positional and keyword tensor arguments are copied to the host
+            async_writer.submit(store_writer.append, "layer0_v_inputs", inputs, rows=lengths)
+            ...
+            async_writer.close()  # waits for all the pending writes, re-raises errors of the worker
+
+    """
+
+    def __init__(self, max_pending=64):
+        self.use_cuda = torch.cuda.is_available()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.pool = {}
+        self.pool_lock = threading.Lock()
+        self.error = None
+        self.wait_time = 0.0  # time the producer spent blocked on a full queue
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _get_buffer(self, numel, dtype):
+        # Flat buffers are reused for any tensor which fits, batches of the bucket iterator rarely share the same shape
+        with self.pool_lock:
+            free = self.pool.setdefault(dtype, [])
+            for j, buffer in enumerate(free):
+                if buffer.numel() >= numel:
+                    return free.pop(j)
+        capacity = 1 << max(numel - 1, 0).bit_length()
+        return torch.empty(capacity, dtype=dtype, pin_memory=self.use_cuda)
+
+    def _release_buffers(self, buffers):
+        with self.pool_lock:
+            for buffer in buffers:
+                self.pool.setdefault(buffer.dtype, []).append(buffer)
+
+    def _to_host(self, value, buffers):
+        if not torch.is_tensor(value):
+            return value
+        value = value.detach()
+        buffer = self._get_buffer(value.numel(), value.dtype)
+        buffers.append(buffer)
+        host = buffer[:value.numel()].view(value.shape)
+        host.copy_(value, non_blocking=value.is_cuda)
+        return host
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) on the worker thread, tensors are handed over as numpy arrays."""
+        if self.error is not None:
+            raise self.error
+        buffers = []
+        args = [self._to_host(a, buffers) for a in args]
+        kwargs = {k: self._to_host(v, buffers) for k, v in kwargs.items()}
+        event = None
+        if self.use_cuda:
+            event = torch.cuda.Event()
+            event.record()
+
+        start = time.time()
+        self.queue.put((event, fn, args, kwargs, buffers))
+        self.wait_time += time.time() - start
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            event, fn, args, kwargs, buffers = item
+            try:
+                if self.error is None:
+                    if event is not None:
+                        event.synchronize()
+                    fn(*[a.numpy() if torch.is_tensor(a) else a for a in args],
+                       **{k: v.numpy() if torch.is_tensor(v) else v for k, v in kwargs.items()})
+            except Exception as e:
+                self.error = e
+            finally:
+                self._release_buffers(buffers)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.pool = {}
+        if self.error is not None:
+            raise self.error
+
+
+class ThroughputMeter:
+    """Counts processed sentences and reports them per second since the creation of the meter."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.sentences = 0
+
+    def update(self, num_sentences):
+        self.sentences += int(num_sentences)
+
+    def rate(self):
+        return self.sentences / max(time.time() - self.start, 1e-9)
+
+    def __str__(self):
+        return f"{self.sentences} sentences in {time.time() - self.start:.1f}s ({self.rate():.1f} sentences/s)"
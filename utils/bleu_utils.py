@@ -0,0 +1,135 @@
+"""
+    Corpus BLEU computed incrementally from token ids.
+
+    NLTK's corpus_bleu counts the n-grams of the whole corpus in Python once the decoding is done. CorpusBleuAccumulator
+    keeps the corpus statistics corpus_bleu is made of (clipped n-gram matches, number of n-grams, hypothesis and
+    reference lengths) and updates them batch by batch directly from the token ids, so the score of the sentences
+    decoded so far is always available and no token is converted to a string.
+
+    Within a batch every n-gram is turned into a 64-bit hash of its token ids and of the index of its sentence, the
+    clipped matches are then computed with np.unique/np.intersect1d over the whole batch. The score is the one of
+    nltk.translate.bleu_score.corpus_bleu with the default weights and no smoothing (one reference per sentence), up to
+    64-bit hash collisions.
+
+"""
+
+
+import math
+import sys
+
+import numpy as np
+
+
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_HASH_MIX = np.uint64(0xBF58476D1CE4E5B9)
+
+
+def _mix(h):
+    # splitmix64 finalizer, spreads the bits of h so that similar n-grams get unrelated hashes
+    h = h ^ (h >> np.uint64(30))
+    h = h * _HASH_MIX
+    return h ^ (h >> np.uint64(31))
+
+
+def ngram_hashes(token_ids, lengths, n):
+    """
+    Hashes of all the n-grams of a batch of padded sentences.
+
+    token_ids shape = (B, T), lengths shape = (B,), only the first lengths[b] tokens of sentence b are used.
+    Returns the hashes of the (sentence index, n-gram) pairs, one per n-gram of the batch.
+    """
+    B, T = token_ids.shape
+    if T < n:
+        return np.empty(0, dtype=np.uint64)
+    starts = np.arange(T - n + 1)
+    # shape = (B, T - n + 1), True for the n-grams which are fully inside their sentence
+    valid = starts[None, :] + n <= lengths[:, None]
+    sentence_indices, starts = np.nonzero(valid)
+    with np.errstate(over='ignore'):
+        h = _mix(sentence_indices.astype(np.uint64) + np.uint64(1))
+        for i in range(n):
+            h = _mix(h * _HASH_MULTIPLIER + token_ids[sentence_indices, starts + i].astype(np.uint64))
+    return h
+
+
+class CorpusBleuAccumulator:
+    """
+        Usage:
+            bleu = CorpusBleuAccumulator()
+            for every batch:
+                bleu.update(predicted_ids, predicted_lengths, reference_ids, reference_lengths)
+                print(bleu.score())  # BLEU of the sentences seen so far
+    """
+
+    def __init__(self, max_order=4):
+        self.max_order = max_order
+        self.weights = [1. / max_order] * max_order
+        self.matches = np.zeros(max_order, dtype=np.int64)  # clipped n-gram matches, numerators of the precisions
+        self.totals = np.zeros(max_order, dtype=np.int64)  # n-grams of the hypotheses, denominators of the precisions
+        self.hypotheses_length = 0
+        self.references_length = 0
+        self.num_sentences = 0
+
+    def update(self, hypotheses_ids, hypotheses_lengths, references_ids, references_lengths):
+        """
+        Adds a batch of (hypothesis, reference) pairs to the corpus.
+
+        hypotheses_ids shape = (B, T), references_ids shape = (B, S), integer numpy arrays (or tensors on the CPU)
+        hypotheses_lengths/references_lengths shape = (B,), number of tokens of every sentence, the rest is padding
+        """
+        hypotheses_ids, references_ids = np.asarray(hypotheses_ids), np.asarray(references_ids)
+        hypotheses_lengths, references_lengths = np.asarray(hypotheses_lengths), np.asarray(references_lengths)
+        for n in range(1, self.max_order + 1):
+            hypotheses_ngrams, hypotheses_counts = np.unique(ngram_hashes(hypotheses_ids, hypotheses_lengths, n), return_counts=True)
+            references_ngrams, references_counts = np.unique(ngram_hashes(references_ids, references_lengths, n), return_counts=True)
+            # a hypothesis n-gram matches at most as many times as it appears in the reference of its sentence
+            _, hypotheses_idx, references_idx = np.intersect1d(hypotheses_ngrams, references_ngrams, assume_unique=True, return_indices=True)
+            self.matches[n - 1] += np.minimum(hypotheses_counts[hypotheses_idx], references_counts[references_idx]).sum()
+            # as in nltk every sentence counts at least one n-gram in the denominator
+            self.totals[n - 1] += np.maximum(hypotheses_lengths - n + 1, 1).sum()
+        self.hypotheses_length += int(hypotheses_lengths.sum())
+        self.references_length += int(references_lengths.sum())
+        self.num_sentences += len(hypotheses_lengths)
+
+    def brevity_penalty(self):
+        if self.hypotheses_length > self.references_length:
+            return 1.
+        if self.hypotheses_length == 0:
+            return 0.
+        return math.exp(1 - self.references_length / self.hypotheses_length)
+
+    def score(self):
+        # Same as nltk: 0 without matching unigrams, the precisions without matches are replaced by the smallest float
+        if self.matches[0] == 0:
+            return 0.
+        precisions = [m / t if m > 0 else sys.float_info.min for m, t in zip(self.matches, self.totals)]
+        return self.brevity_penalty() * math.exp(math.fsum(w * math.log(p) for w, p in zip(self.weights, precisions)))
+
+
+def lengths_up_to_eos(token_ids, eos_token_id):
+    # Number of tokens up to the first EOS token (included) of every sentence, all of them if there is no EOS
+    is_eos = token_ids == eos_token_id
+    return np.where(is_eos.any(axis=1), is_eos.argmax(axis=1) + 1, token_ids.shape[1])
+
+
+# Check against nltk on a random corpus - feel free to ignore
+if __name__ == "__main__":
+    from nltk.translate.bleu_score import corpus_bleu
+
+    rng = np.random.default_rng(0)
+    bleu = CorpusBleuAccumulator()
+    nltk_hypotheses, nltk_references = [], []
+    for _ in range(20):
+        batch_size, vocab_size = 32, 20
+        hypotheses = rng.integers(0, vocab_size, size=(batch_size, 40))
+        references = rng.integers(0, vocab_size, size=(batch_size, 45))
+        hypotheses_lengths = rng.integers(1, 41, size=batch_size)
+        references_lengths = rng.integers(1, 46, size=batch_size)
+        bleu.update(hypotheses, hypotheses_lengths, references, references_lengths)
+        for b in range(batch_size):
+            nltk_hypotheses.append(hypotheses[b, :hypotheses_lengths[b]].tolist())
+            nltk_references.append([references[b, :references_lengths[b]].tolist()])
+    accumulator_score, nltk_score = bleu.score(), corpus_bleu(nltk_references, nltk_hypotheses)
+    print(f'accumulator = {accumulator_score}, nltk = {nltk_score}')
+    if abs(accumulator_score - nltk_score) > 1e-6:
+        raise ValueError(f"ERROR: the accumulated BLEU {accumulator_score} differs from nltk's corpus_bleu {nltk_score}.")
@@ -1,14 +1,19 @@
 import time
 import os
+import csv
+import multiprocessing
 import enum
+import pickle
+import shutil
 
 
+import numpy as np
 import torch
-from torchtext.data import Dataset, BucketIterator, Field, Example, TabularDataset
+from torch.utils.data import DataLoader, Sampler
+from torchtext.data import Dataset, Field, Example, TabularDataset
 from torchtext.data.utils import interleave_keys
 #from torchtext import datasets
 from datasets import load_dataset
-import spacy
 import sys
 
 from .constants import BOS_TOKEN, EOS_TOKEN, MAX_LEN, PAD_TOKEN, DATA_DIR_PATH
@@ -44,7 +49,7 @@ class FastTranslationDataset(Dataset):
     def sort_key(ex):
         # What this does is basically it takes a 16-bit binary representation of lengths and interleaves them.
         # Example: lengths len(ex.src)=5 and len(ex.trg)=3 result in f(101, 011)=100111, 7 and 1 in f(111, 001)=101011
-        # It's basically a heuristic that helps the BucketIterator sort bigger batches first
+        # It's basically a heuristic that helps the TokenBudgetBatchSampler sort bigger batches first
         return interleave_keys(len(ex.src), len(ex.trg))
 
     def __init__(self, cache_path, fields, **kwargs):
@@ -133,43 +138,196 @@ def save_cache(cache_path, dataset):
             #cache_file.write(ex.trg + '\n')
             cache_file.write(' '.join(ex.src) + '\n')
             cache_file.write(' '.join(ex.trg) + '\n')
-#       
-# End of caching mechanism utilities
+
+
+#
+# Parallel tokenization: the prepared csv of a split is cut in shards of rows, a process pool tokenizes them with
+# spaCy (only the tokenizer, in batches) and writes every shard in the format of save_cache. The shards are then
+# concatenated into the cache file. A shard is written to a temporary file and renamed once complete, so an
+# interrupted run only redoes the missing shards.
 #
 
-    
+SPACY_MODELS = {'en': 'en_core_web_sm', 'de': 'de_core_news_sm', 'fr': 'fr_core_news_sm'}
+TOKENIZATION_SHARD_SIZE = 20000  # rows of the csv per shard
+TOKENIZATION_BATCH_SIZE = 1000  # texts per tokenizer.pipe batch
+
+_spacy_tokenizers = {}
+
+
+def get_spacy_tokenizer(lang):
+    # spaCy and its models are loaded lazily (once per process), only for the languages which are actually tokenized
+    if lang not in _spacy_tokenizers:
+        import spacy
+        _spacy_tokenizers[lang] = spacy.load(SPACY_MODELS[lang]).tokenizer
+    return _spacy_tokenizers[lang]
+
+
+def tokenize_shard(job):
+    rows, src_lang, trg_lang, max_len, shard_path = job
+    if os.path.exists(shard_path):
+        return shard_path  # already tokenized by a previous (interrupted) run
+    src_docs = get_spacy_tokenizer(src_lang).pipe((row[0] for row in rows), batch_size=TOKENIZATION_BATCH_SIZE)
+    trg_docs = get_spacy_tokenizer(trg_lang).pipe((row[1] for row in rows), batch_size=TOKENIZATION_BATCH_SIZE)
+    tmp_path = shard_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as shard_file:
+        for src_doc, trg_doc in zip(src_docs, trg_docs):
+            src = [tok.text for tok in src_doc]
+            trg = [tok.text for tok in trg_doc]
+            # filter out examples that have more than max_len tokens
+            if len(src) <= max_len and len(trg) <= max_len:
+                shard_file.write(' '.join(src) + '\n')
+                shard_file.write(' '.join(trg) + '\n')
+    os.replace(tmp_path, shard_path)
+    return shard_path
+
+
+def merge_cache_shards(shard_paths, cache_path):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+        for shard_path in shard_paths:
+            with open(shard_path, encoding='utf-8') as shard_file:
+                shutil.copyfileobj(shard_file, cache_file)
+    os.replace(tmp_path, cache_path)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+def tokenize_to_cache(csv_path, cache_path, src_lang, trg_lang, max_len, num_workers=None):
+    with open(csv_path, encoding='utf-8', newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader)  # skip the header
+        rows = [row[:2] for row in reader]
+
+    jobs = [(rows[start:start + TOKENIZATION_SHARD_SIZE], src_lang, trg_lang, max_len, f'{cache_path}.shard{i:05d}')
+            for i, start in enumerate(range(0, len(rows), TOKENIZATION_SHARD_SIZE))]
+    num_workers = min(num_workers or os.cpu_count() or 1, len(jobs))
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            shard_paths = pool.map(tokenize_shard, jobs, chunksize=1)
+    else:
+        shard_paths = [tokenize_shard(job) for job in jobs]
+    merge_cache_shards(shard_paths, cache_path)
 
-def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, use_caching_mechanism=True, fix_length = None, max_len_train = 100):
-    src_lang, trg_lang = language_direction.split('_')
-    spacy_de = spacy.load('fr_core_news_sm')
-    spacy_en = spacy.load('en_core_web_sm')
-    spacy_fr = spacy.load('fr_core_news_sm')
 
-    def tokenize_de(text):
-        return [tok.text for tok in spacy_de.tokenizer(text)]
+#
+# Numericalized cache: the token ids of every split are stored as flat int32 arrays plus the offsets of the sentences
+# (np.save) next to the pickled vocabs. Loading memory-maps the arrays, so there is no text to parse, no vocab to
+# build and the batches don't need to be numericalized anymore (see load_ids_cache).
+#
+
+IDS_CACHE_SPLITS = ['train', 'val', 'test']
+IDS_CACHE_VOCAB_FILE = 'vocab.pkl'
+
+
+def get_ids_cache_dir(dataset_path, prefix, max_len_train):
+    # The vocab is built on the train split filtered with max_len_train, so the ids depend on it as well
+    return os.path.join(dataset_path, f'{prefix}_ids_cache_maxlen{max_len_train}')
+
+
+def ids_cache_filename(split, side, kind):
+    return f'{split}_{side}_{kind}.npy'
+
+
+def save_ids_cache(cache_dir, datasets, src_field_processor, trg_field_processor):
+    # Written to a temporary folder which is renamed at the end, an interrupted run never leaves a partial cache
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for split, dataset in zip(IDS_CACHE_SPLITS, datasets):
+        for side, field_processor in (('src', src_field_processor), ('trg', trg_field_processor)):
+            stoi = field_processor.vocab.stoi  # unknown tokens are mapped to <unk> as in Field.numericalize
+            sentences = [getattr(ex, side) for ex in dataset.examples]
+            offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(sentence) for sentence in sentences])
+            ids = np.fromiter((stoi[token] for sentence in sentences for token in sentence), dtype=np.int32, count=offsets[-1])
+            np.save(os.path.join(tmp_dir, ids_cache_filename(split, side, 'ids')), ids)
+            np.save(os.path.join(tmp_dir, ids_cache_filename(split, side, 'offsets')), offsets)
+    with open(os.path.join(tmp_dir, IDS_CACHE_VOCAB_FILE), 'wb') as vocab_file:
+        pickle.dump({'src': src_field_processor.vocab, 'trg': trg_field_processor.vocab}, vocab_file)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(tmp_dir, cache_dir)
+
 
-    def tokenize_en(text):
-        return [tok.text for tok in spacy_en.tokenizer(text)]
+def load_ids_split(cache_dir, split, side):
+    # np.asarray drops the memmap subclass, slices of plain arrays are much cheaper to create
+    ids = np.asarray(np.load(os.path.join(cache_dir, ids_cache_filename(split, side, 'ids')), mmap_mode='r'))
+    offsets = np.load(os.path.join(cache_dir, ids_cache_filename(split, side, 'offsets')))
+    return ids, offsets
 
-    def tokenize_fr(text):
-        return [tok.text for tok in spacy_fr.tokenizer(text)]
 
-    tokenizers = {'en': tokenize_en, 'de': tokenize_de, 'fr': tokenize_fr}
+class NumericalizedDataset(Dataset):
+    """
+        Same as FastTranslationDataset but the examples hold slices of the memory-mapped token ids of the cache, the
+        fields (see load_ids_cache) only pad them and turn them into tensors.
+
+    """
+
+    sort_key = staticmethod(FastTranslationDataset.sort_key)
+
+    def __init__(self, cache_dir, split, fields, **kwargs):
+        src_ids, src_offsets = load_ids_split(cache_dir, split, 'src')
+        trg_ids, trg_offsets = load_ids_split(cache_dir, split, 'trg')
+        assert len(src_offsets) == len(trg_offsets), f'Source and target data should be of the same length.'
+
+        examples = []
+        for i in range(len(src_offsets) - 1):
+            ex = Example()
+            setattr(ex, 'src', src_ids[src_offsets[i]:src_offsets[i + 1]])
+            setattr(ex, 'trg', trg_ids[trg_offsets[i]:trg_offsets[i + 1]])
+            examples.append(ex)
+        # used by TokenBudgetBatchSampler, the batches are built without going through the examples
+        self.src_lengths = np.diff(src_offsets)
+        self.trg_lengths = np.diff(trg_offsets)
+
+        print(f'{split} dataset has {len(src_ids)} tokens in the source language corpus and {len(trg_ids)} in the target language corpus.')
+        super().__init__(examples, fields, **kwargs)
+
+
+def load_ids_cache(cache_dir, fix_length=None):
+    ts = time.time()
+    with open(os.path.join(cache_dir, IDS_CACHE_VOCAB_FILE), 'rb') as vocab_file:
+        vocabs = pickle.load(vocab_file)
+    src_vocab, trg_vocab = vocabs['src'], vocabs['trg']
+
+    # The examples already contain ids: the fields don't use the vocab, special tokens are given as ids. The vocabs
+    # are still attached to the fields for the scripts (e.g. field_processor.vocab.stoi[PAD_TOKEN], vocab.itos)
+    src_field_processor = Field(use_vocab=False, pad_token=src_vocab.stoi[PAD_TOKEN], batch_first=True, fix_length=fix_length)
+    trg_field_processor = Field(use_vocab=False, init_token=trg_vocab.stoi[BOS_TOKEN], eos_token=trg_vocab.stoi[EOS_TOKEN], pad_token=trg_vocab.stoi[PAD_TOKEN], batch_first=True, fix_length=fix_length)
+    src_field_processor.vocab = src_vocab
+    trg_field_processor.vocab = trg_vocab
+
+    fields = [('src', src_field_processor), ('trg', trg_field_processor)]
+    train_dataset, val_dataset, test_dataset = [NumericalizedDataset(cache_dir, split, fields) for split in IDS_CACHE_SPLITS]
+    print(f'Time it took to load the numericalized data: {time.time() - ts:3f} seconds.')
+    return train_dataset, val_dataset, test_dataset, src_field_processor, trg_field_processor
+
+#       
+# End of caching mechanism utilities
+#
+
+    
+
+def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, use_caching_mechanism=True, fix_length = None, max_len_train = 100, num_tokenization_workers = None):
+    prefix = language_direction
+    prefix += '_iwslt' if use_iwslt else '_wmt14'
+    # Fast path: token ids and vocabs of a previous run
+    ids_cache_dir = get_ids_cache_dir(dataset_path, prefix, max_len_train)
+    if use_caching_mechanism and os.path.exists(ids_cache_dir):
+        return load_ids_cache(ids_cache_dir, fix_length)
+
+    src_lang, trg_lang = language_direction.split('_')
     # batch first set to true as my transformer is expecting that format (that's consistent with the format
     # used in  computer vision), namely (B, C, H, W) -> batch size, number of channels, height and width
-    src_tokenizer = tokenizers[src_lang]
-    trg_tokenizer = tokenizers[trg_lang]
-    src_field_processor = Field(tokenize=src_tokenizer, pad_token=PAD_TOKEN, batch_first=True, fix_length = fix_length)
-    trg_field_processor = Field(tokenize=trg_tokenizer, init_token=BOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, batch_first=True,fix_length = fix_length)
+    # The examples are read from the (already tokenized) cache files, see tokenize_to_cache
+    src_field_processor = Field(pad_token=PAD_TOKEN, batch_first=True, fix_length = fix_length)
+    trg_field_processor = Field(init_token=BOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, batch_first=True,fix_length = fix_length)
 
     fields = [('src', src_field_processor), ('trg', trg_field_processor)]
     max_len = max_len_train  # filter out examples that have more than MAX_LEN tokens
     filter_pred = lambda x: len(x.src) <= max_len and len(x.trg) <= max_len
     filter_val_test = lambda x: len(x.src) <= MAX_LEN and len(x.trg) <= MAX_LEN
 
-    # Only call once the splits function it is super slow as it constantly has to redo the tokenization
-    prefix = language_direction
-    prefix += '_iwslt' if use_iwslt else '_wmt14'
+    # Tokenization is slow, it only runs when these cache files are missing
     train_cache_path = os.path.join(dataset_path, f'{prefix}_train_cache.csv')
     val_cache_path = os.path.join(dataset_path, f'{prefix}_val_cache.csv')
     test_cache_path = os.path.join(dataset_path, f'{prefix}_test_cache.csv')
@@ -177,26 +335,11 @@ def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, us
     # This simple caching mechanism gave me ~30x speedup on my machine! From ~70s -> ~2.5s!
     ts = time.time()
     if not use_caching_mechanism or not (os.path.exists(train_cache_path) and os.path.exists(val_cache_path) and os.path.exists(test_cache_path)):
-        # dataset objects have a list of examples where example is simply an empty Python Object that has
-        # .src and .trg attributes which contain a tokenized list of strings (created by tokenize_en and tokenize_de).
-        # It's that simple, we can consider our datasets as a table with 2 columns 'src' and 'trg'
-        # each containing fields with tokenized strings from source and target languages
-        src_ext = '.' + language_direction.split('_')[0]
-        trg_ext = '.' + language_direction.split('_')[1]
-        
-        train_dataset, val_dataset, test_dataset = TabularDataset.splits(path='./data/prepared_data', train=f'train_{language_direction}.csv', validation=f'val_{language_direction}.csv', test=f'test_{language_direction}.csv', format='csv', fields=fields, skip_header=True, filter_pred=filter_pred)
-        
-        # dataset_split_fn = datasets.IWSLT.splits if use_iwslt else datasets.WMT14.splits
-        #train_dataset, val_dataset, test_dataset = dataset_split_fn(
-        #     exts=(src_ext, trg_ext),
-        #     fields=fields,
-        #     root=dataset_path,
-        #     filter_pred=filter_pred
-        # )
-
-        save_cache(train_cache_path, train_dataset)
-        save_cache(val_cache_path, val_dataset)
-        save_cache(test_cache_path, test_dataset)
+        # The cache files contain the tokenized examples, source on even lines and target on odd lines
+        # (see save_cache), tokenized in parallel from the prepared csv files
+        for split, cache_path in zip(['train', 'val', 'test'], [train_cache_path, val_cache_path, test_cache_path]):
+            csv_path = os.path.join('./data/prepared_data', f'{split}_{language_direction}.csv')
+            tokenize_to_cache(csv_path, cache_path, src_lang, trg_lang, max_len, num_workers=num_tokenization_workers)
 
     # it's actually better to load from cache as we'll get rid of '\xa0', '\xa0 ' and '\x85' unicode characters
     # which we don't need and which SpaCy unfortunately includes as tokens.
@@ -212,57 +355,175 @@ def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, us
     # Implementation will yield examples and call .src/.trg attributes on them (and those contain tokenized lists)
     src_field_processor.build_vocab(train_dataset.src, min_freq=MIN_FREQ)
     trg_field_processor.build_vocab(train_dataset.trg, min_freq=MIN_FREQ)
+
+    if use_caching_mechanism:
+        # The next runs load the token ids directly, this run uses them as well so that every run sees the same data
+        save_ids_cache(ids_cache_dir, (train_dataset, val_dataset, test_dataset), src_field_processor, trg_field_processor)
+        return load_ids_cache(ids_cache_dir, fix_length)
     return train_dataset, val_dataset, test_dataset, src_field_processor, trg_field_processor
 
 
-global longest_src_sentence, longest_trg_sentence
+class TokenBudgetBatchSampler(Sampler):
+    """
+        Batch sampler whose batch size is not a number of examples/sentences but a number of tokens in a batch - which
+        allows us to max out VRAM on a given GPU.
+
+        Example: with a fixed batch size of say 10 we will sometimes end up with a tensor of size (10, 100) because
+        the longest sentence had a size of 100 tokens but other times we'll end up with a size of (10, 5) because the
+        longest sentence had only 5 tokens!
 
+        Here source and target tensors can't go over max_tokens tokens: a batch grows as long as the number of
+        sentences times the longest sentence (source, or target + 2 for <s> and </s>) stays below max_tokens.
 
-def batch_size_fn(new_example, count, sofar):
+        Sentences of similar lengths are grouped (sorted with the key of FastTranslationDataset.sort_key). Without
+        shuffling the whole split is sorted. With shuffling (same as torchtext's BucketIterator) the sentences are
+        shuffled, cut in buckets of bucket_size_multiplier batches, every bucket is sorted and the resulting batches
+        are shuffled - with a new order at every epoch. Only the length arrays are needed, the batches are built in
+        the main process and the DataLoader workers only collate them.
+
+    """
+
+    def __init__(self, src_lengths, trg_lengths, max_tokens, shuffle=False, bucket_size_multiplier=100, seed=0):
+        self.src_lengths = np.asarray(src_lengths).tolist()
+        # 2 because of start/end of sentence tokens (<s> and </s>)
+        self.trg_lengths = (np.asarray(trg_lengths) + 2).tolist()
+        self.sort_keys = np.array([interleave_keys(src_len, trg_len) for src_len, trg_len in zip(self.src_lengths, np.asarray(trg_lengths).tolist())], dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None if shuffle else self.make_batches(np.argsort(self.sort_keys, kind='stable').tolist(), max_tokens)
+
+    def make_batches(self, indices, max_tokens):
+        batches, batch, longest_sentence = [], [], 0
+        for i in indices:
+            longest_with_i = max(longest_sentence, self.src_lengths[i], self.trg_lengths[i])
+            if batch and (len(batch) + 1) * longest_with_i > max_tokens:
+                batches.append(batch)
+                batch, longest_with_i = [], max(self.src_lengths[i], self.trg_lengths[i])
+            batch.append(i)
+            longest_sentence = longest_with_i
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def make_shuffled_batches(self, rng):
+        batches = []
+        for bucket in self.make_batches(rng.permutation(len(self.sort_keys)).tolist(), self.max_tokens * self.bucket_size_multiplier):
+            bucket = np.asarray(bucket)
+            batches += self.make_batches(bucket[np.argsort(self.sort_keys[bucket], kind='stable')].tolist(), self.max_tokens)
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def get_batches(self):
+        if self.batches is None:
+            self.batches = self.make_shuffled_batches(np.random.default_rng(self.seed + self.epoch))
+        return self.batches
+
+    def __iter__(self):
+        batches = self.get_batches()
+        if self.shuffle:
+            # new batches for the next epoch
+            self.batches = None
+            self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
+class TranslationBatch:
+    """
+        Padded token ids of a batch, src shape = (B, S) and trg shape = (B, T) (with <s> and </s>), same attributes as
+        the batches of torchtext (see get_src_and_trg_batches). pin_memory is called by the DataLoader when
+        pin_memory=True.
+
+    """
+
+    def __init__(self, src, trg):
+        self.src = src
+        self.trg = trg
+
+    def pin_memory(self):
+        return TranslationBatch(self.src.pin_memory(), self.trg.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return TranslationBatch(self.src.to(device, non_blocking=non_blocking), self.trg.to(device, non_blocking=non_blocking))
+
+    def __len__(self):
+        return self.src.shape[0]
+
+
+class TranslationBatchCollator:
     """
-        If we use this function in the BucketIterator the batch_size is no longer the number of examples/sentences
-        in a batch but a number of tokens in a batch - which allows us to max out VRAM on a given GPU.
+        collate_fn of the DataLoader: pads the token ids of the examples of NumericalizedDataset, the special tokens
+        are the ids of the fields returned by load_ids_cache. Same padding as the fields (fix_length included).
 
-        Example: if we don't use this function and we set batch size to say 10 we will sometimes end up with
-        a tensor of size (10, 100) because the longest sentence had a size of 100 tokens but other times we'll end
-        up with a size of (10, 5) because the longest sentence had only 5 tokens!
+    """
 
-        With this function what we do is we specify that source and target tensors can't go over a certain number
-        of tokens like 1000. So usually either source or target tensors will contain around 1000 tokens and
-        in worst case both will be really close to a 1000 tokens each. If that is still below max VRAM availabe on
-        the system we're using the max potential of our GPU w.r.t. VRAM.
+    def __init__(self, src_field_processor, trg_field_processor):
+        self.src_pad_token_id = src_field_processor.pad_token
+        self.trg_pad_token_id = trg_field_processor.pad_token
+        self.trg_bos_token_id = trg_field_processor.init_token
+        self.trg_eos_token_id = trg_field_processor.eos_token
+        self.fix_length = src_field_processor.fix_length
 
-        Note: to understand this function you unfortunately would probably have to dig deeper into torch text's
-        source code.
+    @staticmethod
+    def pad(sentences, length, pad_token_id, offset=0):
+        # sentences are copied row after row into the positions [offset, offset + len) of a (B, length) tensor
+        lengths = torch.tensor([len(sentence) for sentence in sentences])
+        padded = torch.full((len(sentences), length), pad_token_id, dtype=torch.long)
+        positions = torch.arange(length)[None, :] - offset
+        padded[(positions >= 0) & (positions < lengths[:, None])] = torch.from_numpy(np.concatenate(sentences).astype(np.int64))
+        return padded, lengths
+
+    def __call__(self, examples):
+        if self.fix_length is None:
+            src_length = max(len(ex.src) for ex in examples)
+            trg_length = max(len(ex.trg) for ex in examples) + 2
+            src_sentences, trg_sentences = [ex.src for ex in examples], [ex.trg for ex in examples]
+        else:
+            src_length = trg_length = self.fix_length
+            src_sentences, trg_sentences = [ex.src[:self.fix_length] for ex in examples], [ex.trg[:self.fix_length - 2] for ex in examples]
+
+        src, _ = self.pad(src_sentences, src_length, self.src_pad_token_id)
+        trg, trg_lengths = self.pad(trg_sentences, trg_length, self.trg_pad_token_id, offset=1)
+        trg[:, 0] = self.trg_bos_token_id
+        trg[torch.arange(len(examples)), trg_lengths + 1] = self.trg_eos_token_id
+        return TranslationBatch(src, trg)
+
+
+class DeviceDataLoader:
+    """
+        Moves the batches of a DataLoader to the device (non blocking from pinned memory), as the BucketIterator did.
 
     """
-    global longest_src_sentence, longest_trg_sentence
 
-    if count == 1:
-        longest_src_sentence = 0
-        longest_trg_sentence = 0
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
 
-    longest_src_sentence = max(longest_src_sentence, len(new_example.src))
-    # 2 because of start/end of sentence tokens (<s> and </s>)
-    longest_trg_sentence = max(longest_trg_sentence, len(new_example.trg) + 2)
+    def __iter__(self):
+        for batch in self.data_loader:
+            yield batch.to(self.device, non_blocking=True)
 
-    num_of_tokens_in_src_tensor = count * longest_src_sentence
-    num_of_tokens_in_trg_tensor = count * longest_trg_sentence
-    return max(num_of_tokens_in_src_tensor, num_of_tokens_in_trg_tensor)
+    def __len__(self):
+        return len(self.data_loader)
 
 
-# https://github.com/pytorch/text/issues/536#issuecomment-719945594 <- there is a "bug" in BucketIterator i.e. it's
-# description is misleading as it won't group examples of similar length unless you set sort_within_batch to True!
-def get_data_loaders(dataset_path, language_direction, dataset_name, batch_size, device, max_len_train = 100):
+def get_data_loaders(dataset_path, language_direction, dataset_name, batch_size, device, max_len_train = 100, num_workers = 0, seed = 0):
     train_dataset, val_dataset, test_dataset, src_field_processor, trg_field_processor = get_datasets_and_vocabs(dataset_path, language_direction, dataset_name == DatasetType.IWSLT.name, max_len_train = max_len_train)
-    train_token_ids_loader, val_token_ids_loader, test_token_ids_loader = BucketIterator.splits(
-     datasets=(train_dataset, val_dataset, test_dataset),
-     batch_size=batch_size,
-     device=device,
-     sort_within_batch=True,  # this part is really important otherwise we won't group similar length sentences
-     batch_size_fn=batch_size_fn  # this helps us max out GPU's VRAM
-     )
+    collate_fn = TranslationBatchCollator(src_field_processor, trg_field_processor)
+    pin_memory = torch.device(device).type == 'cuda'
+
+    # Only the training split is shuffled (with seed + epoch), batch_size is a number of tokens (see TokenBudgetBatchSampler)
+    token_ids_loaders = []
+    for dataset, shuffle in zip((train_dataset, val_dataset, test_dataset), (True, False, False)):
+        batch_sampler = TokenBudgetBatchSampler(dataset.src_lengths, dataset.trg_lengths, batch_size, shuffle=shuffle, seed=seed)
+        data_loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers, pin_memory=pin_memory)
+        token_ids_loaders.append(DeviceDataLoader(data_loader, device))
 
+    train_token_ids_loader, val_token_ids_loader, test_token_ids_loader = token_ids_loaders
     return train_token_ids_loader, val_token_ids_loader, test_token_ids_loader, src_field_processor, trg_field_processor
 
 
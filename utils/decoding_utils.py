@@ -14,199 +14,200 @@ class DecodingMethod(enum.Enum):
     BEAM = 1
 
 
-def greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=MAX_LEN):
+def greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=MAX_LEN, return_token_ids=False):
     """
     Supports batch (decode multiple source sentences) greedy decoding.
 
-    Decoding could be further optimized to cache old token activations because they can't look ahead and so
-    adding a newly predicted token won't change old token's activations.
+    Old token activations are cached because they can't look ahead and so adding a newly predicted token won't change
+    old token's activations (see Transformer.decode_step). If the decoder attention is substituted, the whole
+    target prefix is decoded at every step instead.
 
     Example: we input <s> and do a forward pass. We get intermediate activations for <s> and at the output at position
     0, after the doing linear layer we get e.g. token <I>. Now we input <s>,<I> but <s>'s activations will remain
     the same. Similarly say we now got <am> at output position 1, in the next step we input <s>,<I>,<am> and so <I>'s
     activations will remain the same as it only looks at/attends to itself and to <s> and so forth.
 
+    The decoding loop stays on the device: the token ids are kept in a tensor, the sentences which reached the EOS
+    token are removed from the decoded batch (and from the cache) and the ids are converted to tokens only at the end.
+    With return_token_ids the (B, max_target_tokens + 1) tensor of ids is returned as well, padded after the EOS token.
+
     """
 
     device = next(baseline_transformer.parameters()).device
     pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+    eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
+    batch_size = src_representations_batch.shape[0]
+
+    # Initial prompt is the beginning/start of the sentence token, shape = (B, max_target_tokens + 1)
+    token_ids = torch.full((batch_size, max_target_tokens + 1), pad_token_id, dtype=torch.long, device=device)
+    token_ids[:, 0] = trg_field_processor.vocab.stoi[BOS_TOKEN]
+    # Number of tokens of every sentence up to the EOS token, sentences without EOS keep all the tokens
+    lengths = torch.full((batch_size,), max_target_tokens + 1, dtype=torch.long, device=device)
+    # Indices of the sentences which didn't reach the EOS token yet, only these are decoded
+    active = torch.arange(batch_size, device=device)
+
+    cache = None
+    if baseline_transformer.supports_incremental_decoding():
+        cache = baseline_transformer.init_decoder_cache(src_representations_batch, max_target_tokens)
+
+    for num_of_trg_tokens in range(1, max_target_tokens + 1):
+        trg_token_ids_batch = token_ids[active, :num_of_trg_tokens]
+        if cache is not None:
+            # Only the newest token goes through the decoder, it can attend to all the (non-padded) previous tokens
+            # Shape = (B, V) where V is the target vocab size
+            trg_mask = (trg_token_ids_batch != pad_token_id).view(trg_token_ids_batch.shape[0], 1, 1, -1)
+            predicted_log_distributions = baseline_transformer.decode_step(trg_token_ids_batch[:, -1:], cache, trg_mask, src_mask)
+        else:
+            trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
+            # Shape = (B*T, V) where T is the current token-sequence length and V target vocab size
+            predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
 
-    # Initial prompt is the beginning/start of the sentence token. Make it compatible shape with source batch => (B,1)
-    target_sentences_tokens = [[BOS_TOKEN] for _ in range(src_representations_batch.shape[0])]
-    trg_token_ids_batch = torch.tensor([[trg_field_processor.vocab.stoi[tokens[0]]] for tokens in target_sentences_tokens], device=device)
-
-    # Set to true for a particular target sentence once it reaches the EOS (end-of-sentence) token
-    is_decoded = [False] * src_representations_batch.shape[0]
-
-    while True:
-        trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
-        # Shape = (B*T, V) where T is the current token-sequence length and V target vocab size
-        predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
-
-        # Extract only the indices of last token for every target sentence (we take every T-th token)
-        num_of_trg_tokens = len(target_sentences_tokens[0])
-        predicted_log_distributions = predicted_log_distributions[num_of_trg_tokens-1::num_of_trg_tokens]
+            # Extract only the indices of last token for every target sentence (we take every T-th token)
+            predicted_log_distributions = predicted_log_distributions[num_of_trg_tokens-1::num_of_trg_tokens]
 
         # This is the "greedy" part of the greedy decoding:
         # We find indices of the highest probability target tokens and discard every other possibility
-        most_probable_last_token_indices = torch.argmax(predicted_log_distributions, dim=-1).cpu().numpy()
-
-        # Find target tokens associated with these indices
-        predicted_words = [trg_field_processor.vocab.itos[index] for index in most_probable_last_token_indices]
-
-        for idx, predicted_word in enumerate(predicted_words):
-            target_sentences_tokens[idx].append(predicted_word)
-
-            if predicted_word == EOS_TOKEN:  # once we find EOS token for a particular sentence we flag it
-                is_decoded[idx] = True
-
-        if all(is_decoded) or num_of_trg_tokens == max_target_tokens:
-            break
-
-        # Prepare the input for the next iteration (merge old token ids with the new column of most probable token ids)
-        trg_token_ids_batch = torch.cat((trg_token_ids_batch, torch.unsqueeze(torch.tensor(most_probable_last_token_indices, device=device), 1)), 1)
+        most_probable_last_token_indices = torch.argmax(predicted_log_distributions, dim=-1)
+        token_ids[active, num_of_trg_tokens] = most_probable_last_token_indices
+
+        # Once we find EOS token for a particular sentence we stop decoding it
+        is_decoded = most_probable_last_token_indices == eos_token_id
+        lengths[active] = lengths[active].masked_fill(is_decoded, num_of_trg_tokens + 1)
+        if is_decoded.any():
+            keep = torch.nonzero(~is_decoded, as_tuple=True)[0]
+            if len(keep) == 0:
+                break
+            active = active[keep]
+            src_representations_batch = src_representations_batch[keep]
+            src_mask = src_mask[keep]
+            if cache is not None:
+                baseline_transformer.select_decoder_cache(cache, keep)
 
     # Post process the sentences - remove everything after the EOS token
     target_sentences_tokens_post = []
-    for target_sentence_tokens in target_sentences_tokens:
-        try:
-            target_index = target_sentence_tokens.index(EOS_TOKEN) + 1
-        except:
-            target_index = None
-
-        target_sentence_tokens = target_sentence_tokens[:target_index]
-        target_sentences_tokens_post.append(target_sentence_tokens)
+    for target_sentence_ids, length in zip(token_ids.cpu().tolist(), lengths.cpu().tolist()):
+        target_sentences_tokens_post.append([trg_field_processor.vocab.itos[id] for id in target_sentence_ids[:length]])
 
+    if return_token_ids:
+        token_ids.masked_fill_(torch.arange(token_ids.shape[1], device=device)[None, :] >= lengths[:, None], pad_token_id)
+        return target_sentences_tokens_post, token_ids
     return target_sentences_tokens_post
 
 
 def get_beam_decoder(translation_config):
     """
-    Note: this implementation could probably be further optimized I just wanted a decent working version.
-
     Notes:
 
     https://arxiv.org/pdf/1609.08144.pdf introduces various heuristics into the beam search algorithm like coverage
     penalty, etc. Here I only designed a simple beam search algorithm with length penalty. As the probability of the
     sequence is constructed by multiplying the conditional probabilities (which are numbers smaller than 1) the beam
-    search algorithm will prefer shorter sentences which we compensate for using the length penalty.
+    search algorithm will prefer shorter sentences which we compensate for using the length penalty
+    lp(Y) = ((5 + |Y|) / 6) ^ length_penalty_coefficient of the same paper (the hypotheses are ranked by log P(Y) / lp(Y)).
+
+    All the hypotheses of all the sentences are decoded as a single batch of B*BS sentences and the selection is done
+    with tensor ops, so the loop never leaves the device (except for a check whether every hypothesis is finished).
 
     """
     beam_size = translation_config['beam_size']
     length_penalty_coefficient = translation_config['length_penalty_coefficient']
 
-    def beam_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=100):
-        raise Exception('Not yet implemented.')
+    def length_penalty(lengths):
+        return ((5. + lengths) / 6.) ** length_penalty_coefficient
+
+    def beam_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=MAX_LEN, return_token_ids=False):
         device = next(baseline_transformer.parameters()).device
         pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
-
-        # Initial prompt is the beginning/start of the sentence token. Make it compatible shape with source batch => (B,1)
-        batch_size, S, model_dimension = src_representations_batch.shape
-        target_multiple_hypotheses_tokens = [[BOS_TOKEN] for _ in range(batch_size)]
-        trg_token_ids_batch = torch.tensor([[trg_field_processor.vocab.stoi[tokens[0]]] for tokens in target_multiple_hypotheses_tokens], device=device)
+        eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
+        batch_size = src_representations_batch.shape[0]
 
         # Repeat so that source sentence representations are repeated contiguously, say we have [s1, s2] we want
         # [s1, s1, s2, s2] and not [s1, s2, s1, s2] where s1 is single sentence representation with shape=(S, D)
         # where S - max source token-sequence length, D - model dimension
-        src_representations_batch = src_representations_batch.repeat(1, beam_size, 1).view(beam_size*batch_size, -1, model_dimension)
-        trg_token_ids_batch = trg_token_ids_batch.repeat(beam_size, 1)
-
-        hypotheses_log_probs = torch.zeros((batch_size * beam_size, 1), device=device)
-        had_eos = [[False] for _ in range(hypotheses_log_probs.shape[0])]
-
-        while True:
-            trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
-            # Shape = (B*BS*T, V) T - current token-sequence length, V - target vocab size, BS - beam size, B - batch
-            predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
-
-            # Extract only the indices of last token for every target sentence (we take every T-th token)
-            # Shape = (B*BS, V)
-            num_of_trg_tokens = trg_token_ids_batch.shape[-1]
-            predicted_log_distributions = predicted_log_distributions[num_of_trg_tokens - 1::num_of_trg_tokens]
-
-            # This time extract beam_size number of highest probability tokens (compare to greedy's arg max)
-            # Shape = (B*BS, BS)
-            latest_token_log_probs, most_probable_token_indices = torch.topk(predicted_log_distributions, beam_size, dim=-1, sorted=True)
-
-            # Don't update the hypothesis which had EOS already (pruning)
-            latest_token_log_probs.masked_fill(torch.tensor(had_eos == True), float("-inf"))
-
-            # Calculate probabilities for every beam hypothesis (since we have log prob we add instead of multiply)
-            # Shape = (B*BS, BS)
-            hypotheses_pool_log_probs = hypotheses_log_probs + latest_token_log_probs
-            # Shape = (B, BS, BS)
-            most_probable_token_indices = most_probable_token_indices.view(batch_size, beam_size, beam_size)
-            hypotheses_pool_log_probs = hypotheses_pool_log_probs.view(batch_size, beam_size, beam_size)
-            # Shape = (B, BS*BS)
-            hypotheses_pool_log_probs = torch.flatten(hypotheses_pool_log_probs, start_dim=-1)
-
-            # Figure out indices of beam_size most probably hypothesis for every target sentence in the batch
-            # Shape = (B, BS)
-            new_hypothesis_log_probs, next_hypothesis_indices = torch.topk(hypotheses_pool_log_probs, beam_size, dim=-1, sorted=True)
-
-            # Create new target ids batch
-            hypotheses_log_probs_tmp = torch.empty((batch_size * beam_size, 1))
-
-            T = trg_token_ids_batch.shape[-1]
-            new_trg_token_ids_batch = torch.empty((batch_size * beam_size, T + 1))
-
-            next_hypothesis_indices = next_hypothesis_indices.cpu().numpy()
-            # Prepare new hypotheses for the next iteration
-            for b_idx, indices in enumerate(next_hypothesis_indices):
-                for h_idx, token_index in indices:
-                    row, column = token_index / beam_size, token_index % beam_size
-                    hypothesis_index = b_idx * beam_size + h_idx
-
-                    new_token_id = most_probable_token_indices[b_idx, row, column]
-                    if had_eos[hypothesis_index]:
-                        new_trg_token_ids_batch[hypothesis_index, :-1] = trg_token_ids_batch[hypothesis_index, :]
-                    else:
-                        new_trg_token_ids_batch[hypothesis_index, :-1] = trg_token_ids_batch[b_idx * beam_size + row, :]
-                        new_trg_token_ids_batch[hypothesis_index, -1] = new_token_id
-
-                    if had_eos[hypothesis_index]:
-                        hypotheses_log_probs_tmp[hypothesis_index] = hypotheses_log_probs[hypothesis_index]
-                    else:
-                        hypotheses_log_probs_tmp[hypothesis_index] = new_hypothesis_log_probs[hypothesis_index]
-
-                    if new_token_id == trg_field_processor.vocab.stoi[EOS_TOKEN]:
-                        had_eos[hypothesis_index] = True
-
-            # Update the current hypothesis probabilities
-            hypotheses_log_probs = hypotheses_log_probs_tmp
-            trg_token_ids_batch = new_trg_token_ids_batch
-
-            if all(had_eos) or num_of_trg_tokens == max_target_tokens:
+        src_representations_batch = src_representations_batch.repeat_interleave(beam_size, dim=0)
+        src_mask = src_mask.repeat_interleave(beam_size, dim=0)
+
+        # Initial prompt is the beginning/start of the sentence token, shape = (B*BS, max_target_tokens + 1)
+        token_ids = torch.full((batch_size * beam_size, max_target_tokens + 1), pad_token_id, dtype=torch.long, device=device)
+        token_ids[:, 0] = trg_field_processor.vocab.stoi[BOS_TOKEN]
+
+        # Only the first hypothesis of every sentence is expanded at the first step (they are all the same), shape = (B, BS)
+        hypotheses_log_probs = torch.full((batch_size, beam_size), float("-inf"), device=device)
+        hypotheses_log_probs[:, 0] = 0.
+        # Number of predicted tokens (EOS included) of the finished hypotheses, shape = (B*BS)
+        hypotheses_lengths = torch.full((batch_size * beam_size,), max_target_tokens, dtype=torch.long, device=device)
+        had_eos = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=device)
+        # Index of the first hypothesis of every sentence in the B*BS batch, shape = (B, 1)
+        batch_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+
+        cache = None
+        if baseline_transformer.supports_incremental_decoding():
+            cache = baseline_transformer.init_decoder_cache(src_representations_batch, max_target_tokens)
+
+        for num_of_trg_tokens in range(1, max_target_tokens + 1):
+            trg_token_ids_batch = token_ids[:, :num_of_trg_tokens]
+            if cache is not None:
+                trg_mask = (trg_token_ids_batch != pad_token_id).view(trg_token_ids_batch.shape[0], 1, 1, -1)
+                # Shape = (B*BS, V), V - target vocab size
+                predicted_log_distributions = baseline_transformer.decode_step(trg_token_ids_batch[:, -1:], cache, trg_mask, src_mask)
+            else:
+                trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
+                # Shape = (B*BS*T, V) T - current token-sequence length
+                predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
+                # Extract only the last token of every hypothesis (we take every T-th token), shape = (B*BS, V)
+                predicted_log_distributions = predicted_log_distributions[num_of_trg_tokens - 1::num_of_trg_tokens]
+            vocab_size = predicted_log_distributions.shape[-1]
+
+            # Don't update the hypotheses which had EOS already (pruning): their only continuation is a pad token
+            # which keeps their probability as it is
+            predicted_log_distributions = predicted_log_distributions.masked_fill(had_eos.unsqueeze(1), float("-inf"))
+            predicted_log_distributions[:, pad_token_id].masked_fill_(had_eos, 0.)
+
+            # Calculate probabilities for every continuation of every hypothesis (log probs are added), shape = (B*BS, V)
+            hypotheses_pool_log_probs = hypotheses_log_probs.view(-1, 1) + predicted_log_distributions
+            # Finished hypotheses keep their length, the others have num_of_trg_tokens predicted tokens
+            pool_lengths = torch.where(had_eos, hypotheses_lengths, torch.full_like(hypotheses_lengths, num_of_trg_tokens))
+            hypotheses_pool_scores = hypotheses_pool_log_probs / length_penalty(pool_lengths.float()).unsqueeze(1)
+
+            # Figure out indices of beam_size most probable hypotheses for every sentence in the batch, shape = (B, BS)
+            _, next_hypothesis_indices = torch.topk(hypotheses_pool_scores.view(batch_size, beam_size * vocab_size), beam_size, dim=-1, sorted=True)
+            hypotheses_log_probs = torch.gather(hypotheses_pool_log_probs.view(batch_size, beam_size * vocab_size), 1, next_hypothesis_indices)
+
+            # Hypothesis which is continued and the token appended to it, shape = (B*BS)
+            previous_hypotheses = (batch_offsets + next_hypothesis_indices // vocab_size).view(-1)
+            new_token_ids = (next_hypothesis_indices % vocab_size).view(-1)
+
+            # Reorder the state of the hypotheses and append the new tokens
+            token_ids = token_ids.index_select(0, previous_hypotheses)
+            token_ids[:, num_of_trg_tokens] = new_token_ids
+            had_eos = had_eos.index_select(0, previous_hypotheses)
+            hypotheses_lengths = hypotheses_lengths.index_select(0, previous_hypotheses)
+            is_eos = (new_token_ids == eos_token_id) & ~had_eos
+            hypotheses_lengths = torch.where(is_eos, torch.full_like(hypotheses_lengths, num_of_trg_tokens), hypotheses_lengths)
+            had_eos = had_eos | is_eos
+            if cache is not None:
+                baseline_transformer.select_decoder_cache(cache, previous_hypotheses)
+
+            if had_eos.all():
                 break
 
         #
         # Selection and post-processing
         #
 
-        target_multiple_hypotheses_tokens = []
-        trg_token_ids_batch_numpy = trg_token_ids_batch.cpu().numpy()
-        for hypothesis_ids in trg_token_ids_batch_numpy:
-            target_multiple_hypotheses_tokens.append([trg_field_processor.vocab.itos[token_id] for token_id in hypothesis_ids])
-
         # Step 1: Select the most probable hypothesis out of beam_size hypotheses for each target sentence
-        hypotheses_log_probs = hypotheses_log_probs.view(batch_size, beam_size)
-        most_probable_hypotheses_indices = torch.argmax(hypotheses_log_probs, dim=-1).cpu().numpy()
-        target_sentences_tokens = []
-        for b_idx, index in enumerate(most_probable_hypotheses_indices):
-            target_sentences_tokens.append(target_multiple_hypotheses_tokens[b_idx * beam_size + index])
+        hypotheses_scores = hypotheses_log_probs / length_penalty(hypotheses_lengths.float()).view(batch_size, beam_size)
+        best_hypotheses = batch_offsets.view(-1) + torch.argmax(hypotheses_scores, dim=-1)
+        token_ids = token_ids.index_select(0, best_hypotheses)
+        lengths = hypotheses_lengths.index_select(0, best_hypotheses) + 1  # the BOS token is kept
 
         # Step 2: Post process the sentences - remove everything after the EOS token
         target_sentences_tokens_post = []
-        for target_sentence_tokens in target_sentences_tokens:
-            try:
-                target_index = target_sentence_tokens.index(EOS_TOKEN) + 1
-            except:
-                target_index = None
-
-            target_sentence_tokens = target_sentence_tokens[:target_index]
-            target_sentences_tokens_post.append(target_sentence_tokens)
+        for target_sentence_ids, length in zip(token_ids.cpu().tolist(), lengths.cpu().tolist()):
+            target_sentences_tokens_post.append([trg_field_processor.vocab.itos[id] for id in target_sentence_ids[:length]])
 
+        if return_token_ids:
+            token_ids.masked_fill_(torch.arange(token_ids.shape[1], device=device)[None, :] >= lengths[:, None], pad_token_id)
+            return target_sentences_tokens_post, token_ids
         return target_sentences_tokens_post
 
     return beam_decoding
-
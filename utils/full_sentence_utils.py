@@ -3,13 +3,23 @@ import math
 import torch
 import numpy as np
 import torch.nn as nn
-from torch.nn.utils.rnn import pad_sequence
 from models.definitions.transformer_model import MultiHeadedAttention, Transformer
+from models.definitions.ALSR_FF import FusedHeadsFF
+from models.definitions.ALR_FF import LengthAdaptiveFF, apply_token_mask
+from models.definitions.low_rank_FF import get_substitute_class
+from models.definitions.block_sparse_FF import BLOCK_SIZE, to_block_sparse
+from utils.precision_utils import cast_linear_weights
 
 from utils.constants import *
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # checking whether you have a GPU, I hope so!
 
+def pad_to_max_len(batch):
+    """Zero pads the tokens (dim 1) of a B x S x MD batch or of a B x S mask to MAX_LEN, in a single allocation."""
+    padded = batch.new_zeros((batch.shape[0], MAX_LEN, *batch.shape[2:]))
+    padded[:, :batch.shape[1]] = batch
+    return padded
+
 class EncoderLayerSubstitute(nn.Module):
     """This class replaces the entire sublayer logic. It gets from the second layer from the original Layer and substitutes the first one 
         with the provided FF. The first layer, in the original transformer corresponds to mha, residual connectio and layer norm.
@@ -57,16 +67,21 @@ class SublayerZeroSubstitute(torch.nn.Module):
         """
         mask = torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1)
         output_shape = src_representations_batch.shape
+        if isinstance(self.FFNetwork, LengthAdaptiveFF):
+            # No padding to MAX_LEN, only the S tokens of the batch go through the network
+            src_representations_batch = apply_token_mask(torch.reshape(src_representations_batch, (output_shape[0], output_shape[1]*output_shape[2])), mask)
+            src_representations_batch = self.FFNetwork(src_representations_batch, mask, [output_shape[1]])
+            return torch.reshape(src_representations_batch, output_shape)
         # Pad and Reshape
-        src_representations_batch = torch.cat([ src_representations_batch, torch.zeros(pad_shape(src_representations_batch), device = self.device) ], dim = 1)
+        # the mask stays B x MAX_LEN, the network broadcasts it over the features of every token
+        src_representations_batch = pad_to_max_len(src_representations_batch)
         intermediate_shape = src_representations_batch.shape
-        mask = torch.cat([mask, torch.zeros(pad_shape(mask, masks = True), device = self.device, dtype=torch.bool) ], dim = 1)
-        mask = torch.repeat_interleave(mask, src_representations_batch.shape[-1] ,dim=1)
+        mask = pad_to_max_len(mask)
         src_representations_batch = torch.reshape(src_representations_batch, 
                                                 (src_representations_batch.shape[0],src_representations_batch.shape[1]*src_representations_batch.shape[2]))
         
         # Feed through the network
-        src_representations_batch = src_representations_batch * mask
+        src_representations_batch = apply_token_mask(src_representations_batch, mask)
         src_representations_batch = self.FFNetwork(src_representations_batch, mask)
         
         # Reshape and unpdad
@@ -139,7 +154,8 @@ class AttentionSubstituteSeparateHeads(nn.Module):
         """Substitutes each attention head with a FF.
 
         Args:
-            ff_list (list[FF_network]): Feed forward nets that compute the attention values
+            ff_list (list[FF_network] or FusedHeadsFF): Feed forward nets that compute the attention values, either one
+                per head or all the heads fused in a single module
         """
         super().__init__()
         self.ff_list = ff_list
@@ -161,24 +177,25 @@ class AttentionSubstituteSeparateHeads(nn.Module):
         B = len(value)
         HD = BASELINE_MODEL_DIMENSION // BASELINE_MODEL_NUMBER_OF_HEADS
         # 1. Pad to MAX_LEN
-        inputs = torch.cat([value, torch.zeros(pad_shape(value), device = self.device)], dim = 1)
+        inputs = pad_to_max_len(value)
         inputs_shape = inputs.shape
-        mask = torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1)
-        mask = torch.cat([mask, torch.zeros(pad_shape(mask, masks = True), device = self.device, dtype=torch.bool) ], dim = 1)
+        mask = pad_to_max_len(torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1))
         # 2. Flatten
-        mask = torch.repeat_interleave(mask, inputs.shape[-1] ,dim=1)
         inputs = inputs.reshape((inputs_shape[0], inputs_shape[1]* inputs_shape[2]))
-        # 3. Compute
-        inputs = inputs*mask
-        mask = mask.reshape((B,MAX_LEN  * HD, BASELINE_MODEL_NUMBER_OF_HEADS)).transpose(1,2)
-        outputs = []
-        for h, ff in enumerate(self.ff_list):
-            # inputs.shape = B x MAX_LEN * MD
-            # mask.shape   = B x MAX_LEN * HD
-            # outputs[i] has shape BxMAX_LENxHD, HD = head dimension
-            outputs.append(ff.forward(inputs, mask[:,h]))
-        # shape = BxNHxMAX_LEN*HD
-        outputs = torch.stack(outputs, dim = 1)
+        # 3. Compute, the B x MAX_LEN mask is broadcast over the MD input and HD output features of every token
+        inputs = apply_token_mask(inputs, mask)
+        if isinstance(self.ff_list, FusedHeadsFF):
+            # all the heads at once, shape = BxNHxMAX_LEN*HD
+            outputs = self.ff_list(inputs, mask)
+        else:
+            outputs = []
+            for h, ff in enumerate(self.ff_list):
+                # inputs.shape = B x MAX_LEN * MD
+                # mask.shape   = B x MAX_LEN
+                # outputs[i] has shape BxMAX_LENxHD, HD = head dimension
+                outputs.append(ff.forward(inputs, mask))
+            # shape = BxNHxMAX_LEN*HD
+            outputs = torch.stack(outputs, dim = 1)
         # 4. Unflatten and unpad
         # shape = BxNHxSxHD
         outputs = outputs.reshape((outputs.shape[0], outputs.shape[1], MAX_LEN, -1))
@@ -308,17 +325,20 @@ class AttentionSubstitute(nn.Module):
         S = value.shape[1]
         B = len(value)
         HD = BASELINE_MODEL_DIMENSION // BASELINE_MODEL_NUMBER_OF_HEADS
+        if isinstance(self.ff, LengthAdaptiveFF):
+            # No padding to MAX_LEN, only the S tokens of the batch go through the network
+            mask = torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1)
+            inputs = apply_token_mask(value.reshape((B, S * value.shape[-1])), mask)
+            outputs = self.ff(inputs, mask, [S])
+            return outputs.reshape((B, S, -1, HD)).transpose(1,2)
         # 1. Pad to MAX_LEN
-        inputs = torch.cat([value, torch.zeros(pad_shape(value), device = self.device)], dim = 1)
+        inputs = pad_to_max_len(value)
         inputs_shape = inputs.shape
-        mask = torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1)
-        mask = torch.cat([mask, torch.zeros(pad_shape(mask, masks = True), device = self.device, dtype=torch.bool) ], dim = 1)
+        mask = pad_to_max_len(torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1))
         # 2. Flatten
-        mask = torch.repeat_interleave(mask, inputs.shape[-1] ,dim=1)
         inputs = inputs.reshape((inputs_shape[0], inputs_shape[1]* inputs_shape[2]))
-        # 3. Compute
-        inputs = inputs*mask
-        # mask = mask.reshape((B,MAX_LEN  * HD, BASELINE_MODEL_NUMBER_OF_HEADS)).transpose(1,2)
+        # 3. Compute, the B x MAX_LEN mask is broadcast over the features of every token
+        inputs = apply_token_mask(inputs, mask)
         outputs = self.ff(inputs, mask)
         # 4. Unflatten and unpad
         # shape = BxNHxSxHD
@@ -353,26 +373,26 @@ class AttentionSubstituteDecoderCA(nn.Module):
         B = len(value)
         S = query.shape[1]
         HD = BASELINE_MODEL_DIMENSION // BASELINE_MODEL_NUMBER_OF_HEADS
+        if isinstance(self.ff, LengthAdaptiveFF):
+            # No padding to MAX_LEN, the source and target tokens of the batch are concatenated
+            enc_mask = torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1)
+            enc_inputs = apply_token_mask(value.reshape((B, value.shape[1] * value.shape[2])), enc_mask)
+            dec_inputs = query.reshape((B, S * query.shape[2]))
+            dec_mask = torch.ones((B, S), device = self.device, dtype=torch.bool)
+            outputs = self.ff(torch.cat([enc_inputs, dec_inputs], dim = 1), dec_mask, [value.shape[1], S])
+            return outputs.reshape((B, S, -1, HD)).transpose(1,2)
         # 1. Pad to MAX_LEN
-        enc_inputs = torch.cat([value, torch.zeros(pad_shape(value), device = self.device)], dim = 1)
-        enc_inputs_shape = enc_inputs.shape
-
-        dec_inputs = torch.cat([query, torch.zeros(pad_shape(query), device = self.device)], dim = 1)
-        dec_inputs_shape = dec_inputs.shape
-        # 2. Flatten
-        mask = torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1)
-        mask = torch.cat([mask, torch.zeros(pad_shape(mask, masks = True), device = self.device, dtype=torch.bool) ], dim = 1)
-        # 2. Flatten
-        enc_mask = torch.repeat_interleave(mask, enc_inputs.shape[-1] ,dim=1)
-        dec_mask = torch.cat([torch.ones((B, S), device = self.device, dtype=torch.bool), torch.zeros((B, MAX_LEN-S), device = self.device, dtype=torch.bool)], dim = 1)
-        dec_mask = torch.repeat_interleave(dec_mask, dec_inputs.shape[-1] ,dim=1)
-        enc_inputs = enc_inputs.reshape((enc_inputs_shape[0], enc_inputs_shape[1]* enc_inputs_shape[2]))
-        dec_inputs = dec_inputs.reshape((dec_inputs_shape[0], dec_inputs_shape[1]* dec_inputs_shape[2]))
+        # source and target tokens are written in a single B x 2 * MAX_LEN x MD buffer
+        inputs = value.new_zeros((B, 2 * MAX_LEN, value.shape[-1]))
+        inputs[:, :value.shape[1]] = value
+        inputs[:, MAX_LEN:MAX_LEN + S] = query
+        # 2. Flatten, the masks stay B x MAX_LEN and are broadcast over the features of every token
+        enc_mask = pad_to_max_len(torch.squeeze(torch.squeeze(mask, dim = 1), dim = 1))
+        dec_mask = torch.arange(MAX_LEN, device = self.device)[None, :].expand(B, -1) < S
+        inputs = inputs.reshape((B, 2 * MAX_LEN * value.shape[-1]))
 
         # 3. Compute
-        enc_inputs = enc_inputs*enc_mask
-        dec_inputs = dec_inputs*dec_mask
-        inputs = torch.cat([enc_inputs, dec_inputs], dim = 1)
+        inputs = apply_token_mask(inputs, torch.cat([enc_mask, dec_mask], dim = 1))
         # mask = mask.reshape((B,MAX_LEN  * HD, BASELINE_MODEL_NUMBER_OF_HEADS)).transpose(1,2)
         outputs = self.ff(inputs, dec_mask)
         # 4. Unflatten and unpad
@@ -425,25 +445,23 @@ class AttentionSubstituteDecoder(nn.Module):
         B = len(value)
         HD = BASELINE_MODEL_DIMENSION // BASELINE_MODEL_NUMBER_OF_HEADS
         batch_size = value.shape[0]
+        if isinstance(self.ff, LengthAdaptiveFF):
+            # No padding to MAX_LEN, the causal prefixes are cut to the S tokens of the batch
+            outputs = self.ff(value, mask.squeeze(dim = 1)[:, -1], [S])
+            return outputs.reshape((B, S, -1, HD)).transpose(1,2)
         # 1. Pad to MAX_LEN
-        inputs = torch.cat([value, torch.zeros(pad_shape(value), device = self.device)], dim = 1)
-        mask = mask.squeeze(dim = 1)
-        trg_padding_mask = pad_sequence([x[-1] for x in mask], batch_first=True, padding_value=0)
-        trg_padding_mask = torch.cat([trg_padding_mask, torch.zeros(pad_shape(trg_padding_mask, masks = True), dtype=torch.bool, device = self.device)], dim = 1).view(batch_size, 1, -1)
-         
-        trg_no_look_forward_mask = torch.triu(torch.ones((1, MAX_LEN, MAX_LEN), device=self.device) == 1).transpose(1, 2)
-
-        # logic AND operation (both padding mask and no-look-forward must be true to attend to a certain target token)
-        trg_mask = trg_padding_mask & trg_no_look_forward_mask  # final shape = (B, T, T)
+        inputs = pad_to_max_len(value)
+        # B x T padding mask (last row of the B x T x T mask), the no-look-forward part is applied by the network
+        trg_padding_mask = pad_to_max_len(mask.squeeze(dim = 1)[:, -1])
         # 3. Compute
-        outputs = self.ff(inputs, trg_mask)
+        outputs = self.ff(inputs, trg_padding_mask)
         outputs = outputs.reshape((outputs.shape[0], MAX_LEN, -1, HD)).transpose(1,2)
         outputs, padding =  torch.split(outputs,[S, MAX_LEN - S] , dim = 2)   
         return outputs 
 
-def substitute_ALR_encoder(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, multi_device):
+def substitute_ALR_encoder(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, multi_device, length_adaptive = False):
     import models.definitions.ALR_FF as m
-    FF_net = getattr(m, substitute_class)
+    FF_net = get_substitute_class(m, substitute_class)
     print(f"Substituing attention with {FF_net}")
     mha_to_mha2(baseline_transformer, attention_type="encoder")
     layers = layers if layers is not None else range(6)    
@@ -460,11 +478,13 @@ def substitute_ALR_encoder(baseline_transformer, substitute_class, substitute_mo
         else:
             print("Test uninitialized")
         ff_net.eval()
+        if length_adaptive:
+            ff_net = LengthAdaptiveFF(ff_net)
         replace_mha(baseline_transformer, ff_net, l, device, attention_type="encoder")
 
-def substitute_ALR_decoder(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, multi_device):
+def substitute_ALR_decoder(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, multi_device, length_adaptive = False):
     import models.definitions.ALR_FF as m
-    FF_net = getattr(m, substitute_class)
+    FF_net = get_substitute_class(m, substitute_class)
     print(f"Substituing attention with {FF_net}")
     mha_to_mha2(baseline_transformer, attention_type="decoder")
     layers = layers if layers is not None else range(6)    
@@ -481,11 +501,13 @@ def substitute_ALR_decoder(baseline_transformer, substitute_class, substitute_mo
         else:
             print("Test uninitialized")
         ff_net.eval()
+        if length_adaptive:
+            ff_net = LengthAdaptiveFF(ff_net)
         replace_mha(baseline_transformer, ff_net, l, device, attention_type="decoder")
 
-def substitute_ALR_decoder_ca(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, multi_device):
+def substitute_ALR_decoder_ca(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, multi_device, length_adaptive = False):
     import models.definitions.ALR_FF as m
-    FF_net = getattr(m, substitute_class)
+    FF_net = get_substitute_class(m, substitute_class)
     print(f"Substituing attention with {FF_net}")
     mha_to_mha2(baseline_transformer, attention_type="decoder_ca")
     layers = layers if layers is not None else range(6)    
@@ -502,9 +524,11 @@ def substitute_ALR_decoder_ca(baseline_transformer, substitute_class, substitute
         else:
             print("Test uninitialized")
         ff_net.eval()
+        if length_adaptive:
+            ff_net = LengthAdaptiveFF(ff_net, num_segments = 2)
         replace_mha(baseline_transformer, ff_net, l, device, attention_type="decoder_ca")
 
-def substitute_separate_mha(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained):
+def substitute_separate_mha(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, fused_heads = False):
     import models.definitions.ALSR_FF as m
     FF_net =getattr(m, substitute_class)
     print(f"Substituing attention with {FF_net}")
@@ -512,6 +536,13 @@ def substitute_separate_mha(baseline_transformer, substitute_class, substitute_m
     layers = layers if layers is not None else range(6)    
     print(layers)
     for l in layers:
+        if fused_heads and not untrained:
+            # pack the 8 per-head checkpoints into a single module evaluated with batched matmuls
+            model_paths = [os.path.join(substitute_model_path, f'layer{l}', MHA_SEPARATE_CHECKPOINT_FORMAT.format(epoch, l, h)) for h in range(8)]
+            fused = FusedHeadsFF.from_checkpoints(FF_net, model_paths, map_location=device).to(device)
+            fused.eval()
+            replace_ALSR(baseline_transformer, fused, l, device)
+            continue
         ff_nets=[]
         for h in range(8):
             ckpt_model_name = MHA_SEPARATE_CHECKPOINT_FORMAT.format(epoch,l, h)
@@ -524,11 +555,13 @@ def substitute_separate_mha(baseline_transformer, substitute_class, substitute_m
             else:
                 ff_net.train()
             ff_nets+=[ff_net]
+        if fused_heads:
+            ff_nets = FusedHeadsFF(ff_nets).to(device)
         replace_ALSR(baseline_transformer, ff_nets, l, device)
       
-def substitute_sublayer(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained):
+def substitute_sublayer(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, length_adaptive = False):
     import models.definitions.ALRR_FF as m
-    FF_net =getattr(m, substitute_class)
+    FF_net = get_substitute_class(m, substitute_class)
     print(f"Substituing attention with {FF_net}")
     mha_to_mha2(baseline_transformer)
     layers = layers if layers is not None else range(6)
@@ -544,11 +577,13 @@ def substitute_sublayer(baseline_transformer, substitute_class, substitute_model
             ff_net.eval()
         else:
             ff_net.train()
+        if length_adaptive:
+            ff_net = LengthAdaptiveFF(ff_net)
         replace_sublayer(baseline_transformer, ff_net, l, device)
 
-def substitute_encoder_layer(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained):
+def substitute_encoder_layer(baseline_transformer, substitute_class, substitute_model_path, layers, epoch, untrained, length_adaptive = False):
     import models.definitions.ELR_FF as m
-    FF_net =getattr(m, substitute_class)
+    FF_net = get_substitute_class(m, substitute_class)
     print(f"Substituing attention with {FF_net}")
     layers = layers if layers is not None else range(6)
     print(layers)
@@ -563,33 +598,86 @@ def substitute_encoder_layer(baseline_transformer, substitute_class, substitute_
             ff_net.eval()
         else:
             ff_net.train()
+        if length_adaptive:
+            ff_net = LengthAdaptiveFF(ff_net)
         replace_encoder(baseline_transformer, ff_net, l, device)
 
-def substitute_attention(baseline_transformer, substitute_class, substitute_model_path, layer, epoch,t, att_replacement, untrained=False,  multi_device = False):
+def substitute_attention(baseline_transformer, substitute_class, substitute_model_path, layer, epoch,t, att_replacement, untrained=False,  multi_device = False, fused_heads = False, length_adaptive = False, precision = "fp32", block_sparse = False, block_size = BLOCK_SIZE):
+    # modules of the model before the substitution, to find the substitutes afterwards
+    baseline_modules = set(baseline_transformer.modules())
     if t == "ALR":
         print("Substitute ALR layer")
         if att_replacement == "encoder":
-            substitute_ALR_encoder(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, multi_device)
+            substitute_ALR_encoder(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, multi_device, length_adaptive)
         elif att_replacement == "decoder":
-            substitute_ALR_decoder(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, multi_device)
+            substitute_ALR_decoder(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, multi_device, length_adaptive)
         elif att_replacement == "decoder_ca":
-            substitute_ALR_decoder_ca(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, multi_device)
+            substitute_ALR_decoder_ca(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, multi_device, length_adaptive)
         else:
             raise ValueError("Attention type in ['encoder', 'decoder', 'decoder_ca']")
     elif t == "ALRR":
         print("Substitute ALRR layer")
-        substitute_sublayer(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained)
+        substitute_sublayer(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, length_adaptive)
     elif t == "ALSR":
         print("Substitute ALSR layer")
-        substitute_separate_mha(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained)
+        substitute_separate_mha(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, fused_heads)
     elif t == "ELR":
         print("Substitute ELR layer")
-        substitute_encoder_layer(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained)
+        substitute_encoder_layer(baseline_transformer, substitute_class, substitute_model_path, layer, epoch, untrained, length_adaptive)
     else:
         raise ValueError("Attention type in ['ALR', 'ALRR', 'ALSR']")
+    if block_sparse:
+        # only the pruned Linears are sparse enough to be converted, the ones of the baseline stay dense and the
+        # substitutes of the previous calls are already converted, so the count is the one of this substitution
+        converted = to_block_sparse(baseline_transformer, block_size)
+        if converted == 0:
+            raise ValueError(f"ERROR: no Linear of the substitutes in {substitute_model_path} is block-sparse, pass the "
+                             f"checkpoints pruned by training_ALR.py --prune_sparsity <s>, e.g. --substitute_model_path "
+                             f"{os.path.join(CHECKPOINTS_SCRATCH, t, substitute_class)}_block_sparse<100 * s>.")
+        print(f"{converted} Linears converted to the block-sparse format")
+    # the length adaptive substitutes fold their first LayerNorm into precomputed tables and are kept in float32
+    substitutes = [m for m in baseline_transformer.modules() if m not in baseline_modules and type(m) == LengthAdaptiveFF]
+    frozen = set(m for substitute in substitutes for m in substitute.modules())
+    cast_linear_weights([m for m in baseline_transformer.modules() if m not in baseline_modules and m not in frozen and type(m) == nn.Linear], precision)
     
+# Suffix of the keys of an evaluation configuration (see validation_script.py) for every attention which can be substituted
+SUBSTITUTION_CONFIG_SUFFIXES = {"encoder": "", "decoder": "_d", "decoder_ca": "_d_ca"}
+
+def substitute_from_config(baseline_transformer, config):
+    """Applies the substitutions of an evaluation configuration.
+
+    Args:
+        config (dict): keys of validation_script.py, substitute_type, substitute_class, substitute_model_path, layers,
+            epoch and untrained for the encoder, the same keys with suffix _d for the decoder self attention and _d_ca for
+            the decoder cross attention, fused_heads, length_adaptive, precision, block_sparse and block_size. Missing keys take the defaults of validation_script.py
+    """
+    for att_replacement, suffix in SUBSTITUTION_CONFIG_SUFFIXES.items():
+        substitute_type = config.get("substitute_type" + suffix, "None")
+        if substitute_type == "None":
+            print("#"*100)
+            print(f"\n\t NO SUBSTITUTION IN {att_replacement.upper()}\n")
+            print("#"*100)
+            continue
+        substitute_class = config.get("substitute_class" + suffix, "FFNetwork_L")
+        substitute_model_path = config.get("substitute_model_path" + suffix)
+        if substitute_model_path is None:
+            substitute_model_path = os.path.join(CHECKPOINTS_SCRATCH, substitute_type, substitute_class)
+        substitute_attention(baseline_transformer,
+                             substitute_class,
+                             substitute_model_path,
+                             config.get("layers" + suffix),
+                             config.get("epoch" + suffix, 21),
+                             substitute_type,
+                             att_replacement,
+                             untrained = config.get("untrained" + suffix, False),
+                             fused_heads = config.get("fused_heads", False),
+                             length_adaptive = config.get("length_adaptive", False),
+                             precision = config.get("precision", "fp32"),
+                             block_sparse = config.get("block_sparse", False),
+                             block_size = tuple(config.get("block_size", BLOCK_SIZE)))
+
 def pad_shape(batch, masks = False):
     shape = batch.shape
     if masks:
         return shape[0],MAX_LEN-shape[1] 
-    return shape[0], MAX_LEN-shape[1], shape[2]
\ No newline at end of file
+    return shape[0], MAX_LEN-shape[1], shape[2]
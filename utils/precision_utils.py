@@ -0,0 +1,66 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+"""
+    Precision policy shared by the training and evaluation scripts (--precision).
+
+    fp32: everything runs in float32, as before.
+    bf16: the forward passes and the losses run under torch.autocast with bfloat16. The Linears and matmuls are
+          computed in bfloat16, autocast keeps the reductions, softmax, LayerNorms and losses in float32. The weights,
+          gradients and optimizer states stay in float32, bfloat16 has the exponent range of float32 so no loss
+          scaling is needed. The backward passes are run outside of the autocast region.
+"""
+
+PRECISIONS = ['fp32', 'bf16']
+PRECISION_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f"ERROR: precision must be in {PRECISIONS}, got {precision}.")
+    if precision != 'fp32' and not hasattr(torch, 'autocast'):
+        raise ValueError(f"ERROR: precision {precision} needs torch.autocast (PyTorch >= 1.10), found PyTorch {torch.__version__}.")
+
+def autocast(precision, device):
+    """Context manager running the enclosed forward pass in the given precision on device."""
+    check_precision(precision)
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=PRECISION_DTYPES[precision])
+
+def cast_linear_weights(modules, precision):
+    """Stores the weights of the Linears of modules in the compute dtype of the precision, so that autocast does not cast
+    them again at every forward pass (the 6400 x 6400 and 12800 x 12800 Linears of the L/XL substitutes dominate the
+    memory traffic). The LayerNorms are left in float32 as autocast would compute them. Evaluation only, the modules
+    must then be run under autocast(precision, ...).
+    """
+    check_precision(precision)
+    if precision == 'fp32':
+        return
+    for module in modules:
+        for m in module.modules():
+            if isinstance(m, nn.Linear):
+                m.to(PRECISION_DTYPES[precision])
+
+def report_loss_parity(compute_loss, precision, device, model=None, prefix=""):
+    """Prints the loss of the same batch computed in fp32 and with the precision policy.
+
+    Args:
+        compute_loss (callable): runs the forward pass and returns the (scalar) loss
+        model (nn.Module): put in eval mode during the comparison so that both losses see the same dropout masks
+    """
+    if precision == 'fp32':
+        return
+    training = model.training if model is not None else False
+    if model is not None:
+        model.eval()
+    with torch.no_grad():
+        fp32_loss = compute_loss().item()
+        with autocast(precision, device):
+            reduced_loss = compute_loss().item()
+    if model is not None:
+        model.train(training)
+    relative_difference = abs(reduced_loss - fp32_loss) / max(abs(fp32_loss), 1e-12)
+    print(f"{prefix}loss parity: fp32 = {fp32_loss:.6f}, {precision} = {reduced_loss:.6f}, relative difference = {relative_difference:.2e}")
+    return fp32_loss, reduced_loss
@@ -0,0 +1,65 @@
+import torch
+import torch.nn as nn
+
+from models.definitions.block_sparse_FF import BLOCK_SIZE
+
+"""
+    Block magnitude pruning of the FF substitutes during fine-tuning. The blocks of every Linear with the smallest
+    Frobenius norm are zeroed, the sparsity grows from 0 to its target between two epochs with the cubic schedule of
+    Zhu & Gupta ("To prune, or not to prune", 2017) so that the network can adapt. Rows (block size 1 x in) or columns
+    (out x 1) give structured pruning. The result is executed with models/definitions/block_sparse_FF.py.
+"""
+
+def block_norms(weight, block_size):
+    """Squared Frobenius norm of every block, shape = out / bo x in / bi."""
+    bo, bi = block_size
+    return weight.reshape(weight.shape[0] // bo, bo, weight.shape[1] // bi, bi).pow(2).sum(dim=(1, 3))
+
+class BlockMagnitudePruner:
+    def __init__(self, model, sparsity, block_size = BLOCK_SIZE, start_epoch = 0, end_epoch = 10):
+        """
+        Args:
+            model (nn.Module): FF substitute, all its Linears are pruned
+            sparsity (float): final fraction of zero blocks of every Linear
+            block_size (tuple[int]): out x in size of the blocks
+            start_epoch, end_epoch (int): the sparsity goes from 0 at start_epoch to sparsity at end_epoch
+        """
+        if not 0 <= sparsity < 1:
+            raise ValueError(f"ERROR: sparsity must be in [0, 1), got {sparsity}.")
+        self.linears = [m for m in model.modules() if type(m) == nn.Linear]
+        for linear in self.linears:
+            if linear.out_features % block_size[0] != 0 or linear.in_features % block_size[1] != 0:
+                raise ValueError(f"ERROR: block size {block_size} does not divide the {linear.out_features} x {linear.in_features} weight.")
+        self.sparsity = sparsity
+        self.block_size = tuple(block_size)
+        self.start_epoch = start_epoch
+        self.end_epoch = end_epoch
+        self.masks = {}
+
+    def sparsity_at(self, epoch):
+        if epoch >= self.end_epoch:
+            return self.sparsity
+        progress = max(epoch - self.start_epoch, 0) / (self.end_epoch - self.start_epoch)
+        return self.sparsity * (1 - (1 - progress) ** 3)
+
+    @torch.no_grad()
+    def update(self, epoch):
+        """Recomputes the block masks for the sparsity of epoch and applies them, returns the sparsity."""
+        sparsity = self.sparsity_at(epoch)
+        for linear in self.linears:
+            norms = block_norms(linear.weight, self.block_size)
+            mask = torch.ones_like(norms, dtype=torch.bool)
+            num_pruned = int(sparsity * norms.numel())
+            if num_pruned > 0:
+                mask.view(-1)[torch.argsort(norms.view(-1))[:num_pruned]] = False
+            self.masks[linear] = mask
+        self.apply()
+        return sparsity
+
+    @torch.no_grad()
+    def apply(self):
+        """Zeroes the pruned blocks, to be called after every optimizer step."""
+        bo, bi = self.block_size
+        for linear, mask in self.masks.items():
+            R, C = mask.shape
+            linear.weight.view(R, bo, C, bi).mul_(mask[:, None, :, None])
@@ -0,0 +1,92 @@
+import io
+
+import torch
+import torch.nn as nn
+try:
+    from torch.ao import quantization
+except ImportError:
+    from torch import quantization
+
+from models.definitions.ALR_FF import LengthAdaptiveFF
+from utils.full_sentence_utils import AttentionSubstitute, AttentionSubstituteDecoder, AttentionSubstituteDecoderCA, AttentionSubstituteSeparateHeads, SublayerZeroSubstitute
+
+"""
+    Post-training dynamic int8 quantization of a transformer after substitute_attention (CPU only). The weights of the
+    Linears are quantized once per output channel, the activations are quantized on the fly at every forward pass with
+    the range of the batch, so no calibration data is needed.
+    Not quantized: the length adaptive substitutes (they read the weights of their first Linear directly), the fused
+    ALSR heads (batched matmuls on stacked weights, no Linear) and the packed q/k/v projection of fuse_qkv (sliced for
+    the source attending attention).
+"""
+
+QUANTIZATION_MODES = ["None", "substitutes", "all"]
+
+# attribute of every adapter which holds the substitute network(s)
+SUBSTITUTE_NETWORK_ATTRIBUTES = {
+    AttentionSubstitute: "ff",
+    AttentionSubstituteDecoder: "ff",
+    AttentionSubstituteDecoderCA: "ff",
+    AttentionSubstituteSeparateHeads: "ff_list",
+    SublayerZeroSubstitute: "FFNetwork",
+}
+
+def check_quantization(device):
+    """Raises if the model cannot be quantized on device, the scripts call it before loading anything."""
+    if not hasattr(quantization, "per_channel_dynamic_qconfig"):
+        raise ValueError(f"ERROR: per channel dynamic quantization is not available in PyTorch {torch.__version__}.")
+    device = torch.device(device)
+    if device.type != "cpu":
+        raise ValueError(f"ERROR: int8 dynamic quantization runs on CPU, the model is on {device} (run with CUDA_VISIBLE_DEVICES=\"\").")
+
+def quantize_network(ff):
+    if isinstance(ff, LengthAdaptiveFF):
+        print("Length adaptive substitute kept in fp32")
+        return ff
+    return quantization.quantize_dynamic(ff, {nn.Linear: quantization.per_channel_dynamic_qconfig}, inplace=True)
+
+def quantize_transformer(transformer, mode="substitutes"):
+    """Quantizes the Linears of the substitutes, and with mode = "all" the remaining Linears of the baseline as well.
+
+    The model is modified in place. The per head ALSR substitutes are registered as a ModuleList so that their
+    quantized weights are part of the state dict (see save_quantized).
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"ERROR: quantization mode must be in {QUANTIZATION_MODES}, got {mode}.")
+    if mode == "None":
+        return transformer
+    check_quantization(next(transformer.parameters()).device)
+    for adapter in list(transformer.modules()):
+        attribute = SUBSTITUTE_NETWORK_ATTRIBUTES.get(type(adapter))
+        if attribute is None:
+            continue
+        ff = getattr(adapter, attribute)
+        if type(ff) == list:
+            setattr(adapter, attribute, nn.ModuleList([quantize_network(f) for f in ff]))
+        else:
+            setattr(adapter, attribute, quantize_network(ff))
+    if mode == "all":
+        qconfig_spec = {nn.Linear: quantization.per_channel_dynamic_qconfig}
+        for name, module in transformer.named_modules():
+            if isinstance(module, LengthAdaptiveFF):
+                # the qconfig of a Linear is looked up by type before the one of its parent, so every submodule of the
+                # length adaptive substitutes has to be excluded by name
+                for submodule_name, _ in module.named_modules(prefix=name):
+                    qconfig_spec[submodule_name] = None
+            elif name.endswith("qkv_projection"):
+                qconfig_spec[name] = None
+        quantization.quantize_dynamic(transformer, qconfig_spec, inplace=True)
+    return transformer
+
+def save_quantized(transformer, path):
+    torch.save({"state_dict": transformer.state_dict()}, path)
+
+def load_quantized(transformer, path):
+    """Loads a checkpoint of save_quantized into a transformer with the same substitutions, quantized with the same mode."""
+    transformer.load_state_dict(torch.load(path, map_location="cpu")["state_dict"], strict=True)
+    return transformer
+
+def state_dict_size(model):
+    """Size in MB of the serialized state dict."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
@@ -2,13 +2,13 @@ import time
 import numpy as np
 import os
 import copy
-from pickle import UnpicklingError
 
 import torch
 from torch import nn
 
 import utils.utils as utils
 from utils.constants import *
+from utils.activation_store import ActivationStore
 
 # Dataset with a single word and the average of its sentence as input
 class SingleWordsInterResultsDataset(torch.utils.data.Dataset):
@@ -17,21 +17,21 @@ class SingleWordsInterResultsDataset(torch.utils.data.Dataset):
         assert(ext_pref in ["ELR", "ALR", "ALRR"])
         pref = f"128emb_20ep_IWSLT_E2G"
 
-        mask_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_masks_{t}")
-        input_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{ext_pref}_layer{index_in}_inputs_{t}")
-        output_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{ext_pref}_layer{index_out}_outputs_{t}")
+        store_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{t}.store")
+        in_field = f"{ext_pref}_layer{index_in}_inputs"
+        out_field = f"{ext_pref}_layer{index_out}_outputs"
 
         self.index_in = index_in
         self.index_out = index_out
 
-        print(f"Starting to load datasets from {input_path} and {output_path} and {mask_path}")
+        print(f"Starting to load datasets {in_field} and {out_field} from {store_path}")
         start = time.time()
 
         self.input = []
         self.output = []
 
-        in_cache = f"{input_path}_single.cache"
-        out_cache = f"{output_path}_single.cache"
+        in_cache = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{in_field}_{t}_single.cache")
+        out_cache = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{out_field}_{t}_single.cache")
 
         if os.path.exists(in_cache) and os.path.exists(out_cache):
             self.input = torch.load(in_cache, map_location=device)
@@ -40,34 +40,15 @@ class SingleWordsInterResultsDataset(torch.utils.data.Dataset):
             print(f"Loaded {len(self.output)} samples (flattened) in {time.time() - start}s")
             return
 
-        inf = open(input_path, "rb")
-        outf = open(output_path, "rb")
-        maskf = open(mask_path, "rb")
-
-        try:
-            while(True):
-                # input dimension: B x L x 128
-                i = torch.from_numpy(np.load(inf))
-                # mask dimension: B x 1 x 1 x L
-                m = torch.from_numpy(np.load(maskf))
-                # output dimension: B x L x 128
-                o = torch.from_numpy(np.load(outf))
-                m = m.squeeze(dim=1)
-                m = m.squeeze(dim=1)
-                denom = m.sum(dim = 1)
-                avg = torch.sum(i * m.unsqueeze(2), dim=1) / denom.reshape((-1, 1))
-                for j, s in enumerate(i):
-                    inp = torch.cat([s[:denom[j]], avg[j].expand((denom[j], 128))], dim=1)
-                    self.input.append(inp)
-                    out = o[j, :denom[j]]
-                    self.output.append(out)
-        except (UnpicklingError, ValueError):
-            print(f"Finished disk access")
-            print(f"Still need to change the dataset in-memory!")
-        finally:
-            inf.close()
-            outf.close()
-            maskf.close()
+        store = ActivationStore(store_path)
+        for j in range(len(store)):
+            # records only hold the non-padded tokens -> input dimension: L x 128, output dimension: L x 128
+            s = torch.from_numpy(np.asarray(store.get(in_field, j), dtype=np.float32))
+            o = torch.from_numpy(np.asarray(store.get(out_field, j), dtype=np.float32))
+            avg = s.mean(dim=0)
+            self.input.append(torch.cat([s, avg.expand((s.shape[0], 128))], dim=1))
+            self.output.append(o)
+        print(f"Finished disk access")
         self.input = torch.cat(self.input, dim=0).to(device)
         self.output = torch.cat(self.output, dim=0).to(device)
         torch.save(self.input, in_cache)
@@ -81,47 +62,38 @@ class SingleWordsInterResultsDataset(torch.utils.data.Dataset):
         return (self.input[idx], self.output[idx])
 
 # Dataset for unchanged access to the data extracted from the transformer (used in sim_all_together.py)
+# Every sample is a batch with a single sentence, since the store only keeps the non-padded tokens
 class UnchangedDataset(torch.utils.data.Dataset):
     def __init__(self, index_in, index_out, t, device, ext_pref):
         assert(t in ["train", "test", "val"])
         assert(ext_pref in ["ELR", "ALR", "ALRR"])
         pref = "128emb_20ep_IWSLT_E2G"
 
-        mask_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_masks_{t}")
-        input_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{ext_pref}_layer{index_in}_inputs_{t}")
-        output_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{ext_pref}_layer{index_out}_outputs_{t}")
+        store_path = os.path.join(LAYER_OUTPUT_PATH, f"{pref}_{t}.store")
+        in_field = f"{ext_pref}_layer{index_in}_inputs"
+        out_field = f"{ext_pref}_layer{index_out}_outputs"
 
         self.index_in = index_in
         self.index_out = index_out
 
-        print(f"Starting to load datasets from {input_path} and {output_path} and {mask_path}")
+        print(f"Starting to load datasets {in_field} and {out_field} from {store_path}")
         start = time.time()
 
         self.input = []
         self.output = []
         self.mask = []
 
-        inf = open(input_path, "rb")
-        outf = open(output_path, "rb")
-        maskf = open(mask_path, "rb")
-
-        try:
-            while(True):
-                # input dimension: B x L x 128
-                i = torch.from_numpy(np.load(inf)).to(device)
-                # mask dimension: B x 1 x 1 x L
-                m = torch.from_numpy(np.load(maskf)).to(device)
-                # output dimension: B x L x 128
-                o = torch.from_numpy(np.load(outf)).to(device)
-                self.input.append(i)
-                self.output.append(o)
-                self.mask.append(m)
-        except (UnpicklingError, ValueError):
-            pass
-        finally:
-            inf.close()
-            outf.close()
-            maskf.close()
+        store = ActivationStore(store_path)
+        for j in range(len(store)):
+            # input dimension: 1 x L x 128
+            i = torch.from_numpy(np.asarray(store.get(in_field, j), dtype=np.float32)).unsqueeze(0).to(device)
+            # output dimension: 1 x L x 128
+            o = torch.from_numpy(np.asarray(store.get(out_field, j), dtype=np.float32)).unsqueeze(0).to(device)
+            # mask dimension: 1 x 1 x 1 x L
+            m = torch.ones((1, 1, 1, i.shape[1]), dtype=torch.bool, device=device)
+            self.input.append(i)
+            self.output.append(o)
+            self.mask.append(m)
         print(f"Loaded {len(self.output)} samples (flattened) in {time.time() - start}s")
 
     def __len__(self):
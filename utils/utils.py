@@ -5,12 +5,13 @@ import time
 
 import git
 import torch
-from nltk.translate.bleu_score import corpus_bleu
 
 
-from .constants import BINARIES_PATH, PAD_TOKEN
-from .decoding_utils import greedy_decoding
+from .constants import BINARIES_PATH, PAD_TOKEN, EOS_TOKEN
+from .bleu_utils import CorpusBleuAccumulator, lengths_up_to_eos
+from .decoding_utils import greedy_decoding, get_beam_decoder, DecodingMethod
 from .data_utils import get_masks_and_count_tokens_src
+from .precision_utils import autocast
 
 
 def get_available_binary_name():
@@ -60,32 +61,45 @@ def print_model_metadata(training_state):
 
 
 # Calculate the BLEU-4 score
-def calculate_bleu_score(transformer, token_ids_loader, trg_field_processor):
+# encoder_outputs (optional): dict batch index -> (src_representations_batch, src_mask), filled on the first call and
+# reused by the following ones, only valid if the batches and the encoder are the same (see validation_grid.py)
+def calculate_bleu_score(transformer, token_ids_loader, trg_field_processor, decoding_method=DecodingMethod.GREEDY, beam_size=4, length_penalty_coefficient=0.6, encoder_outputs=None, precision='fp32'):
+    if decoding_method == DecodingMethod.GREEDY:
+        decoding = greedy_decoding
+    else:
+        decoding = get_beam_decoder({'beam_size': beam_size, 'length_penalty_coefficient': length_penalty_coefficient})
+
     with torch.no_grad():
         pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+        eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
 
-        gt_sentences_corpus = []
-        predicted_sentences_corpus = []
+        # n-gram statistics are accumulated batch by batch from the token ids (same score as nltk's corpus_bleu)
+        bleu = CorpusBleuAccumulator()
 
         ts = time.time()
         for batch_idx, token_ids_batch in enumerate(token_ids_loader):
             src_token_ids_batch, trg_token_ids_batch = token_ids_batch.src, token_ids_batch.trg
             if batch_idx % 10 == 0:
-                print(f'batch={batch_idx}, time elapsed = {time.time()-ts} seconds.')
-
-            # Optimization - compute the source token representations only once
-            src_mask, _ = get_masks_and_count_tokens_src(src_token_ids_batch, pad_token_id)
-            src_representations_batch = transformer.encode(src_token_ids_batch, src_mask)
-
-            predicted_sentences = greedy_decoding(transformer, src_representations_batch, src_mask, trg_field_processor)
-            predicted_sentences_corpus.extend(predicted_sentences)  # add them to the corpus of translations
-
-            # Get the token and not id version of GT (ground-truth) sentences
+                print(f'batch={batch_idx}, BLEU-4 so far = {bleu.score()}, time elapsed = {time.time()-ts} seconds.')
+
+            with autocast(precision, src_token_ids_batch.device):
+                # Optimization - compute the source token representations only once
+                if encoder_outputs is not None and batch_idx in encoder_outputs:
+                    src_representations_batch, src_mask = encoder_outputs[batch_idx]
+                else:
+                    src_mask, _ = get_masks_and_count_tokens_src(src_token_ids_batch, pad_token_id)
+                    src_representations_batch = transformer.encode(src_token_ids_batch, src_mask)
+                    if encoder_outputs is not None:
+                        encoder_outputs[batch_idx] = (src_representations_batch, src_mask)
+
+                _, predicted_token_ids = decoding(transformer, src_representations_batch, src_mask, trg_field_processor, return_token_ids=True)
+            predicted_token_ids = predicted_token_ids.cpu().numpy()
+
+            # GT (ground-truth) sentences are padded at the end
             trg_token_ids_batch = trg_token_ids_batch.cpu().numpy()
-            for target_sentence_ids in trg_token_ids_batch:
-                target_sentence_tokens = [trg_field_processor.vocab.itos[id] for id in target_sentence_ids if id != pad_token_id]
-                gt_sentences_corpus.append([target_sentence_tokens])  # add them to the corpus of GT translations
+            bleu.update(predicted_token_ids, lengths_up_to_eos(predicted_token_ids, eos_token_id),
+                        trg_token_ids_batch, (trg_token_ids_batch != pad_token_id).sum(axis=1))
 
-        bleu_score = corpus_bleu(gt_sentences_corpus, predicted_sentences_corpus)
-        print(f'BLEU-4 corpus score = {bleu_score}, corpus length = {len(gt_sentences_corpus)}, time elapsed = {time.time()-ts} seconds.')
+        bleu_score = bleu.score()
+        print(f'BLEU-4 corpus score = {bleu_score}, corpus length = {bleu.num_sentences}, time elapsed = {time.time()-ts} seconds.')
         return bleu_score